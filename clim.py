@@ -17,28 +17,60 @@ work on your part:
 """
 from __future__ import division, print_function, unicode_literals
 import argparse
+import hashlib
+import json
 import logging
+import marshal
 import os.path
+import pickle
 import re
+import struct
 import sys
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
 from decimal import Decimal
-from tempfile import NamedTemporaryFile
-from time import sleep
+from time import sleep, time
+
+try:
+    from time import perf_counter
+except ImportError:
+    perf_counter = time
 
 try:
     from ConfigParser import RawConfigParser
 except ImportError:
     from configparser import RawConfigParser
 
+try:
+    from importlib import import_module
+    from importlib.util import find_spec
+except ImportError:
+    import pkgutil
+    from importlib import import_module
+    find_spec = None
+
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue
+
 try:
     import thread
     import threading
 except ImportError:
-    thread = None
+    try:
+        import _thread as thread
+        import threading
+    except ImportError:
+        thread = None
 
-import colorama
-import halo
 
+# Bump these whenever the format of the subcommand manifest, config cache, result cache or completion index changes
+MANIFEST_VERSION = 3
+CONFIG_CACHE_VERSION = 4
+RESULT_CACHE_VERSION = 1
+COMPLETION_INDEX_VERSION = 1
 
 # Log Level Representations
 EMOJI_LOGLEVELS = {
@@ -71,31 +103,244 @@ ansi_regex = r'\x1b(' \
              r'(\[\?\d;\d0c)|' \
              r'(\d;\dR))'
 ansi_escape = re.compile(ansi_regex, flags=re.IGNORECASE)
+ansi_token = re.compile(r'\{(\w+)\}')
+
+# A tighter matcher for escape sequences, shaped after ECMA-48: CSI
+# sequences (colors, cursor movement, erasing), OSC strings (window titles)
+# and two character escapes. None of the branches can backtrack past the
+# next ESC, so stripping runs in linear time.
+ansi_sequence = re.compile(
+    r'\x1b(?:'
+    r'\[[0-?]*[ -/]*[@-~]|'  # CSI
+    r'\][^\x07\x1b]*(?:\x07|\x1b\\)|'  # OSC
+    r'[ -/]*[0-~])'  # nF, Fp, Fe and Fs escapes
+)
+# Matches the start of a sequence that has been cut off by the end of the text
+ansi_partial = re.compile(r'\x1b(?:\[[0-?]*[ -/]*|\](?:[^\x07\x1b]|\x1b(?!\\))*|[ -/]*)\Z')
 ansi_colors = {}
-for prefix, obj in (('fg', colorama.ansi.AnsiFore()),
-                    ('bg', colorama.ansi.AnsiBack()),
-                    ('style', colorama.ansi.AnsiStyle())):
-    for color in [x for x in obj.__dict__ if not x.startswith('_')]:
-        ansi_colors[prefix + '_' + color.lower()] = getattr(obj, color)
+
+
+def load_ansi_colors():
+    """Populate `ansi_colors` from colorama, importing it on first use.
+
+    colorama is slow to import and many runs never need a color, so the
+    table is filled in place the first time something asks for it.
+    """
+    if not ansi_colors:
+        import colorama
+
+        for prefix, obj in (('fg', colorama.ansi.AnsiFore()),
+                            ('bg', colorama.ansi.AnsiBack()),
+                            ('style', colorama.ansi.AnsiStyle())):
+            for color in [x for x in obj.__dict__ if not x.startswith('_')]:
+                ansi_colors[prefix + '_' + color.lower()] = getattr(obj, color)
+
+    return ansi_colors
+
+
+class LRUCache(object):
+    """A small thread safe mapping that holds at most `maxsize` items.
+
+    When full the least recently used item is evicted.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock() if thread else None
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Returns the value for key, marking it as recently used.
+        """
+        if self._lock:
+            self._lock.acquire()
+
+        try:
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+        except KeyError:
+            return default
+
+        finally:
+            if self._lock:
+                self._lock.release()
+
+    def set(self, key, value):
+        """Store value under key, evicting the oldest item if we are full.
+        """
+        if self._lock:
+            self._lock.acquire()
+
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        finally:
+            if self._lock:
+                self._lock.release()
+
+    def clear(self):
+        if self._lock:
+            self._lock.acquire()
+
+        try:
+            self._data.clear()
+
+        finally:
+            if self._lock:
+                self._lock.release()
+
+
+ansi_template_cache = LRUCache(1024)
+
+
+def _ansi_token_replace(match):
+    return ansi_colors.get(match.group(1), match.group(0))
+
+
+def format_ansi(text, cache=True):
+    """Replace `{color}` tokens in text with the ANSI codes they represent.
+
+    Tokens that are not a known color are left alone. Rendered text is kept
+    in `ansi_template_cache` so repeated templates only get scanned once.
+    Pass `cache=False` for text that is unlikely to repeat.
+    """
+    if '{' not in text:
+        return text
+
+    if not ansi_colors:
+        load_ansi_colors()
+
+    if not cache:
+        return ansi_token.sub(_ansi_token_replace, text)
+
+    rendered = ansi_template_cache.get(text)
+    if rendered is None:
+        rendered = ansi_token.sub(_ansi_token_replace, text)
+        ansi_template_cache.set(text, rendered)
+
+    return rendered
+
+
+def format_message(record, render):
+    """Returns the message of a log record with `render()` applied to its color tokens.
+
+    The template (`record.msg`) is rendered before the arguments are
+    interpolated, so render can cache it. When an argument, in its string
+    form, might hold a token the message is rendered again after
+    interpolation, without the cache.
+    """
+    message = render(record.msg if isinstance(record.msg, type('')) else str(record.msg))
+
+    if record.args:
+        message = message % record.args
+        args = record.args.values() if isinstance(record.args, dict) else record.args
+
+        if any('{' in str(arg) for arg in args):
+            message = render(message, cache=False)
+
+    return message
+
+
+def strip_ansi(text):
+    """Remove ANSI escape sequences from text.
+    """
+    if '\x1b' not in text:
+        return text
+
+    return ansi_sequence.sub('', text)
+
+
+class ANSIStripper(object):
+    """Strips ANSI escape sequences from text that arrives in chunks, such as subprocess output.
+
+    A sequence split across two chunks is held back until the rest of it
+    arrives. Call `flush()` at the end of the stream to get anything that
+    is still held.
+    """
+    max_pending = 4096
+
+    def __init__(self):
+        self.pending = ''
+
+    def feed(self, data):
+        """Returns data with escape sequences removed, minus any unfinished sequence at the end.
+        """
+        data = self.pending + data
+        self.pending = ''
+
+        if '\x1b' not in data:
+            return data
+
+        start = data.rfind('\x1b')
+        osc = data.rfind('\x1b]', 0, start)
+        if osc != -1 and ansi_partial.match(data, osc):
+            start = osc
+
+        if len(data) - start <= self.max_pending and ansi_partial.match(data, start):
+            data, self.pending = data[:start], data[start:]
+
+        return strip_ansi(data)
+
+    def flush(self):
+        """Returns whatever is left at the end of the stream.
+        """
+        data, self.pending = self.pending, ''
+        return strip_ansi(data)
 
 
 class ANSIFormatter(logging.Formatter):
     """A log formatter that inserts ANSI color.
+
+    Color tokens are rendered in the format string and the message
+    template, not in the finished line, so the rendering can be cached.
+    Tracebacks and stack info are rendered too, without the cache.
     """
     def format(self, record):
-        msg = super(ANSIFormatter, self).format(record)
-        # Avoid .format() so we don't have to worry about the log content
-        for color in ansi_colors:
-            msg = msg.replace('{%s}' % color, ansi_colors[color])
-        msg = msg + ansi_colors['style_reset_all']
-        return msg
+        if not getattr(self, '_ansi_fmt', False):
+            self._fmt = format_ansi(self._fmt)
+            if hasattr(self, '_style'):
+                self._style._fmt = format_ansi(self._style._fmt)
+            self._ansi_fmt = True
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        # Other handlers share the record, so put back what we change
+        msg, args, exc_text = record.msg, record.args, record.exc_text
+        stack_info = getattr(record, 'stack_info', None)
+        record.msg, record.args = format_message(record, format_ansi), None
+
+        if exc_text:
+            record.exc_text = format_ansi(exc_text, cache=False)
+
+        if stack_info:
+            record.stack_info = format_ansi(stack_info, cache=False)
+
+        try:
+            return super(ANSIFormatter, self).format(record) + load_ansi_colors()['style_reset_all']
+
+        finally:
+            record.msg, record.args, record.exc_text = msg, args, exc_text
+
+            if stack_info:
+                record.stack_info = stack_info
 
 
 class ANSIEmojiLoglevelFormatter(ANSIFormatter):
     """A log formatter that makes the loglevel an emoji.
     """
     def format(self, record):
-        record.levelname = EMOJI_LOGLEVELS[record.levelname].format(**ansi_colors)
+        record.levelname = format_ansi(EMOJI_LOGLEVELS[record.levelname])
         return super(ANSIEmojiLoglevelFormatter, self).format(record)
 
 
@@ -104,516 +349,4089 @@ class ANSIStrippingFormatter(ANSIFormatter):
     """
     def format(self, record):
         msg = super(ANSIStrippingFormatter, self).format(record)
-        return ansi_escape.sub('', msg)
+        return strip_ansi(msg)
 
 
-class Configuration(object):
-    """Represents the running configuration.
+ansi_strip_cache = LRUCache(1024)
 
-    This class never raises IndexError, instead it will return None if a
-    section or option does not yet exist.
-    """
-    def __contains__(self, key):
-        return self._config.__contains__(key)
 
-    def __iter__(self):
-        return self._config.__iter__()
+def _ansi_token_strip(match):
+    return '' if match.group(1) in ansi_colors else match.group(0)
 
-    def __len__(self):
-        return self._config.__len__()
 
-    def __repr__(self):
-        return self._config.__repr__()
+def strip_ansi_tokens(text, cache=True):
+    """Remove `{color}` tokens from text, leaving any other curly braced text alone.
 
-    def keys(self):
-        return self._config.keys()
+    Pass `cache=False` for text that is unlikely to repeat.
+    """
+    if '{' not in text:
+        return text
 
-    def items(self):
-        return self._config.items()
+    if not ansi_colors:
+        load_ansi_colors()
 
-    def values(self):
-        return self._config.values()
+    if not cache:
+        return ansi_token.sub(_ansi_token_strip, text)
 
-    def __init__(self, *args, **kwargs):
-        self._config = {}
-        self.default_container = ConfigurationOption
+    stripped = ansi_strip_cache.get(text)
+    if stripped is None:
+        stripped = ansi_token.sub(_ansi_token_strip, text)
+        ansi_strip_cache.set(text, stripped)
 
-    def __getitem__(self, key):
-        """Returns a config section, creating it if it doesn't exist yet.
-        """
-        if key not in self._config:
-            self.__dict__[key] = self._config[key] = ConfigurationOption()
+    return stripped
 
-        return self._config[key]
 
-    def __setitem__(self, key, value):
-        self.__dict__[key] = value
-        self._config[key] = value
+class JSONFormatter(logging.Formatter):
+    """A log formatter that writes each record as one line of compact JSON.
 
-    def __delitem__(self, key):
-        if key in self.__dict__ and key[0] != '_':
-            del(self.__dict__[key])
-        del(self._config[key])
+    Color tokens are removed from the message. Any `extra` fields passed
+    when logging are included, along with exception and stack info.
+    Attributes starting with `_` are internal, such as the decision
+    LogRateFilter stores on the record, and are left out.
+    """
+    standard_attributes = frozenset(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | frozenset(('message', 'asctime'))
+    encoder = json.JSONEncoder(separators=(',', ':'), default=str)
 
+    def format(self, record):
+        message = strip_ansi(format_message(record, strip_ansi_tokens))
 
-class ConfigurationOption(Configuration):
-    def __init__(self, *args, **kwargs):
-        super(ConfigurationOption, self).__init__(*args, **kwargs)
-        self.default_container = dict
+        data = {
+            'time': record.created,
+            'level': logging.getLevelName(record.levelno),
+            'logger': record.name,
+            'message': message,
+            'file': record.pathname,
+            'line': record.lineno,
+        }
 
-    def __getitem__(self, key):
-        """Returns a config section, creating it if it doesn't exist yet.
-        """
-        if key not in self._config:
-            self.__dict__[key] = self._config[key] = None
+        for key in set(record.__dict__).difference(self.standard_attributes):
+            if not key.startswith('_'):
+                data[key] = record.__dict__[key]
 
-        return self._config[key]
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
 
+        if record.exc_text:
+            data['exc_info'] = record.exc_text
 
-def handle_store_boolean(self, *args, **kwargs):
-    """Does the add_argument for action='store_boolean'.
-    """
-    kwargs['add_dest'] = False
-    disabled_args = None
-    disabled_kwargs = kwargs.copy()
-    disabled_kwargs['action'] = 'store_false'
-    disabled_kwargs['help'] = 'Disable ' + kwargs['help']
-    kwargs['action'] = 'store_true'
-    kwargs['help'] = 'Enable ' + kwargs['help']
+        if getattr(record, 'stack_info', None):
+            data['stack_info'] = record.stack_info
 
-    for flag in args:
-        if flag[:2] == '--':
-            disabled_args = ('--no-' + flag[2:],)
-            break
+        return self.encoder.encode(data)
 
-    self.add_argument(*args, **kwargs)
-    self.add_argument(*disabled_args, **disabled_kwargs)
 
-    return (args, kwargs, disabled_args, disabled_kwargs)
+class LogRateFilter(logging.Filter):
+    """A log filter that collapses repeated messages and rate limits noisy loggers.
 
+    * With a `window` (in seconds) an identical message from the same
+      logger at the same level is only let through once per window. The
+      next time it shows up after the window a line saying how many times
+      it repeated is logged first.
+    * With a `rate` (messages per second) each logger and level pair gets a
+      token bucket holding up to `burst` messages. Messages that arrive
+      when the bucket is empty are dropped.
 
-class SubparserWrapper(object):
-    """Wrap subparsers so we can populate the normal and the shadow parser.
+    The filter is attached to every root handler, so it stores its
+    decision on the record to avoid counting it once per handler. Call
+    `report()` to log what is still being held back.
     """
-    def __init__(self, cli, submodule, subparser):
-        self.cli = cli
-        self.submodule = submodule
-        self.subparser = subparser
+    max_seen = 10000
+
+    def __init__(self, window=0, rate=0, burst=10):
+        super(LogRateFilter, self).__init__()
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.enabled = True
+        self.seen = {}
+        self.buckets = {}
+        self.rate_limited = {}
+        self._lock = threading.Lock() if thread else None
+
+    def filter(self, record):
+        if not self.enabled:
+            return True
 
-        for attr in dir(subparser):
-            if not hasattr(self, attr):
-                setattr(self, attr, getattr(subparser, attr))
+        if self._lock:
+            self._lock.acquire()
 
-    def add_argument(self, *args, **kwargs):
-        if kwargs.get('add_dest', True):
-            kwargs['dest'] = self.submodule + '_' + self.cli.get_argument_name(*args, **kwargs)
-        if 'add_dest' in kwargs:
-            del(kwargs['add_dest'])
+        try:
+            decision = getattr(record, '_clim_rate_decision', None)
 
-        if 'action' in kwargs and kwargs['action'] == 'store_boolean':
-            return handle_store_boolean(self, *args, **kwargs)
+            if decision is not None:
+                return decision
 
-        self.subparser.add_argument(*args, **kwargs)
+            decision, repeated = self.decide(record)
+            record._clim_rate_decision = decision
 
-        if 'default' in kwargs:
-            del(kwargs['default'])
-        if 'action' in kwargs and kwargs['action'] == 'store_false':
-            kwargs['action'] == 'store_true'
-        self.cli.subcommands_default[self.submodule].add_argument(*args, **kwargs)
+        finally:
+            if self._lock:
+                self._lock.release()
 
+        if repeated:
+            # Marked as already decided so it goes to every handler without being counted itself
+            summary = logging.makeLogRecord(record.__dict__)
+            summary.msg = '%s (repeated %d more times)'
+            summary.args = (record.getMessage(), repeated)
+            summary.exc_info = summary.exc_text = None
+            summary._clim_rate_decision = True
+            logging.getLogger(record.name).handle(summary)
 
-class CLIM(object):
-    """# CLI Context Manager
+        return decision
 
-    This class wraps some standard python modules in nice ways for CLI tools.
-    It provides a Context Manager that can be used to quickly and easily
-    write tools that behave in the way endusers expect. It's meant to lightly
-    wrap standard python modules with just enough framework to make writing
-    simple scripts simple while allowing you to organically grow into large
-    complex programs with hundreds of options.
+    def decide(self, record):
+        """Returns (let this record through, how many repeats of it were suppressed before this).
+        """
+        now = record.created
+        repeated = 0
 
-    ## Simple Example:
+        if self.window:
+            key = (record.name, record.levelno, record.getMessage())
+            seen = self.seen.get(key)
 
-        cli = CLIM('My useful CLI tool.')
+            if seen and now - seen[0] < self.window:
+                seen[1] += 1
+                return False, 0
 
-        @cli.argument('-n', '--name', help='Name to greet', default='World')
-        @cli.entrypoint
-        def main(cli):
-            cli.log.info('Hello, %s!', cli.config.general.name)
+            if seen:
+                repeated = seen[1]
 
-        if __name__ == '__main__':
-            with cli:
-                cli.run()
+            if len(self.seen) >= self.max_seen:
+                self.seen = dict(item for item in self.seen.items() if now - item[1][0] < self.window and item[1][1])
 
-    # Basics of a CLIM app
+            self.seen[key] = [now, 0]
 
-    Start by instaniating a CLIM context manager and defining your entrypoint:
+        if self.rate:
+            key = (record.name, record.levelno)
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
 
-        cli = CLIM('My useful CLI tool')
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                self.rate_limited[key] = self.rate_limited.get(key, 0) + 1
+                return False, repeated
 
-        def main(cli):
-            print('Hello, %s!' % cli.config.general.name)
+            self.buckets[key] = (tokens - 1, now)
 
-    From here, you should setup your CLI environment. I typically prefer to
-    do this behind a __main__ check.
+        return True, repeated
 
-        if __name__ == '__main__':
-            cli.entrypoint(main)
-            cli.add_argument('-n', '--name', help='Name to greet', default='World')
+    def report(self, log):
+        """Log the messages that are still being suppressed, then stop filtering.
+        """
+        self.enabled = False
 
-    Finally, invoke it as a context manager and use `cli.run()` to dispatch to
-    your entrypoint (or a subcommand, if one has been specified.)
+        for (name, levelno, message), (first_seen, count) in sorted(self.seen.items()):
+            if count:
+                log.log(levelno, '%s (repeated %d more times)', message, count)
 
-            with cli:
-                cli.run()
+        for (name, levelno), count in sorted(self.rate_limited.items()):
+            log.warning('Rate limiting suppressed %d %s messages from %s.', count, logging.getLevelName(levelno), name)
 
-    ## Complete CLIM script, using functions
 
-        cli = CLIM('My useful CLI tool')
+class AsyncLogHandler(logging.Handler):
+    """A log handler that hands records off to a background writer thread.
 
-        def main(cli):
-            print('Hello, %s!' % cli.config.general.name)
+    Records are put into a bounded queue and formatted and written by a
+    thread that owns the real handlers. Writes are batched: the writer
+    collects records for up to `flush_interval` seconds, then writes and
+    flushes each stream once.
 
-        if __name__ == '__main__':
-            cli.entrypoint(main)
-            cli.add_argument('-n', '--name', help='Name to greet', default='World')
+    When the queue is full `policy` decides what happens:
 
-            with cli:
-                cli.run()
+    * `block`: wait for the writer to catch up
+    * `drop-oldest`: throw away the oldest queued record
+    * `drop`: throw away the new record
 
-    # Using decorators instead
+    Dropped records are counted in `self.dropped` and reported on close.
 
-    If you prefer you can use decorators instead. This can help as your program
-    grows by keeping the definition of arguments near the relevant entrypoint.
-    Not that due to the way decorators are evaluated you need to place all
-    `@cli.argument()` decorators above all other decorators.
+    `stop()` sets the `stopping` event rather than queueing a marker, which
+    `drop-oldest` could throw away. The writer checks it whenever the queue
+    runs dry, at least every `poll_interval` seconds. Records that arrive
+    after that are written by the thread that logged them, so the queue
+    can run dry even while other threads keep logging.
+    """
+    policies = ('block', 'drop-oldest', 'drop')
+    poll_interval = 0.05
+
+    def __init__(self, handlers, maxsize=10000, flush_interval=0.1, policy='block', batch_size=1024):
+        super(AsyncLogHandler, self).__init__(min(handler.level for handler in handlers) if handlers else logging.NOTSET)
+
+        if policy not in self.policies:
+            raise ValueError('Unknown log queue policy %r, must be one of %s' % (policy, ', '.join(self.policies)))
+
+        self.handlers = handlers
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.queue = Queue(maxsize)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._writer, name='CLIMLogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        """Interpolate the message now so the writer sees the values at call time.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+
+            if self.stopping.is_set():
+                self.write_batch([record])
+                return
+
+            if self.policy == 'block':
+                self.queue.put(record)
+                return
+
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                with self.queue.mutex:
+                    self.dropped += 1
+                if self.policy == 'drop-oldest':
+                    try:
+                        self.queue.get_nowait()
+                    except Empty:
+                        pass
+                    self.queue.put_nowait(record)
+
+        except Exception:
+            self.handleError(record)
+
+    def _writer(self):
+        """Background thread that drains the queue in batches.
+        """
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=self.poll_interval)]
+            except Empty:
+                continue
 
-        cli = CLIM('My useful CLI tool')
+            deadline = time() + self.flush_interval
 
-        @cli.argument('-n', '--name', help='Name to greet', default='World')
-        @cli.entrypoint
-        def main(cli):
-            print('Hello, %s!' % cli.config.general.name)
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                timeout = deadline - time()
+                try:
+                    batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+                except Empty:
+                    break
 
-        if __name__ == '__main__':
-            with cli:
-                cli.run()
+            # None is only put there by stop() to wake us up
+            self.write_batch([record for record in batch if record is not None])
 
-    # Using Subcommands
+    def write_batch(self, records):
+        """Format records and write them with a single write per stream.
 
-    A command pattern for CLI tools is to have subcommands. For example,
-    you see this in git with `git status` and `git pull`. CLIM supports
-    this pattern using the built-in argparse subcommand functionality.
+        Handlers that draw a live region, such as `LiveStreamHandler`, have it cleared around the write just like their own `emit()` does.
+        """
+        for handler in self.handlers:
+            if not hasattr(handler, 'stream'):
+                for record in records:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                continue
 
-    You can register subcommands by using the `cli.subcommand(func)`
-    function, or by decorating functions with `@cli.subcommand`. In
-    either case the subcommand name will be the same as the name of the
-    function.
+            lines = []
+            for record in records:
+                if record.levelno >= handler.level and handler.filter(record):
+                    try:
+                        lines.append(handler.format(record) + handler.terminator)
+                    except Exception:
+                        handler.handleError(record)
+
+            if lines:
+                handler.acquire()
+                try:
+                    if hasattr(handler, 'suspend'):
+                        with handler.suspend():
+                            handler.stream.write(''.join(lines))
+                            handler.flush()
+                    else:
+                        handler.stream.write(''.join(lines))
+                        handler.flush()
+                except Exception:
+                    handler.handleError(records[0])
+                finally:
+                    handler.release()
+
+    def stop(self):
+        """Drain the queue and stop the writer thread, leaving our handlers open.
+        """
+        if self.thread.is_alive():
+            self.stopping.set()
 
-    You can access the underlying subcommand instance in two ways-
+            # Wake the writer now instead of at its next poll. When the queue is full it's awake anyway.
+            try:
+                self.queue.put_nowait(None)
+            except Full:
+                pass
 
-        * Attribute access (`cli.<subcommand>`)
-        * Dictionary access (`cli.subcommands['<subcommand>']`)
+            self.thread.join()
 
-    You should generally prefer the attribute access. If there is a conflict
-    with an existing attribute or the name is not a legal attribute name you
-    will have to access it via the dictionary.
+            if self.dropped:
+                record = logging.LogRecord('CLIM', logging.WARNING, __file__, 0, '%d log records were dropped because the log queue was full.', (self.dropped,), None)
+                self.write_batch([self.prepare(record)])
 
-    When subcommands are not in use `cli.run()` will always be the same as
-    `cli.entrypoint()`. When subcommands are in use `cli.run()` will be
-    pointed to the proper command to run. If no valid subcommand is given on
-    the command line it will point to `cli.entrypoint()`. If a valid
-    subcommand is supplied it will point to `<subcommand>()`.
+    def close(self):
+        """Drain the queue, stop the writer thread and close our handlers.
+        """
+        self.stop()
 
-    Note: Python 2 does not support calling @cli.entrypoint when subcommands
-    are in use. If you need to call @cli.entrypoint when a subcommand is not
-    specified you will need to use python 3.
+        for handler in self.handlers:
+            handler.close()
 
-    ## Subcommand Example
+        super(AsyncLogHandler, self).close()
 
-        cli = CLIM('My useful CLI tool with subcommands.')
 
-        @cli.argument('-c', '--comma', help='Include the comma in output', default=True, action='store_true')
-        @cli.entrypoint
-        def main(cli):
-            cli.log.info('Hello%s World!', cli.config.general.comma)
+CONFIG_TRUE = frozenset(['1', 'yes', 'true', 'on'])
+CONFIG_FALSE = frozenset(['0', 'no', 'false', 'none', 'off'])
 
-        @cli.argument('-n', '--name', help='Name to greet', default='World')
-        @cli.subcommand
-        def hello(cli):
-            '''Description of hello subcommand here.'''
-            cli.log.info('Hello%s %s!', cli.config.general.comma, cli.config.hello.name)
 
-        def goodbye(cli):
-            '''This will show up in --help output.'''
-            cli.log.info('Goodbye%s %s!', cli.config.general.comma, cli.config.goodbye.name)
+def config_bool(value):
+    """Convert a config value to a bool, raising ValueError if it isn't one.
+    """
+    lowered = value.lower()
 
-        if __name__ == '__main__':
-            # You can register subcommands using decorators as seen above,
-            # or using functions like like this:
-            cli.subcommand(goodbye)
-            cli.goodbye.add_argument('-n', '--name', help='Name to bid farewell to', default='World')
+    if lowered in CONFIG_TRUE:
+        return True
+    elif lowered in CONFIG_FALSE:
+        return False
 
-            with cli:
-                cli.config.general.comma = ',' if cli.config.general.comma else ''
-                cli.run()  # Automatically picks between main(), hello() and goodbye()
+    raise ValueError('%r is not a boolean' % (value,))
 
-    # More Docs!
 
-    Details about the rest of the system can be found in the [docs/](docs/) directory.
+def config_string(value):
+    """Config values without a type are kept as they were written.
     """
-    def __init__(self, description, entrypoint=None, fromfile_prefix_chars='@', conflict_handler='resolve', **kwargs):
-        kwargs['fromfile_prefix_chars'] = fromfile_prefix_chars
-        kwargs['conflict_handler'] = conflict_handler
+    return value
+
+
+def config_converter(type=None, default=None, choices=None, flag=False, multiple=False):
+    """Returns the function that converts strings for a config option.
+
+    Flags and bool defaults get `config_bool()`, a `type` is used as-is
+    (just like argparse does) and otherwise the type of `default` is used.
+    Anything else, including the path of an `argparse.FileType`, is kept
+    as a string. If `choices` is given the converted value must be one of
+    them. When `multiple` is True, for arguments that take a list, the
+    value is split on commas and each item is converted.
+    """
+    if flag or type is bool or (type is None and isinstance(default, bool)):
+        converter = config_bool
+    elif type is not None and not isinstance(type, argparse.FileType):
+        converter = type
+    elif isinstance(default, (int, float, Decimal)):
+        converter = default.__class__
+    else:
+        converter = config_string
+
+    if choices:
+        converter = config_choice(converter, list(choices))
+
+    if multiple:
+        converter = config_list(converter)
+
+    return converter
+
+
+def config_choice(converter, choices):
+    """Returns a converter that checks what `converter` returns is one of `choices`.
+    """
+    def config_choice(value):
+        value = converter(value)
+
+        if value not in choices:
+            raise ValueError('%r is not one of %s' % (value, ', '.join(map(str, choices))))
+
+        return value
+
+    config_choice.signature = '%s%r' % (converter_name(converter), choices)
+
+    return config_choice
+
+
+def config_list(converter):
+    """Returns a converter for a comma separated list, converting each item with `converter`.
+    """
+    def config_list(value):
+        return [converter(item.strip()) for item in value.split(',') if item.strip()]
+
+    config_list.signature = 'list[%s]' % converter_name(converter)
+
+    return config_list
+
+
+CONVERTER_NAMES = {}
+
+
+def converter_name(converter):
+    """Returns a name for a config converter that is the same in every process.
+
+    Names are remembered in `CONVERTER_NAMES`, except for the converters
+    `config_converter()` makes for choices and lists, which carry their own.
+    """
+    name = getattr(converter, 'signature', None)
+
+    if name is None:
+        name = '%s.%s' % (getattr(converter, '__module__', None), getattr(converter, '__qualname__', None) or getattr(converter, '__name__', None) or converter.__class__.__name__)
+        code = getattr(converter, '__code__', None)
+
+        if code:
+            # Lambdas and functions defined inside other functions share a name
+            name += ':%d' % code.co_firstlineno
+
+        try:
+            CONVERTER_NAMES[converter] = name
+        except TypeError:
+            pass
+
+    return name
+
+
+def prepare_log_record(record):
+    """Make a log record safe to format later, in another thread or process.
+
+    The message is interpolated and exception info is turned into text so
+    the record no longer holds references to the caller's objects.
+    """
+    record.msg = record.getMessage()
+    record.args = None
+
+    if record.exc_info:
+        if not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+
+    return record
+
+
+class ParallelJob(object):
+    """The state of one job run by `cli.parallel()`.
+    """
+    def __init__(self, name, prefix=False, forward=None):
+        self.name = name
+        self.prefix = prefix
+        self.forward = forward
+        self.records = []
+        self.result = None
+        self.exception = None
+
+    def add_record(self, record):
+        """Collect a log record, or send it straight on if we are prefixing live output.
+        """
+        record = prepare_log_record(record)
+
+        if self.prefix:
+            record.msg = '[%s] %s' % (self.name, record.msg)
+
+        if self.forward:
+            self.forward(record)
+        else:
+            self.records.append(record)
+
+    def run(self, func, cli, item):
+        """Call func(cli, item), recording the result or the exception.
+        """
+        try:
+            self.result = func(cli, item)
+
+        except Exception as e:
+            self.exception = e
+            logging.getLogger('CLIM').exception('Job %s failed: %s', self.name, e)
+
+        return self
+
+
+class ParallelLogRouter(logging.Handler):
+    """Root log handler used while `cli.parallel()` runs.
+
+    Records logged from a thread that is running a job go to that job,
+    everything else goes to the handlers we replaced.
+    """
+    def __init__(self, handlers):
+        super(ParallelLogRouter, self).__init__()
+        self.handlers = handlers
+        self.local = threading.local()
+
+    def emit(self, record):
+        job = getattr(self.local, 'job', None)
+
+        if job:
+            job.add_record(record)
+        else:
+            self.forward(record)
+
+    def forward(self, record):
+        """Send a record to the real handlers.
+        """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def run(self, job, func, cli, item):
+        """Run a job in the current thread, capturing its log output.
+        """
+        self.local.job = job
+        try:
+            return job.run(func, cli, item)
+        finally:
+            self.local.job = None
+
+
+parallel_cli = None
+
+
+def run_parallel_process_job(job, func, item):
+    """Run a job for `cli.parallel()` in a worker process.
+
+    The worker was forked from a process that already had logging set up.
+    We replace the inherited root handlers with one that collects records
+    for the job, so they can be sent back and written by the parent.
+    """
+    class JobHandler(logging.Handler):
+        def emit(self, record):
+            job.add_record(record)
+
+    logging.root.handlers = [JobHandler()]
+
+    return job.run(func, parallel_cli, item)
+
+
+default_spinner_frames = ('⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏')
+
+
+def spinner_frames(name=None):
+    """Returns (frames, seconds per frame) for a named spinner.
+
+    Named spinners come from the `spinners` package when it is installed,
+    anything else gets the default dots.
+    """
+    if name:
+        try:
+            from spinners import Spinners
+            spinner = Spinners[name].value
+            return spinner['frames'], spinner['interval'] / 1000
+
+        except (ImportError, KeyError):
+            pass
+
+    return default_spinner_frames, 0.08
+
+
+def terminal_width(default=80):
+    """Returns the width of the terminal, or `default` if we can't tell.
+    """
+    try:
+        from shutil import get_terminal_size
+        return get_terminal_size((default, 24)).columns or default
+
+    except ImportError:
+        return default
+
+
+class CompletedAwaitable(object):
+    """An awaitable that is already finished, for `async with` support without async syntax.
+    """
+    def __init__(self, value=None):
+        self.value = value
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        raise StopIteration(self.value)
+
+    next = __next__
+
+
+class ProgressTask(object):
+    """A spinner, or a progress bar when `total` is set, drawn by a `ProgressRenderer`.
+
+    Nothing is drawn until the task is started. It can be used like a
+    `halo.Halo` spinner: `start()`, `stop()`, `succeed()`, `fail()`,
+    `warn()`, `info()` and as a context manager, including `async with`.
+    """
+    symbols = {'succeed': '✔', 'fail': '✖', 'warn': '⚠', 'info': 'ℹ'}
+
+    def __init__(self, renderer, text='', total=None, spinner=None):
+        self.renderer = renderer
+        self.text = text
+        self.total = total
+        self.completed = 0
+        self.frames, self.interval = spinner_frames(spinner)
+        self.started = None
+        self.last_status = 0
+        self.changed = True
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.stop()
+        else:
+            self.fail()
+
+    def __aenter__(self):
+        return CompletedAwaitable(self.__enter__())
+
+    def __aexit__(self, exc_type, exc_val, exc_tb):
+        return CompletedAwaitable(self.__exit__(exc_type, exc_val, exc_tb))
+
+    def update(self, advance=1, text=None, completed=None):
+        """Move a progress bar forward by `advance` steps, or to `completed`, and optionally change the text.
+        """
+        with self.renderer:
+            self.completed = self.completed + advance if completed is None else completed
+            if text is not None:
+                self.text = text
+            self.changed = True
+
+    def start(self, text=None):
+        with self.renderer:
+            if text is not None:
+                self.text = text
+            if self.started is None:
+                self.started = time()
+                self.renderer.add_task(self)
+        return self
+
+    def stop(self):
+        """Remove this task from the display without leaving anything behind.
+        """
+        self.stop_and_persist()
+
+    def stop_and_persist(self, symbol=None, text=None):
+        """Remove this task from the display and print a final line for it when `symbol` is set.
+
+        The render thread reads our state, so it is only changed with the renderer locked.
+        """
+        with self.renderer:
+            if self.started is not None:
+                self.started = None
+                line = '%s %s' % (symbol, self.text if text is None else text) if symbol else None
+                self.renderer.remove_task(self, line)
+        return self
+
+    def succeed(self, text=None):
+        return self.stop_and_persist(self.symbols['succeed'], text)
+
+    def fail(self, text=None):
+        return self.stop_and_persist(self.symbols['fail'], text)
+
+    def warn(self, text=None):
+        return self.stop_and_persist(self.symbols['warn'], text)
+
+    def info(self, text=None):
+        return self.stop_and_persist(self.symbols['info'], text)
+
+    def status(self):
+        """Returns the plain text state of this task.
+        """
+        text = strip_ansi(format_ansi(self.text))
+
+        if self.total:
+            return '%s %d/%d %3d%%' % (text, self.completed, self.total, 100 * self.completed // self.total)
+
+        return text
+
+    def render(self, now, width=20):
+        """Returns the line to draw for this task at time `now`.
+        """
+        if self.total:
+            filled = min(width, width * self.completed // self.total)
+            return '[%s%s] %s' % ('█' * filled, '░' * (width - filled), self.status())
+
+        frame = self.frames[int((now - self.started) / self.interval) % len(self.frames)]
+        return '%s %s' % (frame, self.status())
+
+
+class ProgressRenderer(object):
+    """Draws any number of spinners and progress bars from a single thread.
+
+    On a terminal the tasks are redrawn as a live region at the bottom of
+    the screen, at most `fps` times a second. Log records written by a
+    `LiveStreamHandler` are printed above the live region. When `stream`
+    is not a terminal each task prints a plain status line when it changes,
+    at most once every `status_interval` seconds.
+    """
+    def __init__(self, stream=None, fps=10, status_interval=5, tty=None):
+        self.stream = stream or sys.stderr
+        self.fps = fps
+        self.status_interval = status_interval
+        self.tty = self.stream.isatty() if tty is None else tty
+        self.tasks = []
+        self.lines_drawn = 0
+        self.lock = threading.RLock() if thread else None
+        self.thread = None
+
+    def __enter__(self):
+        if self.lock:
+            self.lock.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.lock:
+            self.lock.release()
+
+    def spinner(self, text='', spinner=None, total=None, **kwargs):
+        """Returns a new `ProgressTask`. Extra `halo.Halo` arguments are accepted and ignored.
+        """
+        return ProgressTask(self, text, total, spinner)
+
+    def task(self, text='', total=None, spinner=None):
+        """Returns a new `ProgressTask` that has already been started.
+        """
+        return ProgressTask(self, text, total, spinner).start()
+
+    def add_task(self, task):
+        with self:
+            self.tasks.append(task)
+
+            if thread and not self.thread:
+                self.thread = threading.Thread(target=self.render_loop, name='CLIM progress')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def remove_task(self, task, line=None):
+        with self:
+            self.clear()
+
+            if task in self.tasks:
+                self.tasks.remove(task)
+
+            if line:
+                self.stream.write(line + '\n')
+
+            self.draw()
+
+    @contextmanager
+    def suspend(self):
+        """Clear the live region while the caller writes to the terminal, then draw it again below.
+        """
+        with self:
+            self.clear()
+            try:
+                yield
+            finally:
+                self.draw()
+
+    def clear(self):
+        if self.lines_drawn:
+            self.stream.write('\x1b[%dA\r\x1b[J' % self.lines_drawn)
+            self.lines_drawn = 0
+
+    def draw(self):
+        if not self.tty or not self.tasks:
+            self.stream.flush()
+            return
+
+        now = time()
+        width = terminal_width() - 1
+        lines = [task.render(now)[:width] for task in self.tasks]
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+        self.lines_drawn = len(lines)
+
+    def write_status(self):
+        now = time()
+
+        for task in self.tasks:
+            if task.changed and now - task.last_status >= self.status_interval:
+                self.stream.write(task.status() + '\n')
+                task.changed = False
+                task.last_status = now
+
+        self.stream.flush()
+
+    def render_loop(self):
+        while True:
+            with self:
+                if not self.tasks:
+                    self.thread = None
+                    return
+
+                try:
+                    if self.tty:
+                        self.clear()
+                        self.draw()
+                    else:
+                        self.write_status()
+
+                except Exception:
+                    # Clear it while we still hold the lock, so the next add_task() starts a new thread
+                    self.thread = None
+                    raise
+
+            sleep(1 / self.fps)
+
+    def close(self):
+        """Stop drawing and clear whatever is left of the live region.
+        """
+        with self:
+            self.clear()
+            self.tasks = []
+            self.stream.flush()
+            render_thread = self.thread
+
+        if render_thread:
+            render_thread.join()
+
+
+class LiveStreamHandler(logging.StreamHandler):
+    """A StreamHandler that prints above the live region of a `ProgressRenderer`.
+    """
+    def __init__(self, stream=None, renderer=None):
+        super(LiveStreamHandler, self).__init__(stream)
+        self.renderer = renderer
+
+    @contextmanager
+    def suspend(self):
+        """Clear the live region, if there is one, while the caller writes to our stream.
+        """
+        if self.renderer and self.renderer.tasks:
+            with self.renderer.suspend():
+                yield
+        else:
+            yield
+
+    def emit(self, record):
+        with self.suspend():
+            super(LiveStreamHandler, self).emit(record)
+
+
+class CommandResult(object):
+    """The outcome of `cli.run_command()`.
+
+    `stdout` and `stderr` hold the ANSI stripped output when it was
+    captured and are None otherwise. `output_bytes` counts everything the
+    command wrote and `peak_output_size` is the most output we held in
+    memory at once.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.returncode = None
+        self.duration = 0
+        self.timed_out = False
+        self.stdout = None
+        self.stderr = None
+        self.output_bytes = 0
+        self.peak_output_size = 0
+
+    def __repr__(self):
+        return 'CommandResult(%r, returncode=%r, duration=%.3f)' % (self.command, self.returncode, self.duration)
+
+    def __bool__(self):
+        return self.returncode == 0
+
+    __nonzero__ = __bool__
+
+
+def read_command_output(pipe, name, output):
+    """Put each chunk read from pipe on the output queue, then (name, None) when it closes.
+    """
+    try:
+        for data in iter(lambda: os.read(pipe.fileno(), 65536), b''):
+            output.put((name, data))
+
+    finally:
+        pipe.close()
+        output.put((name, None))
+
+
+def kill_process_group(process, grace=5):
+    """Stop process and everything it started, giving them `grace` seconds to exit before they are killed.
+    """
+    import signal
+
+    if os.name != 'posix':
+        import subprocess
+        subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)])
+        return
+
+    for sig, wait in ((signal.SIGTERM, grace), (signal.SIGKILL, 0)):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            return
+
+        while wait > 0 and process.poll() is None:
+            sleep(0.05)
+            wait -= 0.05
+
+        if process.poll() is not None:
+            return
+
+
+class PollingWatcher(object):
+    """Watches files and directories for changes by comparing mtimes and sizes every `interval` seconds.
+    """
+    def __init__(self, paths, interval=0.5):
+        self.paths = paths
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """Returns {path: (mtime, size)} for every file under our paths.
+        """
+        files = {}
+
+        for path in self.paths:
+            if os.path.isdir(path):
+                self.scan_directory(path, files)
+            else:
+                try:
+                    stat = os.stat(path)
+                    files[path] = (stat.st_mtime, stat.st_size)
+                except OSError:
+                    pass
+
+        return files
+
+    def scan_directory(self, path, files):
+        scandir = getattr(os, 'scandir', None)
+
+        if not scandir:
+            for directory, subdirectories, filenames in os.walk(path):
+                for filename in filenames:
+                    try:
+                        stat = os.stat(os.path.join(directory, filename))
+                        files[os.path.join(directory, filename)] = (stat.st_mtime, stat.st_size)
+                    except OSError:
+                        pass
+            return
+
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    self.scan_directory(entry.path, files)
+                else:
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                pass
+
+    def wait(self, timeout=None):
+        """Wait for something to change, up to timeout seconds. Returns the set of changed paths.
+        """
+        deadline = None if timeout is None else time() + timeout
+
+        while True:
+            sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time())))
+
+            snapshot = self.scan()
+            changed = set(path for path in set(snapshot) | set(self.snapshot) if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+
+            if changed or (deadline is not None and time() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Watches files and directories for changes with Linux's inotify.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x80000
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+
+        self.paths = paths
+        self.watches = {}
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+
+        for path in paths:
+            if os.path.isdir(path):
+                self.add_tree(path)
+            else:
+                self.add_watch(os.path.dirname(path), os.path.basename(path))
+
+    def add_watch(self, directory, name=None):
+        """Watch directory for changes to name, or to anything in it when name is None.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, (directory or '.').encode(sys.getfilesystemencoding()), self.mask)
+
+        if wd < 0:
+            return
+
+        names = None
+        if name is not None:
+            names = self.watches.get(wd, (directory, set()))[1]
+            if names is not None:
+                names.add(name)
+
+        self.watches[wd] = (directory, names)
+
+    def add_tree(self, path):
+        for directory, subdirectories, filenames in os.walk(path):
+            self.add_watch(directory)
+
+    def wait(self, timeout=None):
+        """Wait for something to change, up to timeout seconds. Returns the set of changed paths.
+        """
+        import select
+
+        changed = set()
+        deadline = None if timeout is None else time() + timeout
+
+        while not changed:
+            if not select.select([self.fd], [], [], None if deadline is None else max(0, deadline - time()))[0]:
+                break
+
+            self.read_events(changed)
+
+        return changed
+
+    def read_events(self, changed):
+        """Read the waiting inotify events and add the paths they mention to changed.
+        """
+        data = os.read(self.fd, 65536)
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode(sys.getfilesystemencoding(), 'replace')
+            offset += 16 + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                changed.update(self.paths)
+                continue
+
+            if wd not in self.watches:
+                continue
+
+            directory, names = self.watches[wd]
+
+            if mask & self.IN_IGNORED:
+                del self.watches[wd]
+                continue
+
+            if names is not None and name not in names:
+                continue
+
+            path = os.path.join(directory, name) if name else directory
+            changed.add(path)
+
+            if names is None and mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.add_tree(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def file_watcher(paths, interval=0.5):
+    """Returns an `InotifyWatcher` for paths where inotify is available, or a `PollingWatcher` otherwise.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (AttributeError, OSError):
+            pass
+
+    return PollingWatcher(paths, interval)
+
+
+class Metric(object):
+    """Base class for metrics. Every metric has its own lock so updating it never waits on CLIM.
+    """
+    kind = None
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock() if thread else None
+
+    def _acquire(self):
+        if self._lock:
+            self._lock.acquire()
+
+    def _release(self):
+        if self._lock:
+            self._lock.release()
+
+
+class Counter(Metric):
+    """A value that only goes up, such as the number of files processed.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help=''):
+        super(Counter, self).__init__(name, help)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self._acquire()
+        self.value += amount
+        self._release()
+
+    def reset(self):
+        self._acquire()
+        self.value = 0
+        self._release()
+
+    def export(self):
+        return {'type': self.kind, 'help': self.help, 'value': self.value}
+
+    def prometheus(self):
+        return ['%s %s' % (self.name, self.value)]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, such as the size of a queue.
+    """
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self._acquire()
+        self.value = value
+        self._release()
+
+
+class Histogram(Metric):
+    """Counts observations, such as latencies, in fixed buckets.
+
+    Each bucket counts the observations less than or equal to its upper bound.
+    """
+    kind = 'histogram'
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help='', buckets=None):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        self._acquire()
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self._release()
+
+    def reset(self):
+        self._acquire()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self._release()
+
+    @contextmanager
+    def time(self):
+        """Context manager that observes how many seconds its body takes.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def cumulative_counts(self):
+        """Returns a list of (upper bound, count) pairs, ending with +Inf.
+        """
+        total = 0
+        counts = []
+
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            counts.append((bound, total))
+
+        return counts
+
+    def export(self):
+        buckets = [['+Inf' if bound == float('inf') else bound, count] for bound, count in self.cumulative_counts()]
+        return {'type': self.kind, 'help': self.help, 'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+    def prometheus(self):
+        lines = []
+
+        for bound, count in self.cumulative_counts():
+            lines.append('%s_bucket{le="%s"} %s' % (self.name, '+Inf' if bound == float('inf') else bound, count))
+
+        lines.append('%s_sum %s' % (self.name, self.sum))
+        lines.append('%s_count %s' % (self.name, self.count))
+
+        return lines
+
+
+class MetricsRegistry(object):
+    """Holds the counters, gauges and histograms for a run.
+
+    Ask for a metric by name; the same object is returned every time, so
+    look it up once outside of hot loops:
+
+        files = cli.metrics.counter('files_processed', 'Files we have looked at')
+        for file in files_to_check:
+            files.inc()
+    """
+    formats = ('json', 'prometheus')
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self._lock = threading.Lock() if thread else None
+
+    def get_metric(self, metric_class, name, *args, **kwargs):
+        """Returns the metric called name, creating it if it doesn't exist yet.
+        """
+        metric = self.metrics.get(name)
+
+        if metric is None:
+            if self._lock:
+                self._lock.acquire()
+
+            try:
+                metric = self.metrics.setdefault(name, metric_class(name, *args, **kwargs))
+            finally:
+                if self._lock:
+                    self._lock.release()
+
+        if type(metric) is not metric_class:
+            raise TypeError('Metric %s is a %s, not a %s!' % (name, metric.kind, metric_class.kind))
+
+        return metric
+
+    def counter(self, name, help=''):
+        return self.get_metric(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self.get_metric(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=None):
+        return self.get_metric(Histogram, name, help, buckets)
+
+    def reset(self):
+        """Set every metric back to zero. The metric objects stay the same, so references to them keep working.
+        """
+        for metric in list(self.metrics.values()):
+            metric.reset()
+
+    def export(self):
+        """Returns a dictionary of every metric, suitable for JSON.
+        """
+        return OrderedDict((name, metric.export()) for name, metric in self.metrics.items())
+
+    def prometheus(self):
+        """Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+
+        for metric in self.metrics.values():
+            if metric.help:
+                lines.append('# HELP %s %s' % (metric.name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.prometheus())
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, format='json'):
+        """Write every metric to filename in the given format.
+        """
+        if format not in self.formats:
+            raise ValueError('Unknown metrics format %r, must be one of %s' % (format, ', '.join(self.formats)))
+
+        with open(filename, 'w') as fd:
+            if format == 'prometheus':
+                fd.write(self.prometheus())
+            else:
+                json.dump(self.export(), fd, indent=4)
+
+
+# Stored in the runtime layer by `del`, hiding the option in the layers below
+deleted_option = object()
+
+
+class ConfigurationReader(object):
+    """The read side of the configuration, shared by `Configuration` and `ConfigSnapshot`.
+
+    Everything is read from `self._snapshot`, the ConfigSnapshot being
+    read. Sections are returned as `ConfigurationOption` views.
+    """
+    def __contains__(self, key):
+        return any(key in layer for layer in self._snapshot._search)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return repr(self.merged())
+
+    def __getattr__(self, key):
+        if key[0] == '_':
+            raise AttributeError(key)
+
+        return self[key]
+
+    def keys(self):
+        keys = []
+        for layer in self._snapshot._layers.values():
+            keys.extend(key for key in layer if key not in keys)
+
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __getitem__(self, key):
+        """Returns a view of a config section.
+        """
+        return ConfigurationOption(self, key)
+
+    def get_layer(self, name):
+        """Returns the dictionary of sections for a layer. Don't modify it.
+        """
+        return self._snapshot._layers[name]
+
+    def provenance(self, section, option):
+        """Returns the name of the layer that `section.option` comes from, or None if it is not set.
+        """
+        layers = self._snapshot._layers
+
+        for name in reversed(Configuration.layer_names):
+            options = layers[name].get(section, ())
+            if option in options:
+                return None if options[option] is deleted_option else name
+
+    def merged(self, layers=None):
+        """Returns a plain dictionary of the configuration.
+
+        If `layers` is given only those layers are included. Deleted
+        options are left out.
+        """
+        merged = {}
+
+        for name in Configuration.layer_names:
+            if layers is None or name in layers:
+                for section, options in self._snapshot._layers[name].items():
+                    merged.setdefault(section, {}).update(options)
+
+        for options in merged.values():
+            for option in [option for option, value in options.items() if value is deleted_option]:
+                del(options[option])
+
+        return merged
+
+
+class ConfigSnapshot(ConfigurationReader):
+    """The configuration at one point in time.
+
+    Every change to `cli.config` publishes a new snapshot, which shares the
+    layers and sections that didn't change with the one before it. A
+    snapshot has no state of its own that changes, and the layer and
+    section dictionaries are replaced rather than modified once they have
+    been published, so snapshots can be handed to other threads and read
+    without taking any locks. The dictionaries are plain dicts to keep
+    reads fast, so don't modify what `get_layer()` returns.
+
+    Snapshots are read the same way as `cli.config`. Assigning to one
+    raises TypeError.
+    """
+    def __init__(self, layers, sources):
+        object.__setattr__(self, '_layers', layers)
+        object.__setattr__(self, '_search', tuple(reversed(layers.values())))
+        object.__setattr__(self, 'sources', sources)
+
+    @property
+    def _snapshot(self):
+        return self
+
+    def __setattr__(self, key, value):
+        raise TypeError('Config snapshots are read only')
+
+    def __setitem__(self, key, value):
+        raise TypeError('Config snapshots are read only')
+
+    def __delitem__(self, key):
+        raise TypeError('Config snapshots are read only')
+
+    def _set_option(self, section, option, value):
+        raise TypeError('Config snapshots are read only')
+
+    def _delete_option(self, section, option):
+        raise TypeError('Config snapshots are read only')
+
+
+class Configuration(ConfigurationReader):
+    """Represents the running configuration.
+
+    The configuration is built from layers. From lowest to highest priority
+    they are:
+
+    * `defaults`: argument defaults
+    * `system`: the system wide config file
+    * `user`: the user's config file
+    * `project`: the config file for the directory we are running in
+    * `env`: environment variables
+    * `cli`: arguments passed on the command line
+    * `runtime`: values assigned while the program runs
+
+    Each layer is a dictionary of sections, which are dictionaries of
+    options. Layers are never merged, lookups check each layer from the top
+    down. Layers are replaced as a whole using `set_layer()`, assignments go
+    into the `runtime` layer. Deleting an option stores `deleted_option` in
+    the `runtime` layer, so it reads as None whichever layer it came from.
+
+    The layers are held in a `ConfigSnapshot`. Reads never take a lock,
+    they use whichever snapshot is current. Changes copy the layer and
+    section they touch and publish a new snapshot, holding a lock that only
+    writers use. Use `snapshot()` when a series of reads needs to agree
+    with each other, or to give a worker a config that won't change under
+    it.
+
+    This class never raises IndexError, instead it will return None if a
+    section or option does not yet exist.
+    """
+    layer_names = ('defaults', 'system', 'user', 'project', 'env', 'cli', 'runtime')
+
+    def __init__(self, *args, **kwargs):
+        self._snapshot = ConfigSnapshot(OrderedDict((name, {}) for name in self.layer_names), {})
+        self._sections = {}
+        self._write_lock = threading.Lock() if thread else None
+
+    @property
+    def sources(self):
+        return self._snapshot.sources
+
+    def __setattr__(self, key, value):
+        if key[0] == '_':
+            object.__setattr__(self, key, value)
+        else:
+            self[key] = value
+
+    def __getitem__(self, key):
+        """Returns a view of a config section. Views are reused, they always read the current snapshot.
+        """
+        section = self._sections.get(key)
+
+        if section is None:
+            section = self._sections.setdefault(key, ConfigurationOption(self, key))
+
+        return section
+
+    def __setitem__(self, key, value):
+        value = dict(value)
+
+        def update(layer):
+            layer = dict(layer)
+            layer[key] = value
+            return layer
+
+        self._publish('runtime', update)
+
+    def __delitem__(self, key):
+        options = self[key].keys()
+
+        def update(layer):
+            layer = dict(layer)
+            layer[key] = dict((option, deleted_option) for option in options)
+            return layer
+
+        self._publish('runtime', update)
+
+    def _set_option(self, section, option, value):
+        def update(layer):
+            layer = dict(layer)
+            layer[section] = dict(layer.get(section, ()))
+            layer[section][option] = value
+            return layer
+
+        self._publish('runtime', update)
+
+    def _delete_option(self, section, option):
+        def update(layer):
+            layer = dict(layer)
+            layer[section] = dict(layer.get(section, ()))
+            layer[section][option] = deleted_option
+            return layer
+
+        self._publish('runtime', update)
+
+    def _publish(self, name, update, source=False):
+        """Publish a new snapshot with layer `name` replaced by `update(layer)`.
+
+        If `source` is given it becomes the source of the layer. Writers
+        hold `_write_lock` so changes made at the same time aren't lost.
+        """
+        if self._write_lock:
+            self._write_lock.acquire()
+
+        try:
+            snapshot = self._snapshot
+            layers = OrderedDict(snapshot._layers)
+            layers[name] = update(layers[name])
+            sources = snapshot.sources
+
+            if source is not False:
+                sources = dict(sources)
+                sources[name] = source
+
+            self._snapshot = ConfigSnapshot(layers, sources)
+
+        finally:
+            if self._write_lock:
+                self._write_lock.release()
+
+    def snapshot(self):
+        """Returns the current ConfigSnapshot.
+        """
+        return self._snapshot
+
+    def set_layer(self, name, layer, source=None):
+        """Replace a layer with a dictionary of sections.
+
+        The layer becomes part of a snapshot, so don't modify it afterwards.
+        """
+        if name not in self.layer_names:
+            raise KeyError('Unknown configuration layer %r' % name)
+
+        self._publish(name, lambda current: layer, source)
+
+
+class ConfigurationOption(object):
+    """A view of a single config section across every configuration layer.
+
+    Views of `cli.config` read from whichever snapshot is current, and
+    assignments publish a new one. Views of a ConfigSnapshot are read only.
+    """
+    def __init__(self, config, section):
+        object.__setattr__(self, '_config', config)
+        object.__setattr__(self, '_section', section)
+
+    def __contains__(self, key):
+        for layer in self._config._snapshot._search:
+            if self._section in layer and key in layer[self._section]:
+                return layer[self._section][key] is not deleted_option
+
+        return False
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __getattr__(self, key):
+        if key[0] == '_':
+            raise AttributeError(key)
+
+        return self[key]
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def keys(self):
+        keys = []
+        for layer in self._config._snapshot._layers.values():
+            keys.extend(key for key in layer.get(self._section, ()) if key not in keys)
+
+        return [key for key in keys if key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __getitem__(self, key):
+        """Returns the value of an option, or None if it is not set.
+        """
+        for layer in self._config._snapshot._search:
+            if self._section in layer and key in layer[self._section]:
+                value = layer[self._section][key]
+                return None if value is deleted_option else value
+
+    def __setitem__(self, key, value):
+        self._config._set_option(self._section, key, value)
+
+    def __delitem__(self, key):
+        self._config._delete_option(self._section, key)
+
+
+class ConfigSchema(object):
+    """The declared type of every config option we know about.
+
+    Each option gets its converter when it is added, so converting a config
+    file is a dictionary lookup and a function call per option. Options
+    that are not in the schema are left as strings and reported by
+    `convert()` instead of being guessed at.
+
+    The name of each converter is kept in `names` so `fingerprint()` can
+    tell whether values converted by another process are still good.
+    """
+    def __init__(self):
+        self.converters = {}
+        self.names = {}
+
+    def add(self, section, option, type=None, default=None, choices=None, flag=False, multiple=False):
+        """Declare `section.option`. The arguments are the same as `config_converter()`.
+        """
+        converter = config_converter(type, default, choices, flag, multiple)
+        self.converters.setdefault(section, {})[option] = converter
+
+        try:
+            name = CONVERTER_NAMES.get(converter) or converter_name(converter)
+        except TypeError:
+            name = converter_name(converter)
+
+        self.names.setdefault(section, {})[option] = name
+
+    def add_dest(self, dest, type=None, default=None, choices=None, flag=False, multiple=False):
+        """Declare the option for an argument dest, which is named `<section>_<option>`.
+        """
+        if '_' in dest and dest not in ('subparsers', 'entrypoint'):
+            section, option = dest.split('_', 1)
+            self.add(section, option, type, default, choices, flag, multiple)
+
+    def add_action(self, action):
+        """Declare the option for an argparse action.
+        """
+        flag = action.nargs == 0 and isinstance(action.const, bool)
+        type = int if action.nargs == 0 and action.const is None else action.type
+        multiple = isinstance(action, argparse._AppendAction) or action.nargs in ('*', '+') or (isinstance(action.nargs, int) and action.nargs > 0)
+        self.add_dest(action.dest, type, action.default, action.choices, flag, multiple)
+
+    def add_arguments(self, command, arguments, argument_name):
+        """Declare the options for the (args, kwargs) pairs of a subcommand that hasn't been built yet.
+
+        This mirrors how `SubparserWrapper.add_argument()` names dests, using
+        `argument_name()` (`cli.get_argument_name()`) to find them.
+        """
+        for args, kwargs in arguments:
+            if kwargs.get('add_dest', True):
+                dest = command + '_' + argument_name(*args, **kwargs)
+            else:
+                dest = kwargs['dest']
+
+            action = kwargs.get('action')
+            nargs = kwargs.get('nargs')
+            type = int if action == 'count' else kwargs.get('type')
+            multiple = action == 'append' or nargs in ('*', '+') or (isinstance(nargs, int) and nargs > 0)
+            self.add_dest(dest, type, kwargs.get('default'), kwargs.get('choices'), action in ('store_true', 'store_false', 'store_boolean'), multiple)
+
+    def convert(self, config):
+        """Convert a dictionary of sections of strings.
+
+        Returns (converted, unknown, invalid). Unknown options are kept as
+        strings and listed as (section, option). Invalid values are dropped
+        and listed as (section, option, value, error). `None`, which is what
+        `save_config()` writes for options that aren't set, becomes None.
+        """
+        converted = {}
+        unknown = []
+        invalid = []
+
+        for section, options in config.items():
+            converters = self.converters.get(section, {})
+            converted[section] = values = {}
+
+            for option, value in options.items():
+                converter = converters.get(option)
+
+                if converter is None:
+                    values[option] = value
+                    unknown.append((section, option))
+                    continue
+
+                if value == 'None':
+                    values[option] = None
+                    continue
+
+                try:
+                    values[option] = converter(value)
+                except (TypeError, ValueError) as e:
+                    invalid.append((section, option, value, str(e)))
+
+        return converted, unknown, invalid
+
+    def fingerprint(self):
+        """Returns a digest of the converter names, which only changes when an option is converted differently.
+        """
+        return hashlib.sha1(marshal.dumps(self.names, 2)).hexdigest()
+
+
+def handle_store_boolean(self, *args, **kwargs):
+    """Does the add_argument for action='store_boolean'.
+    """
+    kwargs['add_dest'] = False
+    disabled_args = None
+    disabled_kwargs = kwargs.copy()
+    disabled_kwargs['action'] = 'store_false'
+    disabled_kwargs['help'] = 'Disable ' + kwargs['help']
+    kwargs['action'] = 'store_true'
+    kwargs['help'] = 'Enable ' + kwargs['help']
+
+    for flag in args:
+        if flag[:2] == '--':
+            disabled_args = ('--no-' + flag[2:],)
+            break
+
+    self.add_argument(*args, **kwargs)
+    self.add_argument(*disabled_args, **disabled_kwargs)
+
+    return (args, kwargs, disabled_args, disabled_kwargs)
+
+
+def argument(*args, **kwargs):
+    """Decorator that records an argument on a lazy subcommand.
+
+    Modules loaded with `cli.lazy_subcommand()` do not have access to the
+    CLIM instance when they are imported, so they use this instead of
+    `@cli.argument()`. Arguments are stored on the function and copied into
+    the subcommand manifest.
+    """
+    def argument_function(handler):
+        if '_clim_arguments' not in handler.__dict__:
+            handler._clim_arguments = []
+
+        handler._clim_arguments.append((args, kwargs))
+
+        return handler
+
+    return argument_function
+
+
+def cached(files=None, artifacts=None, sections=None, version=0):
+    """Decorator that lets a subcommand's results be served from the result cache.
+
+    The cache key covers the config `sections` (the subcommand's own section
+    by default), the contents of `files` and `version`. Bump `version` when
+    the subcommand changes what it produces. `artifacts` are files the
+    subcommand writes, which are stored with the result and put back on a
+    hit. `files` and `artifacts` are lists of paths or glob patterns, or a
+    function that takes `cli` and returns one.
+    """
+    def cached_function(handler):
+        handler._clim_cache = {'files': files, 'artifacts': artifacts, 'sections': sections, 'version': version}
+
+        return handler
+
+    return cached_function
+
+
+def file_signature(stat):
+    """Returns the parts of an `os.stat()` result that change when a file does: (mtime in nanoseconds, inode, size).
+
+    A float mtime can miss two writes close together, and a file replaced
+    by renaming another over it has a new inode.
+    """
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1e9)
+
+    return (mtime_ns, stat.st_ino, stat.st_size)
+
+
+def find_module_file(module):
+    """Returns the file a dotted module name would be loaded from, without importing it.
+    """
+    if find_spec:
+        spec = find_spec(module)
+        return spec.origin if spec else None
+
+    loader = pkgutil.get_loader(module)
+    return loader.get_filename() if loader else None
+
+
+tracked_actions = {}
+
+
+def tracked_action(action_class):
+    """Returns a subclass of action_class that remembers when it was used.
+
+    Actions are only called for arguments that were given on the command
+    line, so `action.passed` tells us which values did not come from a default.
+    """
+    if action_class not in tracked_actions:
+        class TrackedAction(action_class):
+            passed = False
+
+            def __call__(self, parser, namespace, values, option_string=None):
+                self.passed = True
+                return super(TrackedAction, self).__call__(parser, namespace, values, option_string)
+
+        TrackedAction.__name__ = str('Tracked' + action_class.__name__)
+        tracked_actions[action_class] = TrackedAction
+
+    return tracked_actions[action_class]
+
+
+class ResultRecorder(logging.Handler):
+    """Root log handler that keeps a copy of every record while a cached subcommand runs.
+    """
+    def __init__(self):
+        super(ResultRecorder, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        record = prepare_log_record(logging.makeLogRecord(record.__dict__))
+        record.levelname = logging.getLevelName(record.levelno)
+        self.records.append(record)
+
+
+class TeeStream(object):
+    """Wraps a stream, keeping a copy of everything written to it.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.data = []
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+    def write(self, data):
+        self.data.append(data)
+        return self.stream.write(data)
+
+
+class ResultCache(object):
+    """An on-disk store of subcommand results, addressed by a hash of their inputs.
+
+    Each entry is a single pickle that is written to a temporary file and
+    renamed into place, so several processes can share the store without
+    ever reading half an entry. Reading an entry touches its mtime and when
+    the store grows past `max_size` bytes the least recently used entries
+    are removed.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """Returns the entry stored under key, or None.
+        """
+        path = self.entry_path(key)
+
+        try:
+            with open(path, 'rb') as fd:
+                entry = pickle.load(fd)
+
+            os.utime(path, None)
+
+        except Exception:
+            return None
+
+        if entry.get('version') != RESULT_CACHE_VERSION:
+            return None
+
+        return entry
+
+    def put(self, key, entry):
+        """Store entry under key, then evict old entries if the store is too big.
+        """
+        from tempfile import NamedTemporaryFile
+
+        path = self.entry_path(key)
+        entry['version'] = RESULT_CACHE_VERSION
+
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+
+        with NamedTemporaryFile(mode='wb', dir=os.path.dirname(path), prefix='.', delete=False) as tmpfile:
+            pickle.dump(entry, tmpfile, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmpfile.name, path)
+        self.evict()
+
+    def entries(self):
+        """Returns a list of (mtime, size, path) for every entry in the store.
+        """
+        entries = []
+
+        for directory, subdirectories, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.startswith('.') or filename == 'lock':
+                    continue
+
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def remove(self, entries):
+        """Delete entries, ignoring any that another process already removed. Returns how many we removed.
+        """
+        removed = 0
+
+        for mtime, size, path in entries:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+
+        return removed
+
+    def evict(self):
+        """Remove the least recently used entries until the store fits in max_size.
+
+        If another process is already evicting we leave it to them.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+
+        with open(os.path.join(self.path, 'lock'), 'a') as lock:
+            if fcntl:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    return
+
+            entries = sorted(self.entries())
+            total = sum(size for mtime, size, path in entries)
+            expired = []
+
+            while entries and total > self.max_size:
+                expired.append(entries.pop(0))
+                total -= expired[-1][1]
+
+            self.remove(expired)
+
+    def stats(self):
+        """Returns a dictionary describing the store.
+        """
+        entries = self.entries()
+
+        return {
+            'path': self.path,
+            'entries': len(entries),
+            'size': sum(size for mtime, size, path in entries),
+            'max_size': self.max_size,
+        }
+
+    def purge(self):
+        """Remove every entry. Returns how many were removed.
+        """
+        return self.remove(self.entries())
+
+
+def cache_stats(cli):
+    """Show how much is in the result cache."""
+    stats = cli.result_cache.stats()
+    cli.log.info('%d cached results using %.1f of %.1f MiB in %s', stats['entries'], stats['size'] / 2**20, stats['max_size'] / 2**20, stats['path'])
+
+
+def cache_purge(cli):
+    """Remove everything from the result cache."""
+    cli.log.info('Removed %d cached results.', cli.result_cache.purge())
+
+
+class CLIMArgumentParser(argparse.ArgumentParser):
+    """The ArgumentParser CLIM uses for the main parser and every subparser.
+
+    Every action it creates is a `tracked_action()`, so after parsing we
+    can tell which arguments were actually passed.
+
+    If `populate` is set it will be called (once) before the first parse.
+    argparse only parses with the subparser that was selected, so the
+    arguments for every other lazy subcommand are never built.
+    """
+    populate = None
+
+    def _pop_action_class(self, kwargs, default=None):
+        return tracked_action(super(CLIMArgumentParser, self)._pop_action_class(kwargs, default))
+
+    def parse_known_args(self, args=None, namespace=None):
+        if self.populate:
+            populate, self.populate = self.populate, None
+            populate()
+
+        for action in self._actions:
+            action.passed = False
+
+        return super(CLIMArgumentParser, self).parse_known_args(args, namespace)
+
+    def passed_args(self):
+        """Returns the dest of every argument that was passed to this parser.
+        """
+        return set(action.dest for action in self._actions if action.passed)
+
+
+class LazyHandler(object):
+    """Stand-in for a lazy subcommand that imports the real handler when called.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.module, self.__name__ = path.split(':', 1)
+        self.handler = None
+
+    def load(self):
+        """Import the module and return the real handler.
+        """
+        if not self.handler:
+            self.handler = resolve_path(self.path)
+
+        return self.handler
+
+    def __call__(self, cli):
+        return self.load()(cli)
+
+
+def resolve_path(path):
+    """Import `module:qualname` and return the object it names.
+    """
+    module, name = path.split(':', 1)
+    value = import_module(module)
+
+    for attr in name.split('.'):
+        value = getattr(value, attr)
+
+    return value
+
+
+def callable_path(value):
+    """Returns the `module:qualname` value can be imported from, or None if it can't be.
+
+    Only modules that are already imported are looked at, so this never imports anything.
+    """
+    module = getattr(value, '__module__', None)
+    name = getattr(value, '__qualname__', None) or getattr(value, '__name__', None)
+
+    if not module or not name or '<' in name or module not in sys.modules:
+        return None
+
+    path = '%s:%s' % (module, name)
+
+    try:
+        return path if resolve_path(path) is value else None
+    except AttributeError:
+        return None
+
+
+def is_plain_data(value):
+    """Returns True if value is built only from strings, numbers, None and containers of them.
+    """
+    if value is None or isinstance(value, (type(''), type(b''), bool, int, float, Decimal)):
+        return True
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all(is_plain_data(item) for item in value)
+
+    if isinstance(value, dict):
+        return all(is_plain_data(key) and is_plain_data(item) for key, item in value.items())
+
+    return False
+
+
+def manifest_arguments(arguments):
+    """Returns the (args, kwargs) for a lazy subcommand as (args, kwargs, callables), which only hold plain data.
+
+    Callables such as `type=` are taken out of kwargs and put in callables
+    as the `module:qualname` they can be imported from. Loading the manifest
+    then never imports the subcommand's modules. Raises ValueError if an
+    argument has anything else in it, such as a lambda.
+    """
+    plain = []
+
+    for args, kwargs in arguments:
+        kwargs = dict(kwargs)
+        callables = {}
+
+        for key, value in list(kwargs.items()):
+            if is_plain_data(value):
+                continue
+
+            path = callable_path(value) if callable(value) else None
+            if not path:
+                raise ValueError('%s=%r can not be stored in the manifest' % (key, value))
+
+            del(kwargs[key])
+            callables[key] = path
+
+        if not is_plain_data(args):
+            raise ValueError('%r can not be stored in the manifest' % (args,))
+
+        plain.append((args, kwargs, callables))
+
+    return plain
+
+
+def argument_kwargs(kwargs, callables):
+    """Put the callables taken out by `manifest_arguments()` back into kwargs.
+    """
+    kwargs = dict(kwargs)
+
+    for key, path in callables.items():
+        kwargs[key] = resolve_path(path)
+
+    return kwargs
+
+
+def add_completer(add_argument, args, kwargs):
+    """Call add_argument, keeping the optional `completer` keyword on the new action.
+
+    A completer is a function that takes `cli` and returns the values the
+    argument can have. It is called when the completion index is built.
+    """
+    completer = kwargs.pop('completer', None)
+    action = add_argument(*args, **kwargs)
+
+    if completer:
+        action.completer = completer
+
+    return action
+
+
+# Shell completion reads the completion index with this, so it never has to start python.
+# The index has one tab separated line per word: command, word, kind, values.
+completion_awk = r"""
+BEGIN { FS = "\t"; command = "." }
+FILENAME == "-" { if ($0 != "") words[nwords++] = $0; next }
+/^#/ { next }
+$3 == "command" { commands[$2] = 1; next }
+$3 == "value" { positional[$1] = $4; next }
+{ kinds[$1, $2] = $3; values[$1, $2] = $4 }
+END {
+    expecting = ""
+    for (i = 0; i < nwords; i++) {
+        word = words[i]
+        if (expecting != "") { expecting = ""; continue }
+        if (word ~ /^-/) { if ((command, word) in kinds && kinds[command, word] == "option") expecting = word; continue }
+        if (command == "." && word in commands) command = word
+    }
+    if (expecting != "") candidates = values[command, expecting]
+    else if (cur ~ /^-/) { for (key in kinds) { split(key, parts, SUBSEP); if (parts[1] == command) candidates = candidates " " parts[2] } }
+    else if (command == ".") { for (name in commands) candidates = candidates " " name }
+    else if (command in positional) candidates = positional[command]
+    n = split(candidates, list, " ")
+    for (i = 1; i <= n; i++) if (index(list[i], cur) == 1) print list[i]
+}
+"""
+
+completion_scripts = {
+    'bash': """_clim_complete_@FUNC@() {
+    local index="${XDG_CACHE_HOME:-$HOME/.cache}/@PROG@/completion.index"
+    [ -r "$index" ] || return 0
+    local IFS=$'\\n'
+    COMPREPLY=($(printf '%s\\n' "${COMP_WORDS[@]:1:COMP_CWORD-1}" | awk -v cur="${COMP_WORDS[COMP_CWORD]}" '@AWK@' - "$index"))
+}
+complete -o default -F _clim_complete_@FUNC@ @PROG@
+""",
+    'zsh': """_clim_complete_@FUNC@() {
+    local index="${XDG_CACHE_HOME:-$HOME/.cache}/@PROG@/completion.index"
+    [[ -r $index ]] || return 1
+    local -a candidates
+    candidates=(${(f)"$(printf '%s\\n' "${(@)words[2,CURRENT-1]}" | awk -v cur="${words[CURRENT]}" '@AWK@' - "$index")"})
+    if (( ${#candidates} )); then
+        compadd -- "${candidates[@]}"
+    else
+        _files
+    fi
+}
+compdef _clim_complete_@FUNC@ @PROG@
+""",
+}
+
+
+class SubparserWrapper(object):
+    """Wrap subparsers so we can prefix argument names with the subcommand.
+    """
+    def __init__(self, cli, submodule, subparser):
+        self.cli = cli
+        self.submodule = submodule
+        self.subparser = subparser
+
+        for attr in dir(subparser):
+            if not hasattr(self, attr):
+                setattr(self, attr, getattr(subparser, attr))
+
+    def add_argument(self, *args, **kwargs):
+        if kwargs.get('add_dest', True):
+            kwargs['dest'] = self.submodule + '_' + self.cli.get_argument_name(*args, **kwargs)
+        if 'add_dest' in kwargs:
+            del(kwargs['add_dest'])
+
+        if 'action' in kwargs and kwargs['action'] == 'store_boolean':
+            return handle_store_boolean(self, *args, **kwargs)
+
+        return add_completer(self.subparser.add_argument, args, kwargs)
+
+
+class CLIM(object):
+    """# CLI Context Manager
+
+    This class wraps some standard python modules in nice ways for CLI tools.
+    It provides a Context Manager that can be used to quickly and easily
+    write tools that behave in the way endusers expect. It's meant to lightly
+    wrap standard python modules with just enough framework to make writing
+    simple scripts simple while allowing you to organically grow into large
+    complex programs with hundreds of options.
+
+    ## Simple Example:
+
+        cli = CLIM('My useful CLI tool.')
+
+        @cli.argument('-n', '--name', help='Name to greet', default='World')
+        @cli.entrypoint
+        def main(cli):
+            cli.log.info('Hello, %s!', cli.config.general.name)
+
+        if __name__ == '__main__':
+            with cli:
+                cli.run()
+
+    # Basics of a CLIM app
+
+    Start by instaniating a CLIM context manager and defining your entrypoint:
+
+        cli = CLIM('My useful CLI tool')
+
+        def main(cli):
+            print('Hello, %s!' % cli.config.general.name)
+
+    From here, you should setup your CLI environment. I typically prefer to
+    do this behind a __main__ check.
+
+        if __name__ == '__main__':
+            cli.entrypoint(main)
+            cli.add_argument('-n', '--name', help='Name to greet', default='World')
+
+    Finally, invoke it as a context manager and use `cli.run()` to dispatch to
+    your entrypoint (or a subcommand, if one has been specified.)
+
+            with cli:
+                cli.run()
+
+    ## Complete CLIM script, using functions
+
+        cli = CLIM('My useful CLI tool')
+
+        def main(cli):
+            print('Hello, %s!' % cli.config.general.name)
+
+        if __name__ == '__main__':
+            cli.entrypoint(main)
+            cli.add_argument('-n', '--name', help='Name to greet', default='World')
+
+            with cli:
+                cli.run()
+
+    # Using decorators instead
+
+    If you prefer you can use decorators instead. This can help as your program
+    grows by keeping the definition of arguments near the relevant entrypoint.
+    Not that due to the way decorators are evaluated you need to place all
+    `@cli.argument()` decorators above all other decorators.
+
+        cli = CLIM('My useful CLI tool')
+
+        @cli.argument('-n', '--name', help='Name to greet', default='World')
+        @cli.entrypoint
+        def main(cli):
+            print('Hello, %s!' % cli.config.general.name)
+
+        if __name__ == '__main__':
+            with cli:
+                cli.run()
+
+    # Using Subcommands
+
+    A command pattern for CLI tools is to have subcommands. For example,
+    you see this in git with `git status` and `git pull`. CLIM supports
+    this pattern using the built-in argparse subcommand functionality.
+
+    You can register subcommands by using the `cli.subcommand(func)`
+    function, or by decorating functions with `@cli.subcommand`. In
+    either case the subcommand name will be the same as the name of the
+    function.
+
+    You can access the underlying subcommand instance in two ways-
+
+        * Attribute access (`cli.<subcommand>`)
+        * Dictionary access (`cli.subcommands['<subcommand>']`)
+
+    You should generally prefer the attribute access. If there is a conflict
+    with an existing attribute or the name is not a legal attribute name you
+    will have to access it via the dictionary.
+
+    When subcommands are not in use `cli.run()` will always be the same as
+    `cli.entrypoint()`. When subcommands are in use `cli.run()` will be
+    pointed to the proper command to run. If no valid subcommand is given on
+    the command line it will point to `cli.entrypoint()`. If a valid
+    subcommand is supplied it will point to `<subcommand>()`.
+
+    Note: Python 2 does not support calling @cli.entrypoint when subcommands
+    are in use. If you need to call @cli.entrypoint when a subcommand is not
+    specified you will need to use python 3.
+
+    ## Subcommand Example
+
+        cli = CLIM('My useful CLI tool with subcommands.')
+
+        @cli.argument('-c', '--comma', help='Include the comma in output', default=True, action='store_true')
+        @cli.entrypoint
+        def main(cli):
+            cli.log.info('Hello%s World!', cli.config.general.comma)
+
+        @cli.argument('-n', '--name', help='Name to greet', default='World')
+        @cli.subcommand
+        def hello(cli):
+            '''Description of hello subcommand here.'''
+            cli.log.info('Hello%s %s!', cli.config.general.comma, cli.config.hello.name)
+
+        def goodbye(cli):
+            '''This will show up in --help output.'''
+            cli.log.info('Goodbye%s %s!', cli.config.general.comma, cli.config.goodbye.name)
+
+        if __name__ == '__main__':
+            # You can register subcommands using decorators as seen above,
+            # or using functions like like this:
+            cli.subcommand(goodbye)
+            cli.goodbye.add_argument('-n', '--name', help='Name to bid farewell to', default='World')
+
+            with cli:
+                cli.config.general.comma = ',' if cli.config.general.comma else ''
+                cli.run()  # Automatically picks between main(), hello() and goodbye()
+
+    ## Lazy Subcommands
+
+    As your program grows importing every subcommand on every run gets
+    expensive. Subcommands that live in their own module can be registered
+    by dotted path instead, and will only be imported when they are run:
+
+        # mytool/hello.py
+        from clim import argument
+
+        @argument('-n', '--name', help='Name to greet', default='World')
+        def hello(cli):
+            '''Say hello.'''
+            cli.log.info('Hello, %s!', cli.config.hello.name)
+
+        # mytool/__main__.py
+        cli.lazy_subcommand('mytool.hello')  # or 'mytool.hello:hello'
+
+    The help text and arguments for lazy subcommands are cached in a
+    manifest under `~/.cache/<prog_name>/` that is rebuilt when any of the
+    modules change.
+
+    ## Warm Server
+
+    Every run of a CLIM program pays for starting python, importing
+    modules, building the argument parsers and reading config files. If you
+    run your program thousands of times from a build script you can start a
+    long lived server instead:
+
+        mytool --serve /tmp/mytool.sock
+
+    Then forward each invocation to it with `clim_client.run_client()`,
+    which returns None if the server isn't running. `clim_client` only
+    imports a few small standard modules, so do this before importing the
+    rest of your program:
+
+        exit_code = run_client('/tmp/mytool.sock')
+        if exit_code is None:
+            with cli:
+                cli.run()
+        else:
+            exit(exit_code)
+
+    The server forks a child for every request, so each run gets its own
+    config and logging while sharing everything that was already imported.
+    Restart the server when your code changes. A socket left behind by a
+    server that is no longer running is replaced, but the server refuses
+    to start if another one is listening or the path isn't a socket.
+
+    ## Async Entrypoints
+
+    Entrypoints and subcommands can be coroutine functions. CLIM runs them
+    on an event loop it manages (`cli.event_loop`), writes log records from
+    a background thread while they run, cancels them on Ctrl-C and closes
+    the loop when the context manager exits:
+
+        @cli.subcommand
+        async def probe(cli):
+            '''Probe every attached keyboard.'''
+            async with cli.spinner(text='Probing...'):
+                results = await asyncio.gather(*[probe_device(device) for device in devices])
+
+    ## Result Cache
+
+    Subcommands that only depend on their config and input files can have
+    their results cached. On a hit the log output, anything printed to
+    stdout and any artifacts from the original run are replayed instead of
+    running the subcommand again:
+
+        @cli.subcommand
+        @cli.cached(files=['keyboards/planck/**'], artifacts=['planck.hex'], version=1)
+        def compile(cli):
+            '''Compile the firmware.'''
+
+    Results are stored under `~/.cache/<prog_name>/results/`, up to
+    `--cache-size` MiB. Pass `--no-cache` to skip the cache, and use the
+    `cache-stats` and `cache-purge` subcommands to inspect or empty it.
+
+    ## Watch Mode
+
+    Pass `--watch PATH` (as many times as you like) to keep the program
+    running and run the entrypoint again every time a file under one of
+    the paths changes. The paths that changed are in `cli.changed_paths`:
+
+        @cli.subcommand
+        def compile(cli):
+            for path in cli.changed_paths or all_sources():
+                compile_file(path)
+
+    inotify is used on Linux, other systems check file mtimes every
+    `--watch-interval` seconds.
+
+    ## Config Options
+
+    Every argument is also a config option, named `<section>.<option>`
+    where the section is `general` or the subcommand. Values from config
+    files and the environment are converted using the argument's `type`,
+    or the type of its `default`, and checked against its `choices`.
+    `store_true`, `store_false` and `store_boolean` options accept
+    yes/no, true/false, on/off and 1/0.
+
+    Options that only exist in config files can be declared so they get
+    the same treatment:
+
+        cli.config_option('user', 'keyboard')
+        cli.config_option('compile', 'jobs', type=int, default=1)
+
+    Options that aren't declared are kept as strings, and unknown options
+    or values that can't be converted are logged as warnings.
+
+    `cli.config` can be read from any thread without locking. Changes
+    publish a new immutable snapshot of the config, and
+    `cli.config.snapshot()` returns the current one for workers that need
+    a config that won't change while they run:
+
+        config = cli.config.snapshot()
+        results = pool.map(lambda target: build(target, config.compile.jobs), targets)
+
+    # More Docs!
+
+    Details about the rest of the system can be found in the [docs/](docs/) directory.
+    """
+    def __init__(self, description, entrypoint=None, fromfile_prefix_chars='@', conflict_handler='resolve', **kwargs):
+        kwargs['fromfile_prefix_chars'] = fromfile_prefix_chars
+        kwargs['conflict_handler'] = conflict_handler
+
+        # Setup a lock for thread safety and hold it until initialization is complete
+        self._lock = threading.RLock() if thread else None
+        self.acquire_lock()
+
+        # Define some basic info
+        self._entrypoint = entrypoint
+        self._inside_context_manager = False
+        self._subparsers = None
+        self._lazy_subcommands = OrderedDict()
+        self._timer_depth = threading.local() if thread else None
+        self.timings = []
+        self.start_time = perf_counter()
+        self.metrics = MetricsRegistry()
+        self.args = None
+        self.config = Configuration()
+        self.config_file = None
+        self.config_schema = None
+        self.config_problems = []
+        self._config_options = []
+        self._unsaved_options = set()
+        self._subcommand_manifest = {}
+        self.prog_name = sys.argv[0][:-3] if sys.argv[0].endswith('.py') else sys.argv[0]
+        self.subcommands = {}
+        self.changed_paths = None
+        self.completion_index_max_age = 24 * 60 * 60
+        self._spinner = None
+        self._progress = None
+        self._command_slots = None
+        self._result_cache = None
+        self._event_loop = None
+        self.version = 'unknown'
+
+        # Initialize all the things
+        self.initialize_argparse(description, kwargs)
+        self.initialize_logging()
+
+        # Release the lock
+        self.release_lock()
+
+    @property
+    def ansi(self):
+        """A dictionary of ANSI color names to escape codes.
+        """
+        return load_ansi_colors()
+
+    @property
+    def progress(self):
+        """The `ProgressRenderer` that draws spinners and progress bars for this program.
+
+        It is created the first time this is used.
+        """
+        if not self._progress:
+            self._progress = ProgressRenderer(
+                self.log_print_to,
+                fps=float(self.config.general.progress_fps or 10),
+                status_interval=float(self.config.general.progress_interval or 5),
+            )
+
+            if isinstance(self.log_print_handler, LiveStreamHandler):
+                self.log_print_handler.renderer = self._progress
+
+        return self._progress
+
+    @property
+    def event_loop(self):
+        """The asyncio event loop that coroutine entrypoints and subcommands run on.
+
+        It is created the first time this is used and closed by `__exit__`.
+        """
+        if not self._event_loop:
+            import asyncio
+
+            self._event_loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._event_loop)
+
+        return self._event_loop
+
+    @property
+    def result_cache(self):
+        """The `ResultCache` used by subcommands decorated with `cached()`.
+
+        It lives in `results/` inside the cache directory and holds up to
+        --cache-size MiB.
+        """
+        if not self._result_cache:
+            max_size = int(self.config.general.cache_size or 512) * 2**20
+            self._result_cache = ResultCache(os.path.join(self.find_cache_dir(), 'results'), max_size)
+
+        return self._result_cache
+
+    @property
+    def spinner(self):
+        """The spinner class, `self.progress.spinner` unless you have set your own.
+
+        Set this to `halo.Halo` to use halo spinners instead.
+        """
+        if not self._spinner:
+            return self.progress.spinner
+
+        return self._spinner
+
+    @spinner.setter
+    def spinner(self, spinner):
+        self._spinner = spinner
+
+    def initialize_argparse(self, description, kwargs):
+        """Prepare to process arguments from sys.argv.
+        """
+        self._arg_parser = CLIMArgumentParser(description=description, **kwargs)
+        self.set_defaults = self._arg_parser.set_defaults
+        self.print_usage = self._arg_parser.print_usage
+        self.print_help = self._arg_parser.print_help
+
+    def add_argument(self, *args, **kwargs):
+        """Wrapper to add arguments to the main argparser.
+
+        Pass `save=False` for options that pick how this run works rather
+        than configure the program, so `save_config()` leaves them out.
+        """
+        if not kwargs.pop('save', True):
+            self._unsaved_options.add(self.get_argument_name(*args, **kwargs))
+
+        if kwargs.get('add_dest', True):
+            kwargs['dest'] = 'general_' + self.get_argument_name(*args, **kwargs)
+        if 'add_dest' in kwargs:
+            del(kwargs['add_dest'])
+
+        if 'action' in kwargs and kwargs['action'] == 'store_boolean':
+            return handle_store_boolean(self, *args, **kwargs)
+
+        return add_completer(self._arg_parser.add_argument, args, kwargs)
+
+    def initialize_logging(self):
+        """Prepare the defaults for the logging infrastructure.
+        """
+        self.log_file = None
+        self.log_file_mode = 'a'
+        self.log_file_handler = None
+        self.log_queue_handler = None
+        self.log_filter = None
+        self.log_print = True
+        self.log_print_to = sys.stderr
+        self.log_print_handler = None
+        self.log_print_level = logging.INFO
+        self.log_file_level = logging.DEBUG
+        self.log_level = logging.INFO
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.log.setLevel(logging.DEBUG)
+        logging.root.setLevel(logging.DEBUG)
+        self.add_argument('-V', '--version', version=self.version, action='version', help='Display the version and exit')
+        self.add_argument('-v', '--verbose', action='store_true', help='Make the logging more verbose')
+        self.add_argument('--datetime-fmt', default='%Y-%m-%d %H:%M:%S', help='Format string for datetimes')
+        self.add_argument('--log-fmt', default='%(levelname)s %(message)s', help='Format string for printed log output')
+        self.add_argument('--log-file-fmt', default='[%(levelname)s] [%(asctime)s] [file:%(pathname)s] [line:%(lineno)d] %(message)s', help='Format string for log file.')
+        self.add_argument('--log-file', help='File to write log messages to')
+        self.add_argument('--log-format', choices=('text', 'json'), default='text', help='Write log messages as text or as one JSON object per line')
+        self.add_argument('--log-dedup-window', type=float, default=0, help='Collapse identical log messages repeated within this many seconds')
+        self.add_argument('--log-rate-limit', type=float, default=0, help='Maximum log messages per second from each logger and level, 0 for no limit')
+        self.add_argument('--log-rate-burst', type=int, default=10, help='Log messages allowed in a burst before --log-rate-limit applies')
+        self.add_argument('--log-async', action='store_boolean', default=False, help='writing log messages from a background thread')
+        self.add_argument('--log-queue-size', type=int, default=10000, help='Maximum number of log records waiting to be written in async mode')
+        self.add_argument('--log-flush-interval', type=float, default=0.1, help='Seconds to collect log records before writing them in async mode')
+        self.add_argument('--log-queue-policy', choices=AsyncLogHandler.policies, default='block', help='What to do when the async log queue is full')
+        self.add_argument('--progress-fps', type=float, default=10, help='Maximum times per second to redraw spinners and progress bars')
+        self.add_argument('--progress-interval', type=float, default=5, help='Seconds between progress status lines when not writing to a terminal')
+        self.add_argument('--color', action='store_boolean', default=True, help='color in output')
+        self.add_argument('-c', '--config-file', help='The config file to read and/or write')
+        self.add_argument('--save-config', action='store_true', save=False, help='Save the running configuration to the config file')
+        self.add_argument('--timings', action='store_true', help='Log how long each phase of the run took')
+        self.add_argument('--timings-file', metavar='FILE', save=False, help='Write the timings for this run to FILE as JSON')
+        self.add_argument('--profile', metavar='FILE', save=False, help='Run the command under cProfile and write the stats to FILE')
+        self.add_argument('--metrics-file', metavar='FILE', save=False, help='Write the metrics for this run to FILE')
+        self.add_argument('--metrics-format', choices=MetricsRegistry.formats, default='json', help='Format for --metrics-file')
+        self.add_argument('--cache', action='store_boolean', default=True, help='the result cache for subcommands that support it')
+        self.add_argument('--cache-size', type=int, default=512, help='Maximum size of the result cache in MiB')
+        self.add_argument('-j', '--jobs', type=int, default=0, help='Number of jobs cli.parallel() and commands cli.run_command() runs at once, 0 for one per CPU')
+        self.add_argument('--watch', metavar='PATH', action='append', save=False, help='Run again whenever a file under PATH changes. Can be given more than once')
+        self.add_argument('--watch-debounce', type=float, default=0.2, help='Seconds to wait for changes to settle before running again')
+        self.add_argument('--watch-interval', type=float, default=0.5, help='Seconds between checks when inotify is not available')
+        self.add_argument('--completion', choices=sorted(completion_scripts), save=False, help='Print a script that adds tab completion to bash or zsh, then exit')
+        self.add_argument('--batch', metavar='FILE', save=False, help='Run the command on each line of FILE (or - for stdin) in this process')
+        self.add_argument('--serve', metavar='SOCKET', save=False, help='Run as a warm server, running the commands sent to SOCKET by clim_client')
+
+    def find_cache_dir(self):
+        """Locate the directory where we keep cached data.
+        """
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+
+        return os.path.join(cache_home, os.path.basename(self.prog_name))
+
+    def read_cache_file(self, filename):
+        """Returns the contents of filename inside the cache directory, or None if it can't be read.
+        """
+        try:
+            with open(os.path.join(self.find_cache_dir(), filename), 'rb') as fd:
+                return fd.read()
+
+        except (IOError, OSError):
+            return None
+
+    def write_cache_file(self, filename, data):
+        """Atomically write data to filename inside the cache directory.
+
+        Failing to write a cache is not fatal, it will be logged and False will be returned.
+        """
+        cache_dir = self.find_cache_dir()
+
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            from tempfile import NamedTemporaryFile
+
+            with NamedTemporaryFile(mode='wb', dir=cache_dir, delete=False) as tmpfile:
+                tmpfile.write(data)
+
+            os.rename(tmpfile.name, os.path.join(cache_dir, filename))
+
+        except (IOError, OSError) as e:
+            self.log.debug('Could not write cache file %s: %s', filename, e)
+            return False
+
+        return True
+
+    def add_subparsers(self, title='Sub-commands', **kwargs):
+        if self._inside_context_manager:
+            raise RuntimeError('You must run this before the with statement!')
+
+        kwargs.setdefault('parser_class', CLIMArgumentParser)
+
+        self.acquire_lock()
+        self._subparsers = self._arg_parser.add_subparsers(title=title, dest='subparsers', **kwargs)
+        self.release_lock()
+
+    def acquire_lock(self):
+        """Acquire the CLIM lock for exclusive access to properties.
+        """
+        if self._lock:
+            self._lock.acquire()
+
+    def release_lock(self):
+        """Release the CLIM lock.
+        """
+        if self._lock:
+            self._lock.release()
+
+    def find_config_file(self):
+        """Locate the config file.
+        """
+        if self.config_file:
+            return self.config_file
+
+        if self.args and self.args.general_config_file:
+            return self.args.general_config_file
+
+        return os.path.abspath(os.path.expanduser('~/.%s.ini' % os.path.basename(self.prog_name)))
+
+    def find_config_layer_file(self, layer):
+        """Locate the config file for the system, user or project layer.
+        """
+        filename = '.%s.ini' % os.path.basename(self.prog_name)
+
+        if layer == 'system':
+            return os.path.join('/etc', filename[1:])
+
+        if layer == 'user':
+            return self.find_config_file()
+
+        if layer == 'project':
+            user_config = self.find_config_file()
+            directory = os.getcwd()
+
+            while True:
+                config_file = os.path.join(directory, filename)
+                if config_file != user_config and os.path.exists(config_file):
+                    return config_file
+
+                parent = os.path.dirname(directory)
+                if parent == directory:
+                    return None
+
+                directory = parent
+
+    def get_argument_name(self, *args, **kwargs):
+        """Takes argparse arguments and returns the dest name.
+        """
+        return self._arg_parser._get_optional_kwargs(*args, **kwargs)['dest']
+
+    def argument(self, *args, **kwargs):
+        """Decorator to call self.add_argument or self.<subcommand>.add_argument.
+        """
+        if self._inside_context_manager:
+            raise RuntimeError('You must run this before the with statement!')
+
+        def argument_function(handler):
+            if handler is self._entrypoint:
+                self.add_argument(*args, **kwargs)
+
+            elif handler.__name__ in self.subcommands:
+                self.subcommands[handler.__name__].add_argument(*args, **kwargs)
+
+            else:
+                raise RuntimeError('Decorated function is not entrypoint or subcommand!')
+
+            return handler
+
+        return argument_function
+
+    def arg_passed(self, arg):
+        """Returns True if arg was passed on the command line.
+        """
+        return hasattr(self.args_passed, arg)
+
+    def parse_args(self):
+        """Parse the CLI args.
+        """
+        if self.args:
+            self.log.debug('Warning: Arguments have already been parsed, ignoring duplicate attempt!')
+            return
 
-        # Setup a lock for thread safety and hold it until initialization is complete
-        self._lock = threading.RLock() if thread else None
         self.acquire_lock()
 
-        # Define some basic info
-        self._entrypoint = entrypoint
-        self._inside_context_manager = False
-        self._subparsers = None
-        self._subparsers_default = None
-        self.args = None
-        self.ansi = ansi_colors
-        self.config = Configuration()
-        self.config_file = None
-        self.prog_name = sys.argv[0][:-3] if sys.argv[0].endswith('.py') else sys.argv[0]
-        self.subcommands = {}
-        self.subcommands_default = {}
-        self.spinner = halo.Halo
-        self.version = 'unknown'
+        self.args, self.args_passed = self.parse_argv()
 
-        # Initialize all the things
-        self.initialize_argparse(description, kwargs)
-        self.initialize_logging()
+        if 'entrypoint' in self.args:
+            self._entrypoint = self.args.entrypoint
+
+        if self.args.general_config_file:
+            self.config_file = self.args.general_config_file
+
+        self.release_lock()
+
+    def parse_argv(self, argv=None):
+        """Parse argv (default: sys.argv) without changing our state.
+
+        Returns a tuple of (args, args_passed), where args_passed only
+        contains the arguments that were actually given.
+        """
+        args = self._arg_parser.parse_args(argv)
+
+        # Record the arguments that were actually given on the command line
+        passed = self._arg_parser.passed_args()
+        if args.__dict__.get('subparsers') in self.subcommands:
+            passed.update(self.subcommands[args.subparsers].subparser.passed_args())
+
+        return args, argparse.Namespace(**dict((arg, getattr(args, arg)) for arg in passed if hasattr(args, arg)))
+
+    def args_to_config_layers(self, args, args_passed):
+        """Sort parsed arguments into the defaults and cli configuration layers.
+        """
+        defaults = {}
+        passed = {}
+
+        for argument in vars(args):
+            if argument in ('subparsers', 'entrypoint'):
+                continue
+
+            if '_' not in argument:
+                continue
+
+            section, option = argument.split('_', 1)
+            layer = passed if hasattr(args_passed, argument) else defaults
+            layer.setdefault(section, {})[option] = getattr(args, argument)
+
+        return defaults, passed
+
+    def config_option(self, section, option, type=None, default=None, choices=None):
+        """Declare a config option that doesn't have an argument.
+
+        The value will be converted with `type` (or the type of `default`)
+        and checked against `choices`, just like an argument. If `default` is
+        not None it is put in the defaults layer.
+        """
+        self.acquire_lock()
+        self._config_options.append((section, option, type, default, choices))
+        self.config_schema = None
+        self.release_lock()
+
+    def build_config_schema(self):
+        """Returns a ConfigSchema for every argument and `config_option()`.
+
+        Lazy subcommands that haven't been built are read from the
+        subcommand manifest so we don't have to import them.
+        """
+        schema = ConfigSchema()
+
+        for command, parser in self.completion_parsers():
+            if getattr(parser, 'populate', None) and command in self._subcommand_manifest:
+                # Reading config for a subcommand that isn't running shouldn't import it, so types from
+                # modules that haven't been imported are left out and the type of the default is used.
+                arguments = []
+                for args, kwargs, callables in self._subcommand_manifest[command]['arguments']:
+                    imported = dict((key, path) for key, path in callables.items() if path.split(':', 1)[0] in sys.modules)
+                    arguments.append((args, argument_kwargs(kwargs, imported)))
+
+                schema.add_arguments(command, arguments, self.get_argument_name)
+            else:
+                for action in parser._actions:
+                    schema.add_action(action)
+
+        for section, option, type, default, choices in self._config_options:
+            schema.add(section, option, type, default, choices)
+
+        return schema
+
+    def report_config_problems(self):
+        """Log the problems found while converting config values.
+
+        This is called once logging has been setup, config is read before that.
+        """
+        self.acquire_lock()
+        problems, self.config_problems = self.config_problems, []
+        self.release_lock()
+
+        for problem in problems:
+            self.log.warning(*problem)
+
+    def read_config(self):
+        """Parse the configuration file and determine the runtime configuration.
+        """
+        self.acquire_lock()
+        self.config_file = self.find_config_file()
+        self.config_schema = self.build_config_schema()
+        self.config_problems = []
+
+        defaults, passed = self.args_to_config_layers(self.args, self.args_passed)
+
+        for section, option, type, default, choices in self._config_options:
+            if default is not None:
+                defaults.setdefault(section, {}).setdefault(option, default)
+
+        self.config.set_layer('defaults', defaults)
+        self.config.set_layer('cli', passed)
+
+        for layer in ('system', 'user', 'project', 'env'):
+            self.reload_config_layer(layer)
+
+        self.release_lock()
+
+    def read_config_env(self):
+        """Returns the config options set in the environment.
+
+        Options are read from variables named `<PROG_NAME>_<SECTION>_<OPTION>`.
+        """
+        prefix = re.sub(r'\W', '_', os.path.basename(self.prog_name)).upper() + '_'
+        config = {}
+
+        for key, value in os.environ.items():
+            if key.startswith(prefix) and '_' in key[len(prefix):]:
+                section, option = key[len(prefix):].lower().split('_', 1)
+                config.setdefault(section, {})[option] = value
+
+        # Other programs use our prefix too, so unknown variables are not worth a warning
+        config, unknown, invalid = self.convert_config(config)
+
+        for section, option in unknown:
+            self.log.debug('Ignoring type of unknown option %s.%s from the environment.', section, option)
+
+        for section, option, value, error in invalid:
+            self.config_problems.append(('Invalid value for %s.%s in the environment: %s', section, option, error))
+
+        return config
+
+    def reload_config_layer(self, layer):
+        """Re-read a single configuration layer from its source.
+
+        The new layer is published in one step, readers see either the old
+        layer or the new one.
+        """
+        if layer == 'env':
+            self.config.set_layer('env', self.read_config_env(), 'environment')
+        else:
+            config_file = self.find_config_layer_file(layer)
+
+            if config_file and os.path.exists(config_file):
+                self.config.set_layer(layer, self.load_config_file(config_file), config_file)
+            else:
+                self.config.set_layer(layer, {})
+
+    def parse_config_file(self, config_file):
+        """Parse an INI file and return a dictionary of sections with string values.
+        """
+        config = RawConfigParser()
+        config.read(config_file)
+
+        return dict((section, dict(config.items(section))) for section in config.sections())
+
+    def convert_config(self, config):
+        """Convert a dictionary of sections of strings using the config schema.
+
+        Returns (converted, unknown, invalid), see `ConfigSchema.convert()`.
+        """
+        if not self.config_schema:
+            self.config_schema = self.build_config_schema()
+
+        return self.config_schema.convert(config)
+
+    def load_config_file(self, config_file):
+        """Returns the converted contents of config_file.
+
+        The parsed strings are cached, keyed on the path and
+        `file_signature()` of the config file. If the cache is missing, stale or unreadable we
+        parse the INI file and write a new cache. The converted values are
+        cached too, along with the `ConfigSchema.fingerprint()` they were
+        converted with, and are only used when our schema has the same
+        fingerprint. Unknown options and invalid values are added to
+        `config_problems`.
+        """
+        stat = os.stat(config_file)
+        key = (CONFIG_CACHE_VERSION, os.path.abspath(config_file)) + file_signature(stat)
+        cache_file = 'config-%s.cache' % hashlib.sha1(key[1].encode('utf-8')).hexdigest()
+        cached = self.read_cache_file(cache_file)
+        config = converted = None
+
+        if not self.config_schema:
+            self.config_schema = self.build_config_schema()
+
+        fingerprint = self.config_schema.fingerprint()
+
+        if cached:
+            try:
+                cached = pickle.loads(cached)
+                if cached['key'] == key:
+                    config = cached['config']
+
+                    if cached['fingerprint'] == fingerprint:
+                        converted = cached['converted']
+
+            except Exception as e:
+                self.log.debug('Could not use config cache %s: %s', cache_file, e)
+
+        if converted is None:
+            if config is None:
+                config = self.parse_config_file(config_file)
+
+            converted = self.convert_config(config)
+
+            # Loading anything but plain data could import modules, or fail in a process that doesn't have them
+            plain = is_plain_data(converted)
+            self.write_cache_file(cache_file, pickle.dumps({'key': key, 'config': config, 'fingerprint': fingerprint if plain else None, 'converted': converted if plain else None}, 2))
+
+        config, unknown, invalid = converted
+
+        for section, option in unknown:
+            self.config_problems.append(('Unknown option %s.%s in %s', section, option, config_file))
+
+        for section, option, value, error in invalid:
+            self.config_problems.append(('Invalid value for %s.%s in %s: %s', section, option, config_file, error))
+
+        return config
+
+    def save_config(self):
+        """Save changes to the configuration to the config file.
+
+        Only options set on the command line or while running are saved,
+        except those added with `save=False` such as --batch or --serve, and
+        only when their value differs from what the config file held when we
+        read it (or from the default, if the file didn't have them). They
+        are merged into the file as it is on disk now, under an advisory
+        lock, so processes saving at the same time don't lose each other's
+        changes. Nothing is written when the file would not change, and new
+        files are fsynced along with their directory.
+        """
+        self.log.debug("Saving config file to '%s'", self.config_file)
+
+        if not self.config_file:
+            self.log.warning('%s.config_file file not set, not saving config!', self.__class__.__name__)
+            return
+
+        # Values from the system and project config files or the environment
+        # belong to those sources, not to the user's config file.
+        snapshot = self.config.snapshot()
+        saved = snapshot.get_layer('user')
+        defaults = snapshot.get_layer('defaults')
+        changes = []
+        for section_name, section in snapshot.merged(('cli', 'runtime')).items():
+            for option_name, value in section.items():
+                if section_name == 'general' and option_name in self._unsaved_options:
+                    continue
+
+                # Untouched defaults are left out, so we never write over another process's changes with them
+                if option_name in saved.get(section_name, {}):
+                    original = saved[section_name]
+                elif option_name in defaults.get(section_name, {}):
+                    original = defaults[section_name]
+                else:
+                    original = {}
+
+                if option_name not in original or str(original[option_name]) != str(value):
+                    changes.append((section_name, option_name, value))
+
+        if changes:
+            with self.config_file_lock():
+                self.write_config_changes(changes)
+        else:
+            self.log.debug('No config changes to save.')
+
+    @contextmanager
+    def config_file_lock(self):
+        """Hold an advisory lock on `<config_file>.lock` while the body runs.
+
+        Where fcntl isn't available this does nothing.
+        """
+        config_dir = os.path.dirname(os.path.abspath(self.config_file))
+
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir)
+
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+
+        with open(self.config_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def write_config_changes(self, changes):
+        """Apply a list of (section, option, value) changes to the config file as it is on disk now.
+
+        Call this with `config_file_lock()` held. Returns True if the file was written.
+        """
+        from tempfile import NamedTemporaryFile
+
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+
+        config = RawConfigParser()
+        current = ''
+
+        if os.path.exists(self.config_file):
+            with open(self.config_file) as fd:
+                current = fd.read()
+
+            read_file = getattr(config, 'read_file', None) or config.readfp
+            read_file(StringIO(current), self.config_file)
+
+        for section_name, option_name, value in changes:
+            if not config.has_section(section_name):
+                config.add_section(section_name)
+            config.set(section_name, option_name, str(value))
+
+        new = StringIO()
+        config.write(new)
+        new = new.getvalue()
+
+        if new == current:
+            self.log.debug('%s is already up to date.', self.config_file)
+            return False
+
+        if not new:
+            self.log.warning('Config file saving failed, not replacing %s with an empty file.', self.config_file)
+            return False
+
+        config_dir = os.path.dirname(os.path.abspath(self.config_file))
+
+        with NamedTemporaryFile(mode='w', dir=config_dir, delete=False) as tmpfile:
+            tmpfile.write(new)
+            tmpfile.flush()
+            os.fsync(tmpfile.fileno())
+
+        # Move the new config file into place atomically, then make sure the rename is on disk too
+        os.rename(tmpfile.name, self.config_file)
+
+        try:
+            dir_fd = os.open(config_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass  # Windows can't open or fsync directories
+
+        # What we wrote is now what the user's config file holds
+        user = dict((section, dict(options)) for section, options in self.config.get_layer('user').items())
+        for section_name, option_name, value in changes:
+            user.setdefault(section_name, {})[option_name] = value
+        self.config.set_layer('user', user, self.config_file)
+
+        return True
+
+    def run(self):
+        """Execute the entrypoint function.
+        """
+        if not self._inside_context_manager:
+            self.__enter__()
+            self.log.debug('Warning: self.run() called outside of context manager. This will preclude calling self.__exit__().')
+
+        if self.config.general.completion:
+            self.update_completion_index(force=True)
+            print(self.completion_script(self.config.general.completion))
+            return
+
+        if self.config.general.serve:
+            return self.serve(self.config.general.serve)
+
+        if not self._entrypoint:
+            raise RuntimeError('No entrypoint provided!')
+
+        if self.config.general.watch:
+            return self.watch(self.config.general.watch)
+
+        with self.timer('run'):
+            if self.config.general.profile:
+                import cProfile
+
+                profiler = cProfile.Profile()
+                try:
+                    return profiler.runcall(self.dispatch)
+                finally:
+                    profiler.dump_stats(self.config.general.profile)
+                    self.log.debug('Wrote profile stats to %s', self.config.general.profile)
+
+            return self.dispatch()
+
+    def watch(self, paths):
+        """Run the entrypoint, then run it again whenever something under paths changes, until interrupted.
+
+        Changes are collected until none have happened for --watch-debounce
+        seconds. Before each rerun `cli.changed_paths` is set to the sorted
+        list of paths that changed, so the entrypoint can do incremental
+        work. It is None on the first run. Logging and config are not set up
+        again between runs.
+        """
+        if not isinstance(paths, (list, tuple)):
+            paths = [path.strip() for path in paths.split(',')]
+
+        debounce = float(self.config.general.watch_debounce or 0)
+        watcher = file_watcher(paths, float(self.config.general.watch_interval or 0.5))
+        self.changed_paths = None
+        self.log.debug('Watching %s with %s', ', '.join(paths), watcher.__class__.__name__)
+
+        try:
+            while True:
+                try:
+                    with self.timer('run'):
+                        self.dispatch()
+
+                except SystemExit as e:
+                    self.log.debug('Entrypoint exited with %s', e.code)
+
+                except Exception as e:
+                    self.log.exception(e)
+
+                self.log.info('Watching %s for changes. Press Ctrl-C to stop.', ', '.join(paths))
+                changed = watcher.wait()
+
+                while True:
+                    more = watcher.wait(debounce)
+                    if not more:
+                        break
+                    changed.update(more)
+
+                self.changed_paths = sorted(changed)
+                self.log.debug('Changed: %s', ', '.join(self.changed_paths))
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            watcher.close()
+
+    def dispatch(self):
+        """Call the entrypoint, or run the batch file if --batch was given.
+        """
+        if self.config.general.batch:
+            results = self.run_batch(self.config.general.batch)
+            if any(exit_code for line_number, argv, exit_code in results):
+                exit(1)
+
+            return results
+
+        return self.call_entrypoint()
+
+    def call_entrypoint(self):
+        """Call the entrypoint, through the result cache if it was decorated with `cached()`.
+        """
+        handler = self._entrypoint.load() if isinstance(self._entrypoint, LazyHandler) else self._entrypoint
+        options = getattr(handler, '_clim_cache', None)
+
+        if options is None or not self.config.general.cache:
+            return self.call_handler(handler)
+
+        return self.run_cached(handler, options)
+
+    def call_handler(self, handler):
+        """Call handler(cli). When it is a coroutine function it is run to completion on `cli.event_loop`.
+        """
+        result = handler(self)
+
+        if hasattr(result, '__await__'):
+            return self.run_coroutine(result)
+
+        return result
+
+    def run_coroutine(self, coroutine):
+        """Run coroutine on `cli.event_loop` and return its result.
+
+        Log records are written from a background thread while it runs (see
+        `async_logging()`) so logging never blocks the loop. Ctrl-C cancels
+        the coroutine, giving it a chance to clean up, and then raises
+        KeyboardInterrupt.
+        """
+        import asyncio
+        import signal
+
+        loop = self.event_loop
+        task = asyncio.ensure_future(coroutine, loop=loop)
+        interrupted = []
+
+        def interrupt():
+            interrupted.append(True)
+            task.cancel()
+
+        try:
+            loop.add_signal_handler(signal.SIGINT, interrupt)
+            signal_handler = True
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Windows, or we aren't in the main thread
+            signal_handler = False
+
+        try:
+            with self.async_logging():
+                try:
+                    result = loop.run_until_complete(task)
+
+                except KeyboardInterrupt:
+                    interrupt()
+                    loop.run_until_complete(asyncio.wait([task]))
+                    if not task.cancelled():
+                        task.exception()
+
+                except asyncio.CancelledError:
+                    if not interrupted:
+                        raise
+
+        finally:
+            if signal_handler:
+                loop.remove_signal_handler(signal.SIGINT)
+
+        if interrupted:
+            raise KeyboardInterrupt
+
+        return result
+
+    @contextmanager
+    def async_logging(self):
+        """Hand log records to an `AsyncLogHandler` while the body runs, unless --log-async already does.
+        """
+        if self.log_queue_handler or not logging.root.handlers or not thread:
+            yield
+            return
+
+        handlers = logging.root.handlers[:]
+        self.log_queue_handler = AsyncLogHandler(
+            handlers,
+            maxsize=int(self.config.general.log_queue_size),
+            flush_interval=float(self.config.general.log_flush_interval),
+            policy=self.config.general.log_queue_policy,
+        )
+        logging.root.handlers = [self.log_queue_handler]
+
+        try:
+            yield
+
+        finally:
+            logging.root.handlers = handlers
+            self.log_queue_handler.stop()
+            self.log_queue_handler = None
+
+    def close_event_loop(self):
+        """Cancel anything still running on `cli.event_loop`, then close it.
+        """
+        if not self._event_loop:
+            return
+
+        import asyncio
+
+        loop, self._event_loop = self._event_loop, None
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+
+        try:
+            tasks = [task for task in all_tasks(loop) if not task.done()]
+            for task in tasks:
+                task.cancel()
+
+            if tasks:
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+            loop.run_until_complete(loop.shutdown_asyncgens())
+
+            if hasattr(loop, 'shutdown_default_executor'):
+                loop.run_until_complete(loop.shutdown_default_executor())
+
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def find_cache_files(self, files):
+        """Returns the sorted list of files matching `files`, a list of paths and glob patterns or a function that returns one.
+        """
+        from glob import glob
+
+        if callable(files):
+            files = files(self)
+
+        found = set()
 
-        # Release the lock
-        self.release_lock()
+        for pattern in files or ():
+            for path in glob(pattern) or [pattern]:
+                if os.path.isdir(path):
+                    for directory, subdirectories, filenames in os.walk(path):
+                        found.update(os.path.join(directory, filename) for filename in filenames)
+                else:
+                    found.add(path)
 
-    def initialize_argparse(self, description, kwargs):
-        """Prepare to process arguments from sys.argv.
-        """
-        self._arg_defaults = argparse.ArgumentParser(description=description, **kwargs)
-        self._arg_parser = argparse.ArgumentParser(description=description, **kwargs)
-        self.set_defaults = self._arg_parser.set_defaults
-        self.print_usage = self._arg_parser.print_usage
-        self.print_help = self._arg_parser.print_help
+        return sorted(found)
 
-    def add_argument(self, *args, **kwargs):
-        """Wrapper to add arguments to both the main and the shadow argparser.
+    def result_cache_key(self, handler, options):
+        """Returns the hash of everything a cached subcommand's result depends on.
         """
-        if kwargs.get('add_dest', True):
-            kwargs['dest'] = 'general_' + self.get_argument_name(*args, **kwargs)
-        if 'add_dest' in kwargs:
-            del(kwargs['add_dest'])
+        subcommand = getattr(self.args, 'subparsers', None) or 'general'
+        sections = options['sections'] or (subcommand,)
+        config = dict((section, dict(self.config[section].items())) for section in sections)
+        key = hashlib.sha256()
+        key.update(json.dumps(
+            [RESULT_CACHE_VERSION, handler.__module__, handler.__name__, options['version'], config],
+            sort_keys=True,
+            default=str,
+        ).encode('utf-8'))
+
+        for path in self.find_cache_files(options['files']):
+            key.update(b'\0' + path.encode('utf-8') + b'\0')
+
+            try:
+                with open(path, 'rb') as fd:
+                    for block in iter(lambda: fd.read(2**20), b''):
+                        key.update(block)
+
+            except (IOError, OSError):
+                key.update(b'missing')
+
+        return key.hexdigest()
+
+    def run_cached(self, handler, options):
+        """Replay a cached result for handler, or run it and store the result.
+
+        On a hit the log records and stdout from the original run are
+        written again, artifacts are put back in place and the original
+        return value is returned. Failures (exceptions, False or a non-zero
+        exit code) are not cached.
+        """
+        hits = self.metrics.counter('result_cache_hits', 'Subcommand results served from the result cache')
+        misses = self.metrics.counter('result_cache_misses', 'Subcommand results that had to be computed')
+        key = self.result_cache_key(handler, options)
+        entry = self.result_cache.get(key)
+
+        if entry:
+            hits.inc()
+            self.log.debug('Replaying cached result %s', key)
+            now = time()
+
+            for path, data in entry['artifacts']:
+                self.write_artifact(path, data)
+
+            for record in entry['records']:
+                record.created = now
+                record.msecs = (now - int(now)) * 1000
+                for log_handler in logging.root.handlers:
+                    if record.levelno >= log_handler.level:
+                        log_handler.handle(record)
+
+            sys.stdout.write(entry['stdout'])
+
+            return entry['result']
+
+        misses.inc()
+        recorder = ResultRecorder()
+        stdout = sys.stdout = TeeStream(sys.stdout)
+        logging.root.handlers.insert(0, recorder)
+        start = perf_counter()
+
+        try:
+            result = self.call_handler(handler)
+
+        finally:
+            logging.root.removeHandler(recorder)
+            sys.stdout = stdout.stream
+
+        if result is False or (type(result) is int and result != 0):
+            return result
+
+        entry = {
+            'records': recorder.records,
+            'stdout': ''.join(stdout.data),
+            'result': result,
+            'artifacts': [],
+            'duration': perf_counter() - start,
+        }
+
+        for path in self.find_cache_files(options['artifacts']):
+            try:
+                with open(path, 'rb') as fd:
+                    entry['artifacts'].append((path, fd.read()))
+            except (IOError, OSError) as e:
+                self.log.debug('Not caching result %s, could not read artifact %s: %s', key, path, e)
+                return result
+
+        try:
+            self.result_cache.put(key, entry)
+        except Exception as e:
+            self.log.debug('Could not store cached result %s: %s', key, e)
+
+        return result
+
+    def write_artifact(self, path, data):
+        """Atomically write a cached artifact back to path.
+        """
+        from tempfile import NamedTemporaryFile
 
-        if 'action' in kwargs and kwargs['action'] == 'store_boolean':
-            return handle_store_boolean(self, *args, **kwargs)
+        directory = os.path.dirname(os.path.abspath(path))
 
-        self._arg_parser.add_argument(*args, **kwargs)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
 
-        # Populate the shadow parser
-        if 'default' in kwargs:
-            del(kwargs['default'])
-        if 'action' in kwargs and kwargs['action'] == 'store_false':
-            kwargs['action'] == 'store_true'
-        self._arg_defaults.add_argument(*args, **kwargs)
+        with NamedTemporaryFile(mode='wb', dir=directory, delete=False) as tmpfile:
+            tmpfile.write(data)
 
-    def initialize_logging(self):
-        """Prepare the defaults for the logging infrastructure.
+        os.rename(tmpfile.name, path)
+
+    @contextmanager
+    def timer(self, name):
+        """Context manager that records how long its body takes in `cli.timings`.
+
+        Subcommands can use this to add their own spans to the --timings report:
+
+            with cli.timer('compile'):
+                compile_firmware()
         """
-        self.log_file = None
-        self.log_file_mode = 'a'
-        self.log_file_handler = None
-        self.log_print = True
-        self.log_print_to = sys.stderr
-        self.log_print_level = logging.INFO
-        self.log_file_level = logging.DEBUG
-        self.log_level = logging.INFO
-        self.log = logging.getLogger(self.__class__.__name__)
-        self.log.setLevel(logging.DEBUG)
-        logging.root.setLevel(logging.DEBUG)
-        self.add_argument('-V', '--version', version=self.version, action='version', help='Display the version and exit')
-        self.add_argument('-v', '--verbose', action='store_true', help='Make the logging more verbose')
-        self.add_argument('--datetime-fmt', default='%Y-%m-%d %H:%M:%S', help='Format string for datetimes')
-        self.add_argument('--log-fmt', default='%(levelname)s %(message)s', help='Format string for printed log output')
-        self.add_argument('--log-file-fmt', default='[%(levelname)s] [%(asctime)s] [file:%(pathname)s] [line:%(lineno)d] %(message)s', help='Format string for log file.')
-        self.add_argument('--log-file', help='File to write log messages to')
-        self.add_argument('--color', action='store_boolean', default=True, help='color in output')
-        self.add_argument('-c', '--config-file', help='The config file to read and/or write')
-        self.add_argument('--save-config', action='store_true', help='Save the running configuration to the config file')
+        depth = getattr(self._timer_depth, 'depth', 0)
+        start = perf_counter()
 
-    def add_subparsers(self, title='Sub-commands', **kwargs):
-        if self._inside_context_manager:
-            raise RuntimeError('You must run this before the with statement!')
+        if self._timer_depth:
+            self._timer_depth.depth = depth + 1
 
-        self.acquire_lock()
-        self._subparsers_default = self._arg_defaults.add_subparsers(title=title, dest='subparsers', **kwargs)
-        self._subparsers = self._arg_parser.add_subparsers(title=title, dest='subparsers', **kwargs)
-        self.release_lock()
+        try:
+            yield
 
-    def acquire_lock(self):
-        """Acquire the CLIM lock for exclusive access to properties.
+        finally:
+            self.timings.append({'name': name, 'start': start - self.start_time, 'duration': perf_counter() - start, 'depth': depth})
+
+            if self._timer_depth:
+                self._timer_depth.depth = depth
+
+    def export_metrics(self):
+        """Write `cli.metrics` to --metrics-file if it was given.
         """
-        if self._lock:
-            self._lock.acquire()
+        if self.config.general.metrics_file:
+            self.metrics.write(self.config.general.metrics_file, self.config.general.metrics_format)
+            self.log.debug('Wrote metrics to %s', self.config.general.metrics_file)
 
-    def release_lock(self):
-        """Release the CLIM lock.
+    def report_timings(self):
+        """Log and/or write out the timings for this run if we were asked to.
         """
-        if self._lock:
-            self._lock.release()
+        if not (self.config.general.timings or self.config.general.timings_file):
+            return
 
-    def find_config_file(self):
-        """Locate the config file.
+        timings = sorted(self.timings, key=lambda span: span['start'])
+        total = perf_counter() - self.start_time
+
+        if self.config.general.timings:
+            self.log.info('Timings:')
+            for span in timings:
+                self.log.info('  %-32s %10.3fms', '  ' * span['depth'] + span['name'], span['duration'] * 1000)
+            self.log.info('  %-32s %10.3fms', 'total', total * 1000)
+
+        if self.config.general.timings_file:
+            with open(self.config.general.timings_file, 'w') as fd:
+                json.dump({'total': total, 'spans': timings}, fd, indent=4)
+
+    def parallel(self, func, items, jobs=None, processes=False, output='grouped', fail_fast=True, name=str):
+        """Run func(cli, item) for every item, several at a time.
+
+        Jobs run in a thread pool, or a process pool when `processes` is
+        True. Process pools fork, so func must be picklable (a module level
+        function) and receives the forked copy of this CLIM instance. Only
+        the calling thread is copied into the workers: a lock that another
+        thread held when the pool started, such as one inside a log handler
+        or the `--log-async` writer, stays held in the worker forever, so
+        func must not wait on other threads or on locks they hold. Where
+        fork isn't available, such as on Windows, the jobs run in
+        threads instead.
+
+        `jobs` defaults to `cli.config.general.jobs` (`-j`), and 0 means one
+        per CPU.
+
+        Log output from each job is captured and written through the normal
+        log handlers in the order items were given:
+
+        * `grouped`: each job's output is written together when it finishes
+        * `prefixed`: every line is prefixed with `[name(item)]`. Thread
+          jobs write their output as it happens.
+
+        When `fail_fast` is True the first failure cancels every job that
+        has not started yet. After all output has been written the first
+        exception is raised again. Returns a list of results in the same
+        order as items.
         """
-        if self.config_file:
-            return self.config_file
+        global parallel_cli
+        import multiprocessing
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+        if output not in ('grouped', 'prefixed'):
+            raise ValueError('output must be grouped or prefixed, not %r' % output)
+
+        if processes and 'fork' not in multiprocessing.get_all_start_methods():
+            # Workers started any other way would have no copy of this CLIM instance to pass to func
+            self.log.debug('fork is not available, running parallel jobs in threads')
+            processes = False
+
+        items = list(items)
+        jobs = jobs or self.config.general.jobs or multiprocessing.cpu_count()
+        router = ParallelLogRouter(logging.root.handlers[:])
+        live = output == 'prefixed' and not processes
+        parallel_jobs = [ParallelJob(name(item), output == 'prefixed', router.forward if live else None) for item in items]
+
+        if processes:
+            parallel_cli = self
+            executor = ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork'))
+            futures = [executor.submit(run_parallel_process_job, job, func, item) for job, item in zip(parallel_jobs, items)]
+        else:
+            logging.root.handlers = [router]
+            executor = ThreadPoolExecutor(jobs)
+            futures = [executor.submit(router.run, job, func, self, item) for job, item in zip(parallel_jobs, items)]
+
+        results = [None] * len(futures)
+        exceptions = []
+        next_job = 0
+        pending = set(futures)
+
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                if fail_fast and any(not future.cancelled() and (future.exception() or future.result().exception) for future in done):
+                    for future in pending:
+                        future.cancel()
+
+                # Write the output of every finished job, keeping the order of items
+                while next_job < len(futures) and futures[next_job].done():
+                    future = futures[next_job]
+
+                    if not future.cancelled():
+                        if future.exception():
+                            exceptions.append(future.exception())
+                        else:
+                            job = future.result()
+                            results[next_job] = job.result
+                            for record in job.records:
+                                router.forward(record)
+                            if job.exception:
+                                exceptions.append(job.exception)
 
-        if self.args and self.args.general_config_file:
-            return self.args.general_config_file
+                    next_job += 1
 
-        return os.path.abspath(os.path.expanduser('~/.%s.ini' % self.prog_name))
+        finally:
+            executor.shutdown()
+            logging.root.handlers = router.handlers
+            parallel_cli = None
 
-    def get_argument_name(self, *args, **kwargs):
-        """Takes argparse arguments and returns the dest name.
-        """
-        return self._arg_parser._get_optional_kwargs(*args, **kwargs)['dest']
+        if exceptions:
+            raise exceptions[0]
 
-    def argument(self, *args, **kwargs):
-        """Decorator to call self.add_argument or self.<subcommand>.add_argument.
+        return results
+
+    def command_slots(self):
+        """Returns the semaphore that limits how many `run_command()` calls run at once.
+
+        The limit is `cli.config.general.jobs` (`-j`), or one per CPU.
         """
-        if self._inside_context_manager:
-            raise RuntimeError('You must run this before the with statement!')
+        self.acquire_lock()
 
-        def argument_function(handler):
-            if handler is self._entrypoint:
-                self.add_argument(*args, **kwargs)
+        if not self._command_slots:
+            import multiprocessing
+            jobs = self.config.general.jobs or multiprocessing.cpu_count()
+            self._command_slots = threading.BoundedSemaphore(jobs) if thread else None
 
-            elif handler.__name__ in self.subcommands:
-                self.subcommands[handler.__name__].add_argument(*args, **kwargs)
+        self.release_lock()
 
-            else:
-                raise RuntimeError('Decorated function is not entrypoint or subcommand!')
+        return self._command_slots
 
-            return handler
+    def run_command(self, command, stdout_level=logging.INFO, stderr_level=logging.WARNING, timeout=None, capture=False, check=False, encoding='utf-8', kill_grace=5, **kwargs):
+        """Run an external command, streaming its output into `cli.log`, and return a `CommandResult`.
 
-        return argument_function
+        Each line of stdout and stderr is logged at `stdout_level` and
+        `stderr_level` as it arrives. Use None to keep a stream out of the
+        log. ANSI escapes in the output are kept for colored logs and
+        stripped for everything else. Set `capture` to also keep the output
+        in the result.
 
-    def arg_passed(self, arg):
-        """Returns True if arg was passed on the command line.
+        The command runs in its own process group. When `timeout` seconds
+        pass, or we are interrupted, the whole group gets SIGTERM and then
+        SIGKILL after `kill_grace` seconds. No more than `-j` commands run at
+        once across all threads.
+
+        When `check` is True a non-zero exit raises CalledProcessError.
+        Other keyword arguments are passed to `subprocess.Popen`.
         """
-        return self.args_passed[arg] in (None, False)
+        import subprocess
 
-    def parse_args(self):
-        """Parse the CLI args.
+        if os.name == 'posix':
+            if sys.version_info >= (3, 2):
+                kwargs['start_new_session'] = True
+            else:
+                kwargs['preexec_fn'] = os.setsid
+        else:
+            kwargs['creationflags'] = kwargs.get('creationflags', 0) | subprocess.CREATE_NEW_PROCESS_GROUP
+
+        result = CommandResult(command)
+        levels = {'stdout': stdout_level, 'stderr': stderr_level}
+        strippers = {'stdout': ANSIStripper(), 'stderr': ANSIStripper()}
+        captured = {'stdout': [], 'stderr': []}
+        captured_size = 0
+        partial = {'stdout': b'', 'stderr': b''}
+        color = self.config.general.color
+        slots = self.command_slots()
+
+        if slots:
+            slots.acquire()
+
+        try:
+            self.log.debug('Running: %s', ' '.join(command) if isinstance(command, (list, tuple)) else command)
+            start = perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+            output = Queue(1024)
+            timer = None
+
+            for name in ('stdout', 'stderr'):
+                reader = threading.Thread(target=read_command_output, args=(getattr(process, name), name, output))
+                reader.daemon = True
+                reader.start()
+
+            if timeout:
+                def expire():
+                    result.timed_out = True
+                    kill_process_group(process, kill_grace)
+
+                timer = threading.Timer(timeout, expire)
+                timer.daemon = True
+                timer.start()
+
+            try:
+                open_streams = 2
+                while open_streams:
+                    name, data = output.get()
+
+                    if data is None:
+                        open_streams -= 1
+                        lines = [(partial[name], '')] if partial[name] else []
+                        partial[name] = b''
+                    else:
+                        result.output_bytes += len(data)
+
+                        if levels[name] is None and not capture:
+                            result.peak_output_size = max(result.peak_output_size, len(data))
+                            continue
+
+                        data = partial[name] + data
+                        result.peak_output_size = max(result.peak_output_size, captured_size + len(data))
+                        lines = [(line, '\n') for line in data.split(b'\n')]
+                        partial[name] = lines.pop()[0]
+
+                        # Don't hold on to output that never ends a line
+                        if len(partial[name]) > 65536:
+                            lines.append((partial[name], ''))
+                            partial[name] = b''
+
+                    for line, end in lines:
+                        raw = line.decode(encoding, 'replace').rstrip('\r')
+                        text = strippers[name].feed(raw)
+
+                        if levels[name] is not None:
+                            self.log.log(levels[name], '%s', raw if color else text)
+
+                        if capture:
+                            captured[name].append(text + end)
+                            captured_size += len(line) + len(end)
+
+                    if capture and data is None:
+                        captured[name].append(strippers[name].flush())
+
+                    result.peak_output_size = max(result.peak_output_size, captured_size + len(partial[name]))
+
+                result.returncode = process.wait()
+
+            except BaseException:
+                kill_process_group(process, kill_grace)
+                raise
+
+            finally:
+                if timer:
+                    timer.cancel()
+                result.duration = perf_counter() - start
+
+        finally:
+            if slots:
+                slots.release()
+
+        if capture:
+            result.stdout = ''.join(captured['stdout'])
+            result.stderr = ''.join(captured['stderr'])
+
+        if result.timed_out:
+            self.log.error('Command timed out after %s seconds: %s', timeout, command)
+
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, command, result.stdout)
+
+        return result
+
+    def run_commands(self, commands, output='grouped', **kwargs):
+        """Run several commands at once with `run_command()` and return their results in order.
+
+        Their log output is kept together per command (or prefixed, see
+        `parallel()`) and keyword arguments are passed to `run_command()`.
         """
-        if self.args:
-            self.log.debug('Warning: Arguments have already been parsed, ignoring duplicate attempt!')
-            return
+        def run(cli, command):
+            return cli.run_command(command, **kwargs)
 
-        self.acquire_lock()
+        def name(command):
+            return command[0] if isinstance(command, (list, tuple)) else command.split()[0]
 
-        self.args_passed = self._arg_defaults.parse_args()
-        self.args = self._arg_parser.parse_args()
+        return self.parallel(run, commands, output=output, fail_fast=False, name=name)
 
-        if 'entrypoint' in self.args:
-            self._entrypoint = self.args.entrypoint
+    def run_batch(self, filename):
+        """Run every command in filename (or stdin, when filename is `-`) with `run_many()`.
+        """
+        if filename == '-':
+            results = self.run_many(sys.stdin)
+        else:
+            with open(filename) as jobs:
+                results = self.run_many(jobs)
 
-        if self.args.general_config_file:
-            self.config_file = self.args.general_config_file
+        failed = len([result for result in results if result[2]])
+        if failed:
+            self.log.error('%d of %d jobs failed.', failed, len(results))
+        else:
+            self.log.debug('All %d jobs succeeded.', len(results))
 
-        self.release_lock()
+        return results
 
-    def read_config(self):
-        """Parse the configuration file and determine the runtime configuration.
+    def run_many(self, jobs):
+        """Run many commands in this process, one per item in jobs.
+
+        `jobs` is an iterable of command lines, such as an open file. It is
+        read one line at a time. Blank lines and lines starting with `#` are
+        skipped. Each line is parsed with the parsers we already built and
+        dispatched to its entrypoint.
+
+        The config files, environment and logging setup are shared by all
+        jobs. Arguments given on a job's line override the config for that
+        job only, on top of the arguments this process was started with.
+
+        Returns a list of (line_number, argv, exit_code) tuples.
         """
-        self.acquire_lock()
-        self.config_file = self.find_config_file()
+        import shlex
 
-        if self.config_file and os.path.exists(cli.config_file):
-            config = RawConfigParser(self.config)
-            config.read(self.config_file)
-
-            # Iterate over the config file options and write them into self.config
-            for section in config.sections():
-                for option in config.options(section):
-                    value = config.get(section, option)
-
-                    # Coerce values into useful datatypes
-                    if value.lower() in ['1', 'yes', 'true', 'on']:
-                        value = True
-                    elif value.lower() in ['0', 'no', 'false', 'none', 'off']:
-                        value = False
-                    elif value.replace('.', '').isdigit():
-                        if '.' in value:
-                            value = Decimal(value)
-                        else:
-                            value = int(value)
+        if not self._inside_context_manager:
+            raise RuntimeError('You must run this inside the with statement!')
 
-                    self.config[section][option] = value
+        saved = (self.args, self.args_passed, self._entrypoint, self.config.get_layer('defaults'), self.config.get_layer('cli'), self.config.get_layer('runtime'))
+        results = []
 
-        # Fold the CLI args into self.config
-        for argument in vars(self.args):
-            if argument in ('subparsers', 'entrypoint'):
-                continue
+        try:
+            for line_number, line in enumerate(jobs, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
 
-            if '_' not in argument:
-                continue
+                argv = shlex.split(line)
+                exit_code = self.run_job(argv, saved[2], saved[4])
+                results.append((line_number, argv, exit_code))
 
-            section, option = argument.split('_', 1)
-            if hasattr(self.args_passed, argument):
-                self.config[section][option] = getattr(self.args, argument)
-            else:
-                if option not in self.config[section]:
-                    self.config[section][option] = getattr(self.args, argument)
+                if exit_code:
+                    self.log.error('Job on line %d exited with %s: %s', line_number, exit_code, line)
+                else:
+                    self.log.debug('Job on line %d succeeded: %s', line_number, line)
 
-        self.release_lock()
+        finally:
+            self.args, self.args_passed, self._entrypoint = saved[:3]
+            self.config.set_layer('defaults', saved[3], self.config.sources.get('defaults'))
+            self.config.set_layer('cli', saved[4], self.config.sources.get('cli'))
+            self.config.set_layer('runtime', saved[5], self.config.sources.get('runtime'))
 
-    def save_config(self):
-        """Save the current configuration to the config file.
+        return results
+
+    def run_job(self, argv, entrypoint, base_cli):
+        """Parse argv and run it as one job of `run_many()`. Returns the exit code.
         """
-        self.log.debug("Saving config file to '%s'", self.config_file)
+        try:
+            args, args_passed = self.parse_argv(argv)
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
 
-        if not self.config_file:
-            self.log.warning('%s.config_file file not set, not saving config!', self.__class__.__name__)
-            return
+        defaults, passed = self.args_to_config_layers(args, args_passed)
+        cli_layer = dict((section, dict(options)) for section, options in base_cli.items())
+        for section, options in passed.items():
+            cli_layer.setdefault(section, {}).update(options)
 
         self.acquire_lock()
+        self.args, self.args_passed = args, args_passed
+        self._entrypoint = args.__dict__.get('entrypoint', entrypoint)
+        self.config.set_layer('defaults', defaults)
+        self.config.set_layer('cli', cli_layer)
+        self.config.set_layer('runtime', {})
+        self.release_lock()
 
-        config = RawConfigParser()
-        for section_name, section in self.config._config.items():
-            config.add_section(section_name)
-            for option_name, value in section.items():
-                if section_name == 'general':
-                    if option_name in ['save_config']:
-                        continue
-                config.set(section_name, option_name, str(value))
-
-        with NamedTemporaryFile(mode='w', dir=os.path.dirname(self.config_file), delete=False) as tmpfile:
-            config.write(tmpfile)
+        try:
+            self.call_entrypoint()
 
-        # Move the new config file into place atomically
-        if os.path.getsize(tmpfile.name) > 0:
-            os.rename(tmpfile.name, self.config_file)
-        else:
-            self.log.warning('Config file saving failed, not replacing %s with %s.', self.config_file, tmpfile.name)
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
 
-        self.release_lock()
+        except Exception as e:
+            self.log.exception(e)
+            return 255
 
-    def run(self):
-        """Execute the entrypoint function.
-        """
-        if not self._inside_context_manager:
-            self.__enter__()
-            self.log.debug('Warning: self.run() called outside of context manager. This will preclude calling self.__exit__().')
+        return 0
 
-        if not self._entrypoint:
-            raise RuntimeError('No entrypoint provided!')
+    def serve(self, socket_path):
+        """Run as a warm server, handling requests from `run_client()` until interrupted.
 
-        return self._entrypoint(self)
+        This is what `--serve SOCKET` runs. Slow imports and lazy
+        subcommands are loaded once up front. Each request is handled in a
+        forked child that takes over the client's argv, working directory,
+        environment and stdio, runs the program like `with cli: cli.run()`
+        would and reports the exit code.
+        """
+        import signal
+        import socket
+        import stat
+
+        if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'fork'):
+            raise RuntimeError('Server mode requires unix domain sockets and os.fork()!')
+
+        # Warm up everything a request would otherwise have to import
+        load_ansi_colors()
+        spinner_frames('dots')
+        for path, kwargs in self._lazy_subcommands.values():
+            LazyHandler(path).load()
+
+        # Only replace a socket that a server which is no longer running left behind
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise RuntimeError('%s exists and is not a socket!' % socket_path)
+
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError('A server is already listening on %s!' % socket_path)
+            finally:
+                probe.close()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(128)
+        server_inode = os.stat(socket_path).st_ino
+
+        # Let the kernel reap our children, and clean up when we are told to stop
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self.log.debug('Listening for requests on %s', socket_path)
+
+        try:
+            while True:
+                connection = server.accept()[0]
+
+                if os.fork() == 0:
+                    server.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    self.handle_server_request(connection)
+
+                connection.close()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            server.close()
+            if os.path.exists(socket_path) and os.stat(socket_path).st_ino == server_inode:
+                os.unlink(socket_path)
+
+    def handle_server_request(self, connection):
+        """Run a single request in a forked server child. This never returns.
+
+        The child starts with empty timings and runtime config and zeroed
+        metrics, so nothing from the server's own run leaks into the request.
+        """
+        from clim_client import receive_server_message
+
+        start_time = perf_counter()
+        exit_code = 1
+
+        try:
+            try:
+                request, fds = receive_server_message(connection)
+            except EOFError:
+                # Another server checking whether we are still running
+                os._exit(exit_code)
+
+            for stream in (sys.stdout, sys.stderr):
+                stream.flush()
+
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            sys.argv = request['argv']
+
+            # Run the request from scratch, not inside the `with cli:` that started the server
+            for handler in logging.root.handlers[:]:
+                logging.root.removeHandler(handler)
+            self._inside_context_manager = False
+            self.args = None
+            self.timings = []
+            self.start_time = start_time
+            self._timer_depth = threading.local() if thread else None
+            self.metrics.reset()
+            self.config.set_layer('runtime', {})
+
+            try:
+                with self:
+                    self.run()
+                exit_code = 0
+
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+
+        finally:
+            try:
+                logging.shutdown()
+                for stream in (sys.stdout, sys.stderr):
+                    stream.flush()
+                connection.sendall(struct.pack('!i', exit_code))
+            finally:
+                os._exit(exit_code)
 
     def entrypoint(self, handler):
         """Set the entrypoint for when no subcommand is provided.
@@ -644,7 +4462,6 @@ class CLIM(object):
             name = handler.__name__
 
         kwargs['help'] = handler.__doc__.split('\n')[0] if handler.__doc__ else None
-        self.subcommands_default[name] = self._subparsers_default.add_parser(name, **kwargs)
         self.subcommands[name] = SubparserWrapper(self, name, self._subparsers.add_parser(name, **kwargs))
         self.subcommands[name].set_defaults(entrypoint=handler)
 
@@ -657,6 +4474,279 @@ class CLIM(object):
 
         return handler
 
+    def cached(self, files=None, artifacts=None, sections=None, version=0):
+        """Decorator that lets a subcommand's results be served from the result cache. See `cached()`.
+
+        This also adds the `cache-stats` and `cache-purge` subcommands.
+        """
+        self.add_cache_subcommands()
+
+        return cached(files, artifacts, sections, version)
+
+    def add_cache_subcommands(self):
+        """Add the `cache-stats` and `cache-purge` subcommands, if they aren't there already.
+        """
+        if 'cache-stats' not in self.subcommands:
+            self.subcommand(cache_stats, name='cache-stats')
+            self.subcommand(cache_purge, name='cache-purge')
+
+    def lazy_subcommand(self, path, name=None, **kwargs):
+        """Register a subcommand that is only imported when it is run.
+
+        `path` is `package.module:function`. If `:function` is left off the
+        last component of the module name is used. If name is not provided
+        we use the function name.
+
+        Arguments are declared in the module with `@clim.argument()`. The
+        help text and arguments for every lazy subcommand are kept in a
+        manifest in `find_cache_dir()`, which is rebuilt whenever one of the
+        modules changes.
+        """
+        if self._inside_context_manager:
+            raise RuntimeError('You must run this before the with statement!')
+
+        if ':' not in path:
+            path = '%s:%s' % (path, path.rsplit('.', 1)[-1])
+
+        if self._subparsers is None:
+            self.add_subparsers()
+
+        self.acquire_lock()
+        self._lazy_subcommands[name or path.split(':', 1)[1]] = (path, kwargs)
+        self.release_lock()
+
+    def lazy_subcommand_fingerprint(self):
+        """Returns a value that changes whenever the lazy subcommands or their modules change.
+        """
+        fingerprint = [MANIFEST_VERSION]
+
+        for name, (path, kwargs) in self._lazy_subcommands.items():
+            module_file = find_module_file(path.split(':', 1)[0])
+            stat = os.stat(module_file) if module_file and os.path.exists(module_file) else None
+            fingerprint.append((name, path, module_file, file_signature(stat) if stat else None))
+
+        return fingerprint
+
+    def build_subcommand_manifest(self):
+        """Import every lazy subcommand and record its help text and arguments.
+
+        The manifest only holds plain data, see `manifest_arguments()`. The
+        arguments of subcommands that can't be stored that way are None, and
+        those subcommands are imported and registered on every run.
+        """
+        manifest = {}
+
+        for name, (path, kwargs) in self._lazy_subcommands.items():
+            handler = LazyHandler(path).load()
+
+            try:
+                arguments = manifest_arguments(handler.__dict__.get('_clim_arguments', []))
+            except ValueError as e:
+                self.log.debug('Subcommand %s will be imported on every run: %s', name, e)
+                arguments = None
+
+            manifest[name] = {
+                'help': handler.__doc__.split('\n')[0] if handler.__doc__ else None,
+                'arguments': arguments,
+            }
+
+        return manifest
+
+    def load_subcommand_manifest(self):
+        """Returns the subcommand manifest, rebuilding the cached copy if it is stale.
+        """
+        fingerprint = self.lazy_subcommand_fingerprint()
+        cached = self.read_cache_file('subcommands.manifest')
+
+        if cached:
+            try:
+                cached = pickle.loads(cached)
+                if cached['fingerprint'] == fingerprint:
+                    return cached['manifest']
+
+            except Exception as e:
+                self.log.debug('Could not use subcommand manifest: %s', e)
+
+        manifest = self.build_subcommand_manifest()
+
+        try:
+            data = pickle.dumps({'fingerprint': fingerprint, 'manifest': manifest}, 2)
+        except Exception as e:
+            self.log.debug('Could not write subcommand manifest: %s', e)
+        else:
+            self.write_cache_file('subcommands.manifest', data)
+
+        return manifest
+
+    def setup_lazy_subcommands(self):
+        """Called by __enter__() to add subparsers for the lazy subcommands.
+
+        Subcommands that already have a subparser, such as in the children
+        of a warm server, are left alone.
+        """
+        if not self._lazy_subcommands:
+            return
+
+        self.acquire_lock()
+        manifest = self._subcommand_manifest = self.load_subcommand_manifest()
+
+        for name, (path, kwargs) in self._lazy_subcommands.items():
+            if name in self.subcommands:
+                continue
+
+            kwargs = dict(kwargs, help=manifest[name]['help'])
+            self.subcommands[name] = SubparserWrapper(self, name, self._subparsers.add_parser(name, **kwargs))
+
+            if manifest[name]['arguments'] is None:
+                handler = LazyHandler(path).load()
+                self.subcommands[name].set_defaults(entrypoint=handler)
+
+                for args, kwargs in handler.__dict__.get('_clim_arguments', []):
+                    self.subcommands[name].add_argument(*args, **dict(kwargs))
+
+                continue
+
+            self.subcommands[name].set_defaults(entrypoint=LazyHandler(path))
+
+            def populate(wrapper=self.subcommands[name], arguments=manifest[name]['arguments']):
+                for args, kwargs, callables in arguments:
+                    wrapper.add_argument(*args, **argument_kwargs(kwargs, callables))
+
+            self.subcommands[name].subparser.populate = populate
+
+        self.release_lock()
+
+    def completion_parsers(self):
+        """Yields (command, parser) for every parser, using `.` for the main parser.
+        """
+        yield '.', self._arg_parser
+
+        for name, wrapper in self.subcommands.items():
+            yield name, wrapper.subparser
+
+    def completion_fingerprint(self):
+        """Returns a hash of every command, option and choice, which changes whenever the completion index should be rebuilt.
+
+        Lazy subcommands are covered by the manifest fingerprint, so their
+        parsers don't have to be populated.
+        """
+        fingerprint = [COMPLETION_INDEX_VERSION, sorted(self.subcommands)]
+
+        if self._lazy_subcommands:
+            fingerprint.append(self.lazy_subcommand_fingerprint())
+
+        for command, parser in self.completion_parsers():
+            if command in self._lazy_subcommands:
+                continue
+
+            for action in parser._actions:
+                if isinstance(action, argparse._SubParsersAction):
+                    continue
+
+                completer = getattr(action, 'completer', None)
+                fingerprint.append((
+                    command,
+                    action.option_strings,
+                    action.nargs,
+                    list(action.choices) if action.choices else None,
+                    (completer.__module__, completer.__name__) if completer else None,
+                ))
+
+        return hashlib.sha1(repr(fingerprint).encode('utf-8')).hexdigest()
+
+    def completion_values(self, action):
+        """Returns the space separated values an argument can have, from its choices or completer.
+        """
+        values = action.choices or ()
+        completer = getattr(action, 'completer', None)
+
+        if completer:
+            try:
+                values = completer(self)
+            except Exception as e:
+                self.log.debug('Completer for %s failed: %s', '/'.join(action.option_strings) or action.dest, e)
+                values = ()
+
+        return ' '.join(str(value) for value in values if str(value).split() == [str(value)])
+
+    def completion_index(self):
+        """Returns the lines of the completion index.
+        """
+        lines = []
+
+        for command, parser in self.completion_parsers():
+            if parser.populate:
+                populate, parser.populate = parser.populate, None
+                populate()
+
+            if command != '.':
+                lines.append('.\t%s\tcommand\t' % command)
+
+            for action in parser._actions:
+                if isinstance(action, argparse._SubParsersAction) or action.help == argparse.SUPPRESS:
+                    continue
+
+                values = self.completion_values(action)
+
+                if action.option_strings:
+                    kind = 'flag' if action.nargs == 0 else 'option'
+                    lines.extend('\t'.join((command, option, kind, values)) for option in action.option_strings)
+                elif values:
+                    lines.append('\t'.join((command, '', 'value', values)))
+
+        return lines
+
+    def update_completion_index(self, force=False):
+        """Rebuild the completion index if it is out of date.
+
+        Nothing is done until the index has been created by --completion,
+        so programs nobody completes don't pay for it. After that it is
+        rebuilt whenever the fingerprint changes, or every
+        `completion_index_max_age` seconds so completer values stay fresh.
+        """
+        path = os.path.join(self.find_cache_dir(), 'completion.index')
+
+        if not force and not os.path.exists(path):
+            return
+
+        fingerprint = self.completion_fingerprint()
+
+        if not force:
+            try:
+                with open(path) as fd:
+                    header = fd.readline().rstrip('\n').split('\t')
+
+                if header[1] == fingerprint and time() - float(header[2]) < self.completion_index_max_age:
+                    return
+
+            except (IOError, OSError, IndexError, ValueError):
+                pass
+
+        self.log.debug('Rebuilding completion index %s', path)
+        lines = ['#fingerprint\t%s\t%d' % (fingerprint, time())] + self.completion_index()
+        self.write_cache_file('completion.index', ('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def completion_script(self, shell):
+        """Returns the bash or zsh script that completes this program from the completion index.
+        """
+        prog = os.path.basename(self.prog_name)
+        script = completion_scripts[shell].replace('@AWK@', completion_awk.strip())
+
+        return script.replace('@FUNC@', re.sub(r'\W', '_', prog)).replace('@PROG@', prog)
+
+    def setup_colorama(self):
+        """Called by __enter__() to let colorama wrap stdout and stderr.
+
+        When color is disabled and we are not writing to a terminal there is
+        nothing for colorama to do, so we skip importing it.
+        """
+        streams = (sys.stdout, self.log_print_to)
+        isatty = any(hasattr(stream, 'isatty') and stream.isatty() for stream in streams)
+
+        if self.config.general.color or isatty:
+            import colorama
+            colorama.init()
+
     def setup_logging(self):
         """Called by __enter__() to setup the logging configuration.
         """
@@ -679,20 +4769,61 @@ class CLIM(object):
         else:
             self.log_format = ANSIStrippingFormatter(self.args.general_log_fmt, self.config.general.datetime_fmt)
 
+        if self.config.general.log_format == 'json':
+            self.log_file_format = self.log_format = JSONFormatter()
+
+        handlers = []
+
         if self.log_file:
             self.log_file_handler = logging.FileHandler(self.log_file, self.log_file_mode)
             self.log_file_handler.setLevel(self.log_file_level)
             self.log_file_handler.setFormatter(self.log_file_format)
-            logging.root.addHandler(self.log_file_handler)
+            handlers.append(self.log_file_handler)
 
         if self.log_print:
-            self.log_print_handler = logging.StreamHandler(self.log_print_to)
+            self.log_print_handler = LiveStreamHandler(self.log_print_to, self._progress)
             self.log_print_handler.setLevel(self.log_print_level)
             self.log_print_handler.setFormatter(self.log_format)
-            logging.root.addHandler(self.log_print_handler)
+            handlers.append(self.log_print_handler)
+
+        if self.config.general.log_async and handlers and thread:
+            self.log_queue_handler = AsyncLogHandler(
+                handlers,
+                maxsize=int(self.config.general.log_queue_size),
+                flush_interval=float(self.config.general.log_flush_interval),
+                policy=self.config.general.log_queue_policy,
+            )
+            handlers = [self.log_queue_handler]
+
+        if self.config.general.log_dedup_window or self.config.general.log_rate_limit:
+            self.log_filter = LogRateFilter(
+                window=float(self.config.general.log_dedup_window or 0),
+                rate=float(self.config.general.log_rate_limit or 0),
+                burst=int(self.config.general.log_rate_burst),
+            )
+            for handler in handlers:
+                handler.addFilter(self.log_filter)
+
+        for handler in handlers:
+            logging.root.addHandler(handler)
 
         self.release_lock()
 
+    def shutdown_logging(self):
+        """Clear the progress display, report suppressed log messages and write out any records still waiting in the async log queue.
+        """
+        if self._progress:
+            self._progress.close()
+
+        if self.log_filter:
+            self.log_filter.report(self.log)
+            self.log_filter = None
+
+        if self.log_queue_handler:
+            logging.root.removeHandler(self.log_queue_handler)
+            self.log_queue_handler.close()
+            self.log_queue_handler = None
+
     def __enter__(self):
         if self._inside_context_manager:
             self.log.debug('Warning: context manager was entered again. This usually means that self.run() was called before the with statement. You probably do not want to do that.')
@@ -702,13 +4833,30 @@ class CLIM(object):
         self._inside_context_manager = True
         self.release_lock()
 
-        colorama.init()
-        self.parse_args()
-        self.read_config()
-        self.setup_logging()
+        with self.timer('setup_lazy_subcommands'):
+            self.setup_lazy_subcommands()
+
+        with self.timer('parse_args'):
+            self.parse_args()
+
+        with self.timer('read_config'):
+            self.read_config()
+
+        with self.timer('setup_colorama'):
+            self.setup_colorama()
+
+        with self.timer('setup_logging'):
+            self.setup_logging()
+
+        if self.config_problems:
+            self.report_config_problems()
+
+        with self.timer('update_completion_index'):
+            self.update_completion_index()
 
         if self.config.general.save_config:
-            self.save_config()
+            with self.timer('save_config'):
+                self.save_config()
 
         return self
 
@@ -717,10 +4865,19 @@ class CLIM(object):
         self._inside_context_manager = False
         self.release_lock()
 
-        if exc_type is not None:
+        if exc_type is not None and not issubclass(exc_type, SystemExit):
             logging.exception(exc_val)
+            self.close_event_loop()
+            self.report_timings()
+            self.export_metrics()
+            self.shutdown_logging()
             exit(255)
 
+        self.close_event_loop()
+        self.report_timings()
+        self.export_metrics()
+        self.shutdown_logging()
+
 
 if __name__ == '__main__':
         cli = CLIM('My useful CLI tool with subcommands.')
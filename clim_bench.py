@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+"""Benchmarks for clim.
+
+Record a baseline before you start, then compare against it as you work:
+
+    ./clim_bench.py bench -o bench_baseline.json
+    ./clim_bench.py compare -b bench_baseline.json
+
+`bench` times every benchmark and writes the results as JSON. `compare`
+runs them again (or reads `--results`) and exits with an error if any of
+them is more than `--threshold` percent slower than the baseline, or if
+`import clim` started importing a module that should only be imported when
+it is needed.
+
+Each benchmark is timed `--repeat` times and the fastest time is compared,
+which is the least sensitive to whatever else the machine is doing. Config
+and cache files are kept in a temporary directory and nothing uses the
+network. Baselines are only meaningful on the machine that recorded them.
+The committed `bench_baseline.json` shows where things stood when it was
+recorded (see its `python` and `platform`). Record your own before
+comparing.
+"""
+from __future__ import division, print_function, unicode_literals
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+from collections import OrderedDict
+from tempfile import mkdtemp
+from time import sleep, time
+
+from clim import CLIM, ANSIFormatter, ANSIEmojiLoglevelFormatter, ANSIStrippingFormatter, JSONFormatter, perf_counter
+
+RESULTS_VERSION = 1
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that `import clim` must not import, they are imported when they are first used
+DEFERRED_MODULES = ('asyncio', 'colorama', 'concurrent', 'ctypes', 'multiprocessing', 'socket', 'spinners', 'subprocess', 'tempfile')
+
+# The size of the CLI built by make_cli()
+SUBCOMMANDS = 20
+ARGUMENTS = 10
+
+benchmarks = OrderedDict()
+cli = CLIM('Benchmarks for clim.')
+
+
+def benchmark(name, number=1):
+    """Decorator that registers a benchmark.
+
+    The decorated function is called with a scratch directory and returns
+    the function to time, so setup isn't counted. The time is divided by
+    `number`, the number of operations one call does. If the timed function
+    returns a number it is used as the time instead, for things that have
+    to be timed in another process. If the timed function has a `cleanup`
+    attribute it is called once timing is done.
+    """
+    def benchmark_function(setup):
+        benchmarks[name] = (setup, number)
+        return setup
+
+    return benchmark_function
+
+
+class NullStream(object):
+    """A stream that throws away everything written to it.
+    """
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_cli(subcommands=SUBCOMMANDS, arguments=ARGUMENTS):
+    """Returns a CLIM with some subcommands, each with some arguments.
+    """
+    bench_cli = CLIM('Benchmark CLI.')
+
+    for i in range(subcommands):
+        def handler(cli):
+            pass
+
+        handler.__name__ = str('command%d' % i)
+        handler.__doc__ = 'Benchmark subcommand %d.' % i
+        bench_cli.subcommand(handler)
+
+        for j in range(arguments):
+            bench_cli.subcommands[handler.__name__].add_argument('--option%d' % j, type=int, default=j, help='Option %d' % j)
+
+    return bench_cli
+
+
+def write_config(path, sections, options):
+    """Write an INI file with options for the first `sections` subcommands of make_cli().
+    """
+    with open(path, 'w') as fd:
+        for i in range(sections):
+            fd.write('[command%d]\n' % i)
+            for j in range(options):
+                fd.write('%s%d = %s\n' % ('option' if j < ARGUMENTS else 'setting', j, j))
+            fd.write('\n')
+
+
+def config_cli(workdir, name, sections, options):
+    """Returns a make_cli() that has read a config file of the given size.
+    """
+    config_file = os.path.join(workdir, name)
+    write_config(config_file, sections, options)
+
+    bench_cli = make_cli()
+    for i in range(sections):
+        for j in range(ARGUMENTS, options):
+            bench_cli.config_option('command%d' % i, 'setting%d' % j, type=int)
+
+    bench_cli.config_file = config_file
+    bench_cli.args, bench_cli.args_passed = bench_cli.parse_argv(['command0'])
+    bench_cli.read_config()
+
+    return bench_cli
+
+
+def python_env():
+    """Returns the environment for running python in a subprocess.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([HERE] + [path for path in [env.get('PYTHONPATH')] if path])
+    env.pop('QMK_SERVER', None)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)  # Compiling clim.py on every run would dwarf everything else
+
+    return env
+
+
+@benchmark('import_clim')
+def import_clim(workdir):
+    script = 'from timeit import default_timer; start = default_timer(); import clim; print(default_timer() - start)'
+
+    def run():
+        return float(subprocess.check_output([sys.executable, '-c', script], env=python_env()))
+
+    return run
+
+
+@benchmark('construct_cli')
+def construct_cli(workdir):
+    return make_cli
+
+
+@benchmark('parse_args', number=100)
+def parse_args(workdir):
+    bench_cli = make_cli()
+    argv = ['command%d' % (SUBCOMMANDS - 1), '--option1', '5', '--option%d' % (ARGUMENTS - 1), '7']
+
+    def run():
+        for i in range(100):
+            bench_cli.parse_argv(argv)
+
+    return run
+
+
+@benchmark('read_config_small', number=100)
+def read_config_small(workdir):
+    bench_cli = config_cli(workdir, 'small.ini', 1, ARGUMENTS)
+
+    def run():
+        for i in range(100):
+            bench_cli.read_config()
+
+    return run
+
+
+@benchmark('read_config_large')
+def read_config_large(workdir):
+    return config_cli(workdir, 'large.ini', SUBCOMMANDS, 500).read_config
+
+
+@benchmark('read_config_large_uncached')
+def read_config_large_uncached(workdir):
+    bench_cli = config_cli(workdir, 'large.ini', SUBCOMMANDS, 500)
+
+    def run():
+        shutil.rmtree(bench_cli.find_cache_dir(), ignore_errors=True)
+        bench_cli.read_config()
+
+    return run
+
+
+@benchmark('read_config_threaded', number=40000)
+def read_config_threaded(workdir):
+    bench_cli = config_cli(workdir, 'threaded.ini', SUBCOMMANDS, ARGUMENTS)
+
+    def reader():
+        for i in range(10000):
+            bench_cli.config.command0.option1
+
+    def writer():
+        for i in range(100):
+            bench_cli.config.command1.option1 = i
+
+    def run():
+        # Four threads reading while another publishes new snapshots
+        threads = [threading.Thread(target=reader) for i in range(4)] + [threading.Thread(target=writer)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    return run
+
+
+@benchmark('save_config')
+def save_config(workdir):
+    bench_cli = config_cli(workdir, 'save.ini', SUBCOMMANDS, ARGUMENTS)
+    counter = [0]
+
+    def run():
+        counter[0] += 1
+        bench_cli.config.command0.option0 = counter[0]
+        bench_cli.save_config()
+
+    return run
+
+
+def log_throughput(formatter_class):
+    """Returns a benchmark that logs 1000 records through a formatter.
+    """
+    def setup(workdir):
+        handler = logging.StreamHandler(NullStream())
+        handler.setFormatter(formatter_class('%(levelname)s %(message)s'))
+        log = logging.getLogger('clim_bench.' + formatter_class.__name__)
+        log.handlers = [handler]
+        log.propagate = False
+        log.setLevel(logging.INFO)
+
+        def run():
+            for i in range(1000):
+                log.info('{fg_blue}Record{style_reset_all} %d of %s', i, 'the benchmark')
+
+        return run
+
+    return setup
+
+
+# ANSIStrippingFormatter is what --log-format text writes to files and pipes, JSONFormatter is --log-format json
+for formatter_class in (ANSIFormatter, ANSIEmojiLoglevelFormatter, ANSIStrippingFormatter, JSONFormatter):
+    benchmark('log_' + formatter_class.__name__, number=1000)(log_throughput(formatter_class))
+
+
+@benchmark('qmk_hello')
+def qmk_hello(workdir):
+    command = [sys.executable, os.path.join(HERE, 'qmk'), 'hello']
+
+    def run():
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(command, env=python_env(), cwd=workdir, stdout=devnull)
+
+    run()  # Build the caches, we want the time for a normal run
+
+    return run
+
+
+@benchmark('qmk_hello_warm')
+def qmk_hello_warm(workdir):
+    qmk = os.path.join(HERE, 'qmk')
+    socket_path = os.path.join(workdir, 'qmk.sock')
+    env = python_env()
+    env['QMK_SERVER'] = socket_path
+    server = subprocess.Popen([sys.executable, qmk, '--serve', socket_path], env=env, cwd=workdir)
+
+    while server.poll() is None and not os.path.exists(socket_path):
+        sleep(0.01)
+
+    def run():
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, qmk, 'hello'], env=env, cwd=workdir, stdout=devnull)
+
+    def cleanup():
+        server.terminate()
+        server.wait()
+
+    run.cleanup = cleanup
+    run()
+
+    return run
+
+
+def deferred_imports():
+    """Returns the DEFERRED_MODULES that `import clim` imported.
+    """
+    script = 'import json, sys, clim; print(json.dumps([module for module in %r if module in sys.modules]))' % (DEFERRED_MODULES,)
+
+    return json.loads(subprocess.check_output([sys.executable, '-c', script], env=python_env()).decode('utf-8'))
+
+
+def run_benchmarks(repeat, only=None):
+    """Run the benchmarks and return the results.
+
+    Config and cache files go in a temporary directory, which is removed
+    afterward.
+    """
+    workdir = mkdtemp(prefix='clim_bench.')
+    saved_env = dict(os.environ)
+    os.environ['HOME'] = workdir
+    os.environ['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+    results = OrderedDict()
+
+    try:
+        for name, (setup, number) in benchmarks.items():
+            if only and name not in only:
+                continue
+
+            function = setup(workdir)
+            times = []
+
+            try:
+                for i in range(repeat):
+                    start = perf_counter()
+                    elapsed = function()
+                    if not isinstance(elapsed, float):
+                        elapsed = perf_counter() - start
+                    times.append(elapsed / number)
+
+            finally:
+                if hasattr(function, 'cleanup'):
+                    function.cleanup()
+
+            times.sort()
+            results[name] = {'min': times[0], 'median': times[len(times) // 2], 'repeat': repeat, 'number': number}
+            cli.log.info('%-36s %10s', name, format_time(times[0]))
+
+        return {
+            'version': RESULTS_VERSION,
+            'created': time(),
+            'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+            'platform': platform.platform(),
+            'benchmarks': results,
+            'deferred_imports': deferred_imports(),
+        }
+
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def format_time(seconds):
+    """Returns a number of seconds in the most readable unit.
+    """
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return '%.2f%s' % (seconds * scale, unit)
+
+    return '%.0fns' % (seconds * 1e9)
+
+
+def read_results(filename):
+    """Returns the results stored in filename.
+    """
+    with open(filename) as fd:
+        results = json.load(fd)
+
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError('%s has version %s results, we need version %s.' % (filename, results.get('version'), RESULTS_VERSION))
+
+    return results
+
+
+def write_results(filename, results):
+    """Write results to filename as JSON.
+    """
+    with open(filename, 'w') as fd:
+        json.dump(results, fd, indent=2, sort_keys=True)
+        fd.write('\n')
+
+    cli.log.info('Wrote results to %s', filename)
+
+
+@cli.entrypoint
+def main(cli):
+    """Benchmarks for clim.
+    """
+    cli.print_help()
+
+
+@cli.argument('-o', '--output', metavar='FILE', help='Write the results to FILE')
+@cli.argument('-r', '--repeat', type=int, default=10, help='Number of times to time each benchmark')
+@cli.argument('-k', '--only', metavar='NAME', action='append', help='Only run NAME. Can be given more than once')
+@cli.subcommand
+def bench(cli):
+    """Run the benchmarks.
+    """
+    results = run_benchmarks(cli.config.bench.repeat, cli.config.bench.only)
+
+    if results['deferred_imports']:
+        cli.log.warning('import clim imported %s', ', '.join(results['deferred_imports']))
+
+    if cli.config.bench.output:
+        write_results(cli.config.bench.output, results)
+
+
+@cli.argument('-b', '--baseline', metavar='FILE', default='bench_baseline.json', help='The results to compare against')
+@cli.argument('--results', metavar='FILE', help='Compare these results instead of running the benchmarks')
+@cli.argument('-o', '--output', metavar='FILE', help='Write the new results to FILE')
+@cli.argument('-t', '--threshold', type=float, default=20, help='Percent slower than the baseline that counts as a regression')
+@cli.argument('-r', '--repeat', type=int, default=10, help='Number of times to time each benchmark')
+@cli.subcommand
+def compare(cli):
+    """Compare the benchmarks to a baseline and fail if any of them regressed.
+    """
+    if not os.path.exists(cli.config.compare.baseline):
+        cli.log.error('No baseline at %s, record one with: %s bench -o %s', cli.config.compare.baseline, sys.argv[0], cli.config.compare.baseline)
+        exit(1)
+
+    baseline = read_results(cli.config.compare.baseline)
+
+    if cli.config.compare.results:
+        results = read_results(cli.config.compare.results)
+    else:
+        results = run_benchmarks(cli.config.compare.repeat)
+
+    if cli.config.compare.output:
+        write_results(cli.config.compare.output, results)
+
+    regressions = []
+    limit = 1 + cli.config.compare.threshold / 100
+
+    print('%-36s %10s %10s %8s' % ('benchmark', 'baseline', 'current', 'change'))
+    for name in sorted(set(baseline['benchmarks']) | set(results['benchmarks'])):
+        if name not in results['benchmarks']:
+            print('%-36s %10s %10s %8s' % (name, format_time(baseline['benchmarks'][name]['min']), '-', 'missing'))
+            continue
+
+        if name not in baseline['benchmarks']:
+            print('%-36s %10s %10s %8s' % (name, '-', format_time(results['benchmarks'][name]['min']), 'new'))
+            continue
+
+        before = baseline['benchmarks'][name]['min']
+        after = results['benchmarks'][name]['min']
+        print('%-36s %10s %10s %+7.1f%%' % (name, format_time(before), format_time(after), (after / before - 1) * 100))
+
+        if after > before * limit:
+            regressions.append(name)
+
+    if results['python'] != baseline['python'] or results['platform'] != baseline['platform']:
+        cli.log.warning('The baseline was recorded with %s on %s, these results are from %s on %s.', baseline['python'], baseline['platform'], results['python'], results['platform'])
+
+    for module in results['deferred_imports']:
+        cli.log.error('import clim now imports %s, which should only be imported when it is needed.', module)
+
+    for name in regressions:
+        cli.log.error('%s is more than %s%% slower than the baseline.', name, cli.config.compare.threshold)
+
+    if regressions or results['deferred_imports']:
+        exit(1)
+
+    cli.log.info('No regressions.')
+
+
+if __name__ == '__main__':
+    with cli:
+        cli.run()
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""Thin client for a CLIM warm server.
+
+This module is kept separate from clim so that forwarding a command to a
+server started with `cli.serve()` doesn't pay for importing clim itself.
+"""
+from __future__ import division, print_function, unicode_literals
+import json
+import os
+import socket
+import struct
+import sys
+from array import array
+
+
+def send_server_message(sock, message, fds=()):
+    """Send a length prefixed JSON message, optionally passing file descriptors along with it.
+    """
+    data = json.dumps(message).encode('utf-8')
+    data = struct.pack('!I', len(data)) + data
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', fds))] if fds else []
+    sent = sock.sendmsg([data], ancillary)
+
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def receive_server_message(sock, max_fds=3):
+    """Receive a message sent by `send_server_message()`.
+
+    Returns a tuple of (message, fds).
+    """
+    fds = array('i')
+    data, ancillary, flags, address = sock.recvmsg(65536, socket.CMSG_LEN(max_fds * fds.itemsize))
+
+    for level, kind, fd_data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(fd_data[:len(fd_data) - (len(fd_data) % fds.itemsize)])
+
+    while len(data) < 4 or len(data) < struct.unpack('!I', data[:4])[0] + 4:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise EOFError('Connection closed in the middle of a message')
+        data += chunk
+
+    return json.loads(data[4:].decode('utf-8')), list(fds)
+
+
+def run_client(socket_path, argv=None):
+    """Run a command in a warm server started with `cli.serve()`.
+
+    Our argv, working directory, environment and stdio are handed to the
+    server, which runs the command and sends back the exit code. Returns
+    the exit code, or None if the server could not be reached.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(socket.socket, 'sendmsg'):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+
+    try:
+        for stream in (sys.stdout, sys.stderr):
+            stream.flush()
+
+        request = {'argv': sys.argv if argv is None else argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+        send_server_message(sock, request, (sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()))
+        response = b''
+
+        while len(response) < 4:
+            chunk = sock.recv(4 - len(response))
+            if not chunk:
+                return 255
+            response += chunk
+
+        return struct.unpack('!i', response)[0]
+
+    finally:
+        sock.close()
@@ -0,0 +1,40 @@
+"""Shared fixtures for the clim tests.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def clim_env(tmp_path, monkeypatch):
+    """Keep config and cache files for the test inside tmp_path.
+    """
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.delenv('QMK_SERVER', raising=False)
+
+    return tmp_path
+
+
+def python_env():
+    """Returns the environment for running a CLIM program in a subprocess.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+
+    return env
+
+
+def start_program(program, *args, **kwargs):
+    """Start `python program args` with clim importable. Returns the Popen.
+    """
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('stderr', subprocess.PIPE)
+    kwargs.setdefault('env', python_env())
+
+    return subprocess.Popen([sys.executable, str(program)] + list(args), **kwargs)
@@ -0,0 +1,58 @@
+"""Tests for the config file cache.
+"""
+import os
+
+from clim import CLIM, ConfigSchema
+
+
+def read_config(config_file, type):
+    cli = CLIM('Config cache test.')
+    cli.config_option('test', 'value', type=type)
+    cli.config_file = str(config_file)
+    cli.args, cli.args_passed = cli.parse_argv([])
+    cli.read_config()
+
+    return cli
+
+
+def test_converted_values_follow_the_schema(clim_env, monkeypatch):
+    config_file = clim_env / 'test.ini'
+    config_file.write_text('[test]\nvalue = 10\n')
+    converted = []
+    convert = ConfigSchema.convert
+
+    def counting_convert(self, config):
+        converted.extend(config)
+        return convert(self, config)
+
+    monkeypatch.setattr(ConfigSchema, 'convert', counting_convert)
+
+    assert read_config(config_file, int).config.test.value == 10
+    assert converted == ['test']
+    assert read_config(config_file, int).config.test.value == 10
+    assert converted == ['test']
+    assert read_config(config_file, float).config.test.value == 10.0
+    assert isinstance(read_config(config_file, float).config.test.value, float)
+    assert read_config(config_file, None).config.test.value == '10'
+
+
+def test_cache_notices_replaced_files(clim_env):
+    config_file = clim_env / 'test.ini'
+    config_file.write_text('[test]\nvalue = 10\n')
+    mtime_ns = os.stat(str(config_file)).st_mtime_ns
+
+    assert read_config(config_file, int).config.test.value == 10
+
+    # Same size and mtime, but renamed over the original so it is a new inode
+    new_file = clim_env / 'new.ini'
+    new_file.write_text('[test]\nvalue = 20\n')
+    os.utime(str(new_file), ns=(mtime_ns, mtime_ns))
+    os.rename(str(new_file), str(config_file))
+
+    assert read_config(config_file, int).config.test.value == 20
+
+    # Same inode and size, 1ns later than before, which a float mtime can't tell apart
+    config_file.write_text('[test]\nvalue = 30\n')
+    os.utime(str(config_file), ns=(mtime_ns + 1, mtime_ns + 1))
+
+    assert read_config(config_file, int).config.test.value == 30
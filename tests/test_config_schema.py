@@ -0,0 +1,108 @@
+"""Tests for converting config values with the config schema.
+"""
+import argparse
+import logging
+
+from clim import CLIM, ConfigSchema
+
+
+def test_converters():
+    parser = argparse.ArgumentParser()
+    schema = ConfigSchema()
+    schema.add('test', 'count', type=int)
+    schema.add('test', 'ratio', default=0.5)
+    schema.add('test', 'enabled', default=True)
+    schema.add('test', 'verbose', flag=True)
+    schema.add('test', 'numbers', type=int, multiple=True)
+    schema.add('test', 'output', type=argparse.FileType('w'))
+    schema.add('test', 'level', choices=('low', 'high'))
+    schema.add_action(parser.add_argument('--test-include', action='append'))
+
+    converted, unknown, invalid = schema.convert({'test': {
+        'count': '42',
+        'ratio': '1.25',
+        'enabled': 'off',
+        'verbose': 'Yes',
+        'numbers': '1, 2,3,',
+        'output': '~/out.txt',
+        'level': 'high',
+        'include': 'src,lib',
+    }})
+
+    assert converted == {'test': {
+        'count': 42,
+        'ratio': 1.25,
+        'enabled': False,
+        'verbose': True,
+        'numbers': [1, 2, 3],
+        'output': '~/out.txt',
+        'level': 'high',
+        'include': ['src', 'lib'],
+    }}
+    assert unknown == invalid == []
+
+
+def test_invalid_and_unknown_values():
+    schema = ConfigSchema()
+    schema.add('test', 'count', type=int)
+    schema.add('test', 'enabled', default=True)
+    schema.add('test', 'numbers', type=int, multiple=True)
+    schema.add('test', 'level', choices=('low', 'high'))
+    schema.add('test', 'unset', type=int)
+
+    converted, unknown, invalid = schema.convert({'test': {
+        'count': '1.5',
+        'enabled': 'maybe',
+        'numbers': '1,two',
+        'level': 'medium',
+        'mystery': '1',
+        'unset': 'None',
+    }})
+
+    assert converted == {'test': {'mystery': '1', 'unset': None}}
+    assert unknown == [('test', 'mystery')]
+    assert sorted(option for section, option, value, error in invalid) == ['count', 'enabled', 'level', 'numbers']
+
+
+def make_cli(clim_env, monkeypatch):
+    monkeypatch.chdir(str(clim_env))
+    cli = CLIM('Config schema test.')
+    cli.prog_name = 'p'
+    cli.add_argument('--num', type=int, default=1, help='A number')
+    cli.config_file = str(clim_env / 'p.ini')
+    cli.args, cli.args_passed = cli.parse_argv([])
+
+    return cli
+
+
+def test_problems_are_reported(clim_env, monkeypatch, caplog):
+    (clim_env / 'p.ini').write_text('[general]\nnum = abc\n\n[test]\nmystery = 1\n')
+    cli = make_cli(clim_env, monkeypatch)
+    cli.read_config()
+
+    with caplog.at_level(logging.WARNING):
+        cli.report_config_problems()
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert 'Invalid value for general.num in %s: invalid literal for int() with base 10: \'abc\'' % cli.config_file in messages
+    assert 'Unknown option test.mystery in %s' % cli.config_file in messages
+    assert cli.config.general.num == 1
+    assert cli.config.test.mystery == '1'
+
+
+def test_invalid_env_value_falls_back_to_the_user_file(clim_env, monkeypatch, caplog):
+    (clim_env / 'p.ini').write_text('[general]\nnum = 5\n')
+    monkeypatch.setenv('P_GENERAL_NUM', 'abc')
+    cli = make_cli(clim_env, monkeypatch)
+    cli.read_config()
+
+    with caplog.at_level(logging.WARNING):
+        cli.report_config_problems()
+
+    assert cli.config.general.num == 5
+    assert cli.config.provenance('general', 'num') == 'user'
+    assert [record.getMessage() for record in caplog.records] == ["Invalid value for general.num in the environment: invalid literal for int() with base 10: 'abc'"]
+
+    monkeypatch.setenv('P_GENERAL_NUM', '7')
+    cli.reload_config_layer('env')
+    assert cli.config.general.num == 7
@@ -0,0 +1,87 @@
+"""Tests for the copy-on-write configuration.
+"""
+import pytest
+
+from clim import ConfigSnapshot, Configuration
+
+
+def make_config():
+    config = Configuration()
+    config.set_layer('defaults', {'general': {'color': True, 'jobs': 0}})
+    config.set_layer('user', {'general': {'jobs': 4}}, '/home/user/.config/prog.ini')
+
+    return config
+
+
+def test_snapshot_does_not_change():
+    config = make_config()
+    snapshot = config.snapshot()
+
+    config.general.jobs = 8
+    config.general.color = False
+    config.compile = {'target': 'all'}
+    del config.general['color']
+
+    assert config.general.jobs == 8
+    assert config.compile.target == 'all'
+    assert config.general.color is None
+    assert snapshot.general.jobs == 4
+    assert snapshot.general.color is True
+    assert 'compile' not in snapshot
+    assert snapshot.merged() == {'general': {'color': True, 'jobs': 4}}
+    assert snapshot.provenance('general', 'jobs') == 'user'
+    assert config.provenance('general', 'jobs') == 'runtime'
+    assert snapshot.sources == config.sources == {'defaults': None, 'user': '/home/user/.config/prog.ini'}
+
+
+def test_snapshot_reads_like_the_config():
+    config = make_config()
+    snapshot = config.snapshot()
+
+    assert isinstance(snapshot, ConfigSnapshot)
+    assert snapshot.keys() == config.keys() == ['general']
+    assert dict(snapshot.general.items()) == dict(config.general.items()) == {'color': True, 'jobs': 4}
+    assert repr(snapshot) == repr(config)
+    assert len(snapshot) == len(config) == 1
+    assert snapshot.get_layer('user') is config.get_layer('user')
+
+
+def test_deleting_hides_every_layer():
+    config = make_config()
+    snapshot = config.snapshot()
+
+    del config.general['jobs']
+    del config.general['missing']
+
+    assert config.general.jobs is None
+    assert 'jobs' not in config.general
+    assert config.general.keys() == ['color']
+    assert config.merged() == {'general': {'color': True}}
+    assert config.provenance('general', 'jobs') is None
+    assert snapshot.general.jobs == 4
+
+    config.general.jobs = 2
+    assert config.general.jobs == 2
+
+    del config['general']
+    assert config.general.color is None
+    assert config.general.keys() == []
+    assert config.get_layer('user') == {'general': {'jobs': 4}}
+
+
+def test_snapshot_is_read_only():
+    snapshot = make_config().snapshot()
+
+    with pytest.raises(TypeError):
+        snapshot.general.jobs = 8
+
+    with pytest.raises(TypeError):
+        snapshot['general'] = {}
+
+    with pytest.raises(TypeError):
+        snapshot.general = {}
+
+    with pytest.raises(TypeError):
+        del snapshot.general['color']
+
+    assert snapshot.general.jobs == 4
@@ -0,0 +1,53 @@
+"""Keep `import clim` fast.
+
+`import clim` took about 53ms before colorama, halo and friends were
+imported lazily, and 31-37ms after (the fastest of 10 runs, bytecode
+cached). Timings vary a lot between machines and how busy they are, so
+IMPORT_BUDGET is a coarse limit. Moving one of the lazy imports back to
+the top of the module is caught by `test_deferred_modules_are_not_imported`.
+"""
+import json
+import subprocess
+import sys
+
+from clim_bench import DEFERRED_MODULES
+from conftest import python_env
+
+IMPORT_BUDGET = 0.060  # Seconds
+
+
+def import_env():
+    """Let python write bytecode, compiling clim.py on every run would dwarf everything else.
+    """
+    env = python_env()
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    return env
+
+
+def import_time():
+    """Returns the cumulative time `python -X importtime` reports for importing clim.
+    """
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import clim'], env=import_env(), stderr=subprocess.PIPE, universal_newlines=True)
+    stderr = process.communicate()[1]
+
+    for line in stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if fields[-1] == 'clim':
+            return int(fields[1]) / 1e6
+
+    raise AssertionError('No import time for clim in:\n' + stderr)
+
+
+def test_import_time_budget():
+    import_time()  # Write the bytecode
+    fastest = min(import_time() for i in range(10))
+
+    assert fastest < IMPORT_BUDGET, 'import clim took %.1fms, the budget is %.1fms' % (fastest * 1e3, IMPORT_BUDGET * 1e3)
+
+
+def test_deferred_modules_are_not_imported():
+    script = 'import json, sys, clim; print(json.dumps([module for module in %r if module in sys.modules]))' % (DEFERRED_MODULES,)
+    output = subprocess.check_output([sys.executable, '-c', script], env=import_env(), universal_newlines=True)
+
+    assert json.loads(output) == []
@@ -0,0 +1,101 @@
+"""Tests for lazy subcommands and their manifest.
+"""
+from conftest import start_program
+
+PROGRAM = '''
+import sys
+sys.path.insert(0, %r)
+
+from clim import CLIM
+
+cli = CLIM('Lazy subcommand test.')
+
+
+@cli.subcommand
+def hello(cli):
+    """Say hello."""
+    print('hello')
+
+
+cli.lazy_subcommand('lazycmds.greet')
+cli.lazy_subcommand('lazycmds.anon')
+
+with cli:
+    cli.run()
+'''
+
+GREET = '''
+from clim import argument
+
+print('IMPORTED greet')
+
+
+def shout(value):
+    return value.upper()
+
+
+@argument('--name', type=shout, default='world', help='Name to greet')
+def greet(cli):
+    """Greet someone."""
+    print('greet %s' % cli.config.greet.name)
+'''
+
+ANON = '''
+from clim import argument
+
+print('IMPORTED anon')
+
+
+@argument('--count', type=lambda value: int(value) * 2, default=1, help='How many')
+def anon(cli):
+    """Has an argument that can't be stored in the manifest."""
+    print('anon %r' % cli.config.anon.count)
+'''
+
+
+def run(tmp_path, *args):
+    program = tmp_path / 'prog.py'
+
+    if not program.exists():
+        package = tmp_path / 'lazycmds'
+        package.mkdir()
+        (package / '__init__.py').write_text('')
+        (package / 'greet.py').write_text(GREET)
+        (package / 'anon.py').write_text(ANON)
+        program.write_text(PROGRAM % str(tmp_path))
+
+    process = start_program(program, *args)
+    stdout, stderr = process.communicate()
+
+    assert process.returncode == 0, stderr.decode('utf-8')
+
+    return stdout.decode('utf-8').splitlines()
+
+
+def test_manifest_does_not_import_subcommands(clim_env):
+    run(clim_env, 'hello')  # Builds the manifest, which imports everything
+
+    output = run(clim_env, 'hello')
+
+    assert 'hello' in output
+    assert 'IMPORTED greet' not in output
+
+
+def test_types_are_resolved_when_the_subcommand_runs(clim_env):
+    run(clim_env, 'hello')
+
+    assert run(clim_env, 'greet', '--name', 'bob')[-2:] == ['IMPORTED greet', 'greet BOB']
+
+
+def test_config_for_other_subcommands_does_not_import_them(clim_env):
+    (clim_env / '.prog.ini').write_text('[greet]\nname = alice\n')
+    run(clim_env, 'hello')
+
+    assert 'IMPORTED greet' not in run(clim_env, 'hello')
+    assert run(clim_env, 'greet')[-1] == 'greet ALICE'
+
+
+def test_unstorable_arguments_are_registered_eagerly(clim_env):
+    assert run(clim_env, 'anon', '--count', '3')[-1] == 'anon 6'
+    assert run(clim_env, 'anon', '--count', '3')[-1] == 'anon 6'
+    assert 'hello' in run(clim_env, 'hello')
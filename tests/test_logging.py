@@ -0,0 +1,178 @@
+"""Tests for the logging handlers and filters.
+"""
+import json
+import logging
+import sys
+import threading
+from time import sleep
+
+from clim import ANSIFormatter, AsyncLogHandler, JSONFormatter, LiveStreamHandler, LogRateFilter, ProgressRenderer, ansi_template_cache, load_ansi_colors
+from test_progress import TerminalStream
+
+
+def make_record(message, name='test', level=logging.INFO):
+    return logging.LogRecord(name, level, __file__, 0, message, None, None)
+
+
+def test_async_batches_clear_the_live_region():
+    stream = TerminalStream()
+    renderer = ProgressRenderer(stream, fps=100)
+    handler = LiveStreamHandler(stream, renderer)
+    async_handler = AsyncLogHandler([handler], flush_interval=0.01)
+    task = renderer.task('spin')
+    sleep(0.05)
+
+    async_handler.handle(make_record('ASYNC-LINE'))
+    async_handler.stop()
+
+    data = stream.data
+    index = [i for i, chunk in enumerate(data) if 'ASYNC-LINE' in chunk][0]
+    assert data[index - 1].startswith('\x1b[') and data[index - 1].endswith('\x1b[J')
+    assert 'spin' in data[index + 1]
+
+    task.stop()
+    renderer.close()
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+def test_repeat_summary_reaches_every_handler():
+    log = logging.getLogger('test_rate_filter')
+    log.propagate = False
+    log_filter = LogRateFilter(window=0.05)
+    handlers = [ListHandler(), ListHandler()]
+
+    for handler in handlers:
+        handler.addFilter(log_filter)
+        log.addHandler(handler)
+
+    try:
+        log.warning('noisy')
+        log.warning('noisy')
+        sleep(0.1)
+        log.warning('noisy')
+    finally:
+        for handler in handlers:
+            log.removeHandler(handler)
+
+    for handler in handlers:
+        assert handler.messages == ['noisy', 'noisy (repeated 1 more times)', 'noisy']
+
+
+def test_color_tokens_are_cached_per_template():
+    ansi_template_cache.clear()
+    formatter = ANSIFormatter('{fg_blue}%(levelname)s{style_reset_all} %(message)s')
+    colors = load_ansi_colors()
+    reset = colors['style_reset_all']
+
+    for i in range(100):
+        record = make_record('{fg_red}Record{style_reset_all} %d of %s')
+        record.args = (i, '{fg_green}args')
+        assert formatter.format(record) == '%sINFO%s %sRecord%s %d of %sargs%s' % (colors['fg_blue'], reset, colors['fg_red'], reset, i, colors['fg_green'], reset)
+        assert record.msg == '{fg_red}Record{style_reset_all} %d of %s'
+
+    assert len(ansi_template_cache) == 2
+
+
+def test_json_messages_have_no_color_tokens():
+    record = make_record('{fg_red}Record{style_reset_all} %s')
+    record.args = ('{fg_green}args',)
+
+    assert json.loads(JSONFormatter().format(record))['message'] == 'Record args'
+
+
+def test_json_lines_leave_out_rate_limit_state():
+    log = logging.getLogger('test_json_rate')
+    log.propagate = False
+    handler = ListHandler()
+    handler.setFormatter(JSONFormatter())
+    handler.addFilter(LogRateFilter(rate=1, burst=2))
+    log.addHandler(handler)
+
+    try:
+        for i in range(5):
+            log.warning('limited %d', i, extra={'request': 'abc'})
+    finally:
+        log.removeHandler(handler)
+
+    lines = [json.loads(line) for line in handler.messages]
+    assert [line['message'] for line in lines] == ['limited 0', 'limited 1']
+    for line in lines:
+        assert line['request'] == 'abc'
+        assert not [key for key in line if key.startswith('_')]
+
+
+class BaselineANSIFormatter(logging.Formatter):
+    """ANSIFormatter as it was before rendering moved to the templates.
+    """
+    def format(self, record):
+        msg = super(BaselineANSIFormatter, self).format(record)
+        colors = load_ansi_colors()
+        for color in colors:
+            msg = msg.replace('{%s}' % color, colors[color])
+
+        return msg + colors['style_reset_all']
+
+
+def test_ansi_formatter_matches_the_baseline():
+    fmt = '{fg_blue}%(levelname)s{style_reset_all} %(message)s'
+
+    try:
+        raise ValueError('{fg_red}broken')
+    except ValueError:
+        exc_info = sys.exc_info()
+
+    records = [
+        ('{fg_red}plain %s', ('{fg_green}string',), None),
+        ('list %s and %d', (['{fg_cyan}item'], 3), None),
+        ('dict %(value)s', ({'value': '{fg_yellow}mapped'},), None),
+        (ValueError('{fg_magenta}object'), (), None),
+        ('{fg_red}failed', (), exc_info),
+    ]
+
+    for msg, args, exc in records:
+        expected_record = logging.LogRecord('test', logging.ERROR, __file__, 0, msg, args, exc)
+        record = logging.LogRecord('test', logging.ERROR, __file__, 0, msg, args, exc)
+
+        assert ANSIFormatter(fmt).format(record) == BaselineANSIFormatter(fmt).format(expected_record)
+        assert '{' not in ANSIFormatter(fmt).format(record)
+        assert record.msg is msg
+        assert '\x1b' not in (record.exc_text or '')
+
+
+class SlowListHandler(ListHandler):
+    def emit(self, record):
+        sleep(0.001)
+        super(SlowListHandler, self).emit(record)
+
+
+def test_drop_oldest_queue_stops_while_logging_continues():
+    handler = SlowListHandler()
+    async_handler = AsyncLogHandler([handler], maxsize=2, flush_interval=0, policy='drop-oldest', batch_size=1)
+    logging_done = threading.Event()
+
+    def keep_logging():
+        while not logging_done.is_set():
+            async_handler.handle(make_record('record'))
+
+    logger = threading.Thread(target=keep_logging)
+    logger.start()
+    sleep(0.05)
+
+    stopper = threading.Thread(target=async_handler.stop)
+    stopper.daemon = True
+    stopper.start()
+    stopper.join(2)
+    logging_done.set()
+    logger.join()
+
+    assert not stopper.is_alive()
+    assert not async_handler.thread.is_alive()
+    assert len([message for message in handler.messages if message.endswith('dropped because the log queue was full.')]) == 1
@@ -0,0 +1,48 @@
+"""Tests for running jobs with `cli.parallel()`.
+"""
+import multiprocessing
+import os
+
+from clim import CLIM
+from conftest import start_program
+
+PROGRAM = '''
+from clim import CLIM
+
+cli = CLIM('Parallel test.')
+
+
+def square(cli, item):
+    cli.log.info('square %d', item)
+    return item * item
+
+
+@cli.entrypoint
+def main(cli):
+    print(cli.parallel(square, (i for i in range(5)), jobs=2))
+
+
+with cli:
+    cli.run()
+'''
+
+
+def test_parallel_accepts_a_generator(clim_env):
+    program = clim_env / 'prog.py'
+    program.write_text(PROGRAM)
+    stdout, stderr = start_program(program, '--no-color', universal_newlines=True).communicate()
+
+    assert stdout.strip().splitlines()[-1] == '[0, 1, 4, 9, 16]'
+    for i in range(5):
+        assert 'square %d' % i in stdout + stderr
+
+
+def square_with_pid(cli, item):
+    return item * item, os.getpid()
+
+
+def test_processes_fall_back_to_threads_without_fork(monkeypatch):
+    monkeypatch.setattr(multiprocessing, 'get_all_start_methods', lambda: ['spawn'])
+    cli = CLIM('Parallel test.')
+
+    assert cli.parallel(square_with_pid, range(5), jobs=2, processes=True) == [(i * i, os.getpid()) for i in range(5)]
@@ -0,0 +1,66 @@
+"""Tests for the progress renderer.
+"""
+import threading
+from time import sleep
+
+from clim import ProgressRenderer
+
+
+class TerminalStream(object):
+    """Collects what is written to it and claims to be a terminal.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = []
+
+    def isatty(self):
+        return True
+
+    def write(self, data):
+        with self.lock:
+            self.data.append(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        with self.lock:
+            return ''.join(self.data)
+
+
+def test_stopping_tasks_while_rendering(monkeypatch):
+    errors = []
+    monkeypatch.setattr(threading, 'excepthook', lambda args: errors.append(args.exc_value), raising=False)
+    renderer = ProgressRenderer(TerminalStream(), fps=1000)
+
+    for i in range(2000):
+        task = renderer.task('task %d' % i)
+        task.succeed()
+
+    assert errors == []
+
+    task = renderer.task('still drawing')
+    sleep(0.05)
+
+    assert renderer.thread is not None and renderer.thread.is_alive()
+    assert 'still drawing' in renderer.stream.getvalue()
+
+    task.stop()
+    renderer.close()
+
+
+def test_render_thread_is_restarted_after_it_dies(monkeypatch):
+    monkeypatch.setattr(threading, 'excepthook', lambda args: None, raising=False)
+    renderer = ProgressRenderer(TerminalStream(), fps=1000)
+    task = renderer.task('broken')
+    task.render = None  # Calling this kills the render thread
+    sleep(0.05)
+
+    assert renderer.thread is None
+
+    task.stop()
+    renderer.task('working')
+    sleep(0.05)
+
+    assert renderer.thread is not None and renderer.thread.is_alive()
+    renderer.close()
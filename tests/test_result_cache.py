@@ -0,0 +1,128 @@
+"""Tests for serving subcommand results from the result cache.
+"""
+import os
+import subprocess
+
+from conftest import start_program
+
+PROGRAM = '''
+from clim import CLIM
+
+cli = CLIM('Result cache test.')
+
+
+@cli.argument('--size', type=int, default=10, help='Bytes of output to print')
+@cli.subcommand
+@cli.cached(files=['input.txt'])
+def build(cli):
+    """Build something slowly.
+    """
+    with open('runs.log', 'a') as runs:
+        runs.write('run\\n')
+
+    with open('input.txt') as input_file:
+        cli.log.info('built from %s', input_file.read())
+
+    print('x' * cli.config.build.size)
+
+
+with cli:
+    cli.run()
+'''
+
+
+def write_program(clim_env):
+    program = clim_env / 'prog.py'
+    program.write_text(PROGRAM)
+    (clim_env / 'input.txt').write_text('first')
+
+    return program
+
+
+def start_build(program, *args):
+    return start_program(program, '--no-color', *args, cwd=str(program.parent), stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def build(program, *args):
+    """Run the program with args and return (exit code, output).
+    """
+    process = start_build(program, *args)
+    output = process.communicate()[0]
+
+    return process.returncode, output
+
+
+def count_runs(clim_env):
+    runs = clim_env / 'runs.log'
+
+    return len(runs.read_text().splitlines()) if runs.exists() else 0
+
+
+def cache_entries(clim_env):
+    """Returns the size of every entry in the result cache.
+    """
+    sizes = []
+
+    for directory, subdirectories, filenames in os.walk(str(clim_env / 'cache' / 'prog' / 'results')):
+        sizes.extend(os.path.getsize(os.path.join(directory, filename)) for filename in filenames if filename != 'lock')
+
+    return sizes
+
+
+def test_second_run_is_a_hit(clim_env):
+    program = write_program(clim_env)
+    first = build(program, 'build')
+    second = build(program, 'build')
+
+    assert first[0] == second[0] == 0
+    assert second[1] == first[1]
+    assert 'built from first' in second[1]
+    assert count_runs(clim_env) == 1
+
+
+def test_changed_inputs_miss(clim_env):
+    program = write_program(clim_env)
+    build(program, 'build')
+
+    (clim_env / 'input.txt').write_text('second')
+    assert 'built from second' in build(program, 'build')[1]
+    assert count_runs(clim_env) == 2
+
+    build(program, 'build', '--size', '20')
+    assert count_runs(clim_env) == 3
+
+    build(program, 'build', '--size', '20')
+    assert count_runs(clim_env) == 3
+
+
+def test_eviction_at_cache_size(clim_env):
+    program = write_program(clim_env)
+    entry_size = 400 * 1024
+
+    for i in range(5):
+        assert build(program, '--cache-size', '1', 'build', '--size', str(entry_size + i))[0] == 0
+
+    sizes = cache_entries(clim_env)
+    assert 0 < len(sizes) < 5
+    assert sum(sizes) <= 2**20
+
+    # The newest result is the one that was kept
+    build(program, '--cache-size', '1', 'build', '--size', str(entry_size + 4))
+    assert count_runs(clim_env) == 5
+
+
+def test_processes_writing_at_once(clim_env):
+    program = write_program(clim_env)
+    processes = [start_build(program, 'build', '--size', str(100 + i % 4)) for i in range(8)]
+
+    for process in processes:
+        process.communicate()
+        assert process.returncode == 0
+
+    assert len(cache_entries(clim_env)) == 4
+
+    runs = count_runs(clim_env)
+    for i in range(4):
+        assert build(program, 'build', '--size', str(100 + i))[0] == 0
+
+    assert count_runs(clim_env) == runs
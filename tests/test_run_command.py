@@ -0,0 +1,99 @@
+"""Tests for running external commands with `cli.run_command()`.
+"""
+import errno
+import logging
+import os
+import subprocess
+import sys
+from time import sleep, time
+
+import pytest
+
+from clim import CLIM
+
+OUTPUT_SIZE = 4 * 1024 * 1024
+
+LOUD_COMMAND = '''
+import sys
+
+line = 'x' * 1023 + '\\n'
+for i in range(%d):
+    sys.stdout.write(line)
+    sys.stderr.write(line)
+''' % (OUTPUT_SIZE // 1024)
+
+GROUP_COMMAND = '''
+import subprocess, sys, time
+
+child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+print(child.pid)
+sys.stdout.flush()
+time.sleep(60)
+'''
+
+
+def python_command(code):
+    return [sys.executable, '-c', code]
+
+
+def process_running(pid):
+    """Returns True if pid is alive. Zombies waiting for init to reap them count as gone.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    try:
+        with open('/proc/%d/stat' % pid) as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return True
+
+
+def test_large_output_on_both_streams():
+    cli = CLIM('Run command test.')
+    result = cli.run_command(python_command(LOUD_COMMAND), stdout_level=None, stderr_level=None, capture=True, timeout=60)
+
+    assert not result.timed_out
+    assert result.returncode == 0
+    assert len(result.stdout) == len(result.stderr) == OUTPUT_SIZE
+    assert result.output_bytes == 2 * OUTPUT_SIZE
+
+
+def test_timeout_kills_the_process_group():
+    cli = CLIM('Run command test.')
+    result = cli.run_command(python_command(GROUP_COMMAND), stdout_level=None, capture=True, timeout=0.5, kill_grace=1)
+
+    assert result.timed_out
+    assert result.returncode != 0
+    assert result.duration < 30
+
+    # The output pipes close as soon as the group is signalled, the grandchild may take a moment to exit
+    child = int(result.stdout)
+    deadline = time() + 5
+    while process_running(child) and time() < deadline:
+        sleep(0.05)
+
+    assert not process_running(child)
+
+
+def test_return_code_and_captured_output(caplog):
+    cli = CLIM('Run command test.')
+    code = "import sys; print('\\x1b[31mout\\x1b[0m'); sys.stderr.write('err\\n'); sys.exit(3)"
+
+    with caplog.at_level(logging.DEBUG):
+        result = cli.run_command(python_command(code), capture=True)
+
+    assert result.returncode == 3
+    assert not result
+    assert result.stdout == 'out\n'
+    assert result.stderr == 'err\n'
+    assert ('CLIM', logging.INFO, 'out') in caplog.record_tuples
+    assert ('CLIM', logging.WARNING, 'err') in caplog.record_tuples
+
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        cli.run_command(python_command(code), stdout_level=None, stderr_level=None, capture=True, check=True)
+
+    assert error.value.returncode == 3
+    assert error.value.output == 'out\n'
@@ -0,0 +1,98 @@
+"""Tests for saving the configuration.
+"""
+try:
+    from configparser import RawConfigParser
+except ImportError:
+    from ConfigParser import RawConfigParser
+
+from conftest import start_program
+
+OPTIONS = 20
+
+PROGRAM = '''
+from clim import CLIM
+
+cli = CLIM('Save config test.')
+
+for i in range(%d):
+    cli.add_argument('--opt%%d' %% i, default='default', help='Option %%d' %% i)
+
+
+@cli.entrypoint
+def main(cli):
+    pass
+
+
+with cli:
+    cli.run()
+''' % OPTIONS
+
+
+def read_config_file(path):
+    config = RawConfigParser()
+    config.read(str(path))
+
+    return dict((section, dict(config.items(section))) for section in config.sections())
+
+
+def save_options(tmp_path, config_file, options):
+    """Run one process per option at the same time, each saving one option. Returns their exit codes.
+    """
+    program = tmp_path / 'prog.py'
+    program.write_text(PROGRAM)
+    processes = [start_program(program, '-c', str(config_file), '--save-config', '--opt%d' % i, value) for i, value in options]
+
+    for process in processes:
+        process.communicate()
+
+    return [process.returncode for process in processes]
+
+
+def test_parallel_saves_without_config_file(clim_env):
+    config_file = clim_env / 'prog.ini'
+
+    assert save_options(clim_env, config_file, [(i, 'value%d' % i) for i in range(OPTIONS)]) == [0] * OPTIONS
+
+    general = read_config_file(config_file)['general']
+    for i in range(OPTIONS):
+        assert general['opt%d' % i] == 'value%d' % i
+
+
+def test_parallel_saves_with_config_file(clim_env):
+    config_file = clim_env / 'prog.ini'
+    config_file.write_text('[general]\n' + ''.join('opt%d = old%d\n' % (i, i) for i in range(OPTIONS)))
+
+    assert save_options(clim_env, config_file, [(i, 'new%d' % i) for i in range(OPTIONS)]) == [0] * OPTIONS
+
+    general = read_config_file(config_file)['general']
+    for i in range(OPTIONS):
+        assert general['opt%d' % i] == 'new%d' % i
+
+
+def test_untouched_defaults_are_not_saved(clim_env):
+    config_file = clim_env / 'prog.ini'
+
+    assert save_options(clim_env, config_file, [(3, 'three')]) == [0]
+
+    general = read_config_file(config_file)['general']
+    assert general['opt3'] == 'three'
+    assert 'opt4' not in general
+    assert 'verbose' not in general
+
+
+def test_run_mode_options_are_not_saved(clim_env):
+    config_file = clim_env / 'prog.ini'
+    program = clim_env / 'prog.py'
+    program.write_text(PROGRAM)
+    run_options = []
+    for option in ('--timings-file', '--metrics-file', '--profile'):
+        run_options += [option, str(clim_env / (option[2:] + '.out'))]
+
+    process = start_program(program, '-c', str(config_file), '--save-config', '--opt1', 'one', *run_options)
+    process.communicate()
+
+    assert process.returncode == 0
+    general = read_config_file(config_file)['general']
+    assert general['opt1'] == 'one'
+    for option in ('save_config', 'timings_file', 'metrics_file', 'profile'):
+        assert option not in general
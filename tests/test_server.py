@@ -0,0 +1,187 @@
+"""Tests for the warm server started with `--serve`.
+"""
+import json
+import os
+import signal
+import socket
+from time import sleep
+
+import pytest
+
+from conftest import ROOT, python_env, start_program
+
+QMK = os.path.join(ROOT, 'qmk')
+CLIENT = '''
+import sys
+from clim_client import run_client
+
+exit_code = run_client(%r, ['qmk', 'hello'])
+print(exit_code, 'clim' in sys.modules)
+'''
+
+LAZY_PROGRAM = '''
+import os
+import sys
+sys.path.insert(0, %r)
+
+if os.environ.get('QMK_SERVER'):
+    from clim_client import run_client
+
+    exit_code = run_client(os.environ['QMK_SERVER'])
+    if exit_code is not None:
+        exit(exit_code)
+
+from clim import CLIM
+
+cli = CLIM('Lazy server test.')
+cli.lazy_subcommand('lazyserved:wave')
+
+with cli:
+    cli.run()
+'''
+
+LAZY_MODULE = '''
+import os
+
+from clim import argument
+
+
+@argument('--name', default='world', help='Who to wave at')
+def wave(cli):
+    """Wave at someone."""
+    print('wave %s from %d' % (cli.config.wave.name, os.getppid()))
+'''
+
+
+def start_server(socket_path, program=QMK):
+    """Start `program --serve socket_path` and wait for it to listen.
+    """
+    server = start_program(program, '--serve', str(socket_path), universal_newlines=True)
+
+    for i in range(200):
+        if server.poll() is not None or os.path.exists(str(socket_path)):
+            break
+        sleep(0.05)
+
+    return server
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    return server.communicate()
+
+
+def run_program(program, socket_path, *args):
+    env = python_env()
+    env['QMK_SERVER'] = str(socket_path)
+    process = start_program(program, *args, env=env, universal_newlines=True)
+    stdout, stderr = process.communicate()
+
+    return process.returncode, stdout, stderr
+
+
+def run_qmk(socket_path, *args):
+    return run_program(QMK, socket_path, *args)
+
+
+@pytest.fixture
+def socket_path(clim_env):
+    return clim_env / 'qmk.sock'
+
+
+def test_requests_are_run_by_the_server(socket_path):
+    server = start_server(socket_path)
+
+    try:
+        assert run_qmk(socket_path, 'hello')[:2] == (0, 'Hello, World!\n')
+        assert run_qmk(socket_path, 'goodbye')[:2] == (0, 'Goodbye, World!\n')
+        assert run_qmk(socket_path, 'nonexistent')[0] == 2
+
+        # Forwarding a command must not import clim
+        client = start_program('-c', CLIENT % str(socket_path), universal_newlines=True)
+        assert client.communicate()[0] == 'Hello, World!\n0 False\n'
+
+    finally:
+        stop_server(server)
+
+    assert server.returncode == 0
+    assert not os.path.exists(str(socket_path))
+
+
+def test_stale_socket_is_replaced(socket_path):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(socket_path))
+    stale.close()
+
+    server = start_server(socket_path)
+
+    try:
+        assert run_qmk(socket_path, 'hello')[:2] == (0, 'Hello, World!\n')
+    finally:
+        stop_server(server)
+
+
+def test_running_server_is_left_alone(socket_path):
+    server = start_server(socket_path)
+
+    try:
+        second = start_server(socket_path)
+        stdout, stderr = second.communicate()
+
+        assert second.returncode != 0
+        assert 'already listening' in stdout + stderr
+        assert run_qmk(socket_path, 'hello')[:2] == (0, 'Hello, World!\n')
+
+    finally:
+        stop_server(server)
+
+
+def test_other_files_are_left_alone(socket_path):
+    socket_path.write_text('not a socket')
+
+    server = start_server(socket_path)
+    stdout, stderr = server.communicate()
+
+    assert server.returncode != 0
+    assert 'not a socket' in stdout + stderr
+    assert socket_path.read_text() == 'not a socket'
+
+
+def test_lazy_subcommands_are_forwarded(socket_path):
+    modules = socket_path.parent / 'modules'
+    modules.mkdir()
+    (modules / 'lazyserved.py').write_text(LAZY_MODULE)
+    program = socket_path.parent / 'lazy.py'
+    program.write_text(LAZY_PROGRAM % str(modules))
+
+    server = start_server(socket_path, program)
+
+    try:
+        # Requests are run in children forked by the server
+        assert run_program(program, socket_path, 'wave')[:2] == (0, 'wave world from %d\n' % server.pid)
+        assert run_program(program, socket_path, 'wave', '--name', 'you')[:2] == (0, 'wave you from %d\n' % server.pid)
+
+    finally:
+        stop_server(server)
+
+
+def test_forwarded_timings_match_a_direct_run(socket_path):
+    direct_file = socket_path.parent / 'direct.json'
+    served_file = socket_path.parent / 'served.json'
+    direct = start_program(QMK, '--timings-file', str(direct_file), 'hello')
+    direct.communicate()
+
+    server = start_server(socket_path)
+
+    try:
+        sleep(1)
+        assert run_qmk(socket_path, '--timings-file', str(served_file), 'hello')[0] == 0
+
+    finally:
+        stop_server(server)
+
+    direct_timings = json.loads(direct_file.read_text())
+    served_timings = json.loads(served_file.read_text())
+
+    assert [span['name'] for span in served_timings['spans']] == [span['name'] for span in direct_timings['spans']]
+    assert served_timings['total'] < 1
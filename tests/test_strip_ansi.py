@@ -0,0 +1,67 @@
+"""Compare `strip_ansi()` with the regex it replaced, `ansi_escape`.
+
+Every sequence in the corpus must be stripped the same way by both,
+except the ones in `INTENDED_DIFFERENCES`, which the old regex got wrong.
+"""
+import random
+
+from clim import ANSIStripper, ansi_escape, strip_ansi
+
+CSI = '\x1b['
+
+# SGR colors and styles, as colorama writes them
+SGR = [CSI + '%dm' % n for n in list(range(30, 38)) + [39] + list(range(90, 98)) + list(range(40, 48)) + [49] + [0, 1, 2, 22]]
+
+# Cursor movement, erasing and modes
+CONTROL = [CSI + '2A', CSI + '3B', CSI + '4C', CSI + '5D', CSI + '10;20H', CSI + '0J', CSI + '2J', CSI + 'K', CSI + '2K', CSI + '?25l', CSI + '?25h', '\x1b7', '\x1b8', '\x1b(B', '\x1bM']
+
+# Sequence: (what the old regex left behind, what strip_ansi() leaves behind)
+INTENDED_DIFFERENCES = {
+    # Back.LIGHT*_EX, the old regex only allowed two digit parameters
+    CSI + '100m': (CSI + '100m', ''),
+    CSI + '101m': (CSI + '101m', ''),
+    CSI + '102m': (CSI + '102m', ''),
+    CSI + '103m': (CSI + '103m', ''),
+    CSI + '104m': (CSI + '104m', ''),
+    CSI + '105m': (CSI + '105m', ''),
+    CSI + '106m': (CSI + '106m', ''),
+    CSI + '107m': (CSI + '107m', ''),
+    # Multi-parameter SGR, the old regex stopped at the first parameter
+    CSI + '1;31m': ('m', ''),
+    CSI + '38;5;208m': (';208m', ''),
+    # OSC strings (window titles, hyperlinks) were not recognized at all
+    '\x1b]0;title\x07': ('\x1b]0;title\x07', ''),
+    '\x1b]2;title\x1b\\': ('\x1b]2;title\x1b\\', ''),
+    '\x1b]8;;https://qmk.fm/\x1b\\': ('\x1b]8;;https://qmk.fm/\x1b\\', ''),
+}
+
+
+def test_corpus_matches_the_old_regex():
+    for sequence in SGR + CONTROL:
+        text = 'before' + sequence + 'after'
+        assert strip_ansi(text) == ansi_escape.sub('', text) == 'beforeafter', repr(sequence)
+
+
+def test_intended_differences():
+    for sequence, (old, new) in INTENDED_DIFFERENCES.items():
+        text = 'before' + sequence + 'after'
+        assert ansi_escape.sub('', text) == 'before' + old + 'after', repr(sequence)
+        assert strip_ansi(text) == 'before' + new + 'after', repr(sequence)
+
+
+def test_text_without_escapes_is_untouched():
+    for text in ('', 'plain text', '[31m not an escape', '{fg_red} a color token'):
+        assert strip_ansi(text) == ansi_escape.sub('', text) == text
+
+
+def test_streaming_matches_whole_text():
+    sequences = SGR + CONTROL + list(INTENDED_DIFFERENCES)
+    rng = random.Random(0)
+
+    for i in range(500):
+        text = ''.join(rng.choice(sequences) + 'word%d ' % j for j in range(20))
+        stripper = ANSIStripper()
+        cuts = sorted(rng.sample(range(1, len(text)), 10))
+        chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+        assert ''.join(stripper.feed(chunk) for chunk in chunks) + stripper.flush() == strip_ansi(text)